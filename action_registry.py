@@ -0,0 +1,64 @@
+'''
+The actions executed on ticks, and the parameters they take.
+
+Actions are checked against their schema when queued locally (GameModel.add_action)
+and when decoded from a peer's packets (wire.Reader.actions), so a malformed action
+is rejected before it reaches a tick, and handlers get the parameters they expect.
+
+A schema lists the types of the parameters:
+
+* int
+* str
+* square: a board square, a pair of non-negative ints
+* player: a player number, as an int or the digits typed in a command
+
+The last type may be followed by '...', for any number of such parameters.
+'''
+
+# Action -> (whether the engine or the game handles it, its parameters)
+schemas = {
+    'move': ('game', ['square', 'square']),
+    'msg': ('game', ['str', '...']),
+    'surrender': ('game', []),
+    'become': ('game', ['player']),
+    'nick': ('game', ['str']),
+    'credits': ('game', []),
+    'delay': ('engine', ['int']),
+    'hash': ('engine', ['int', 'int']),
+    }
+
+def is_square(value):
+    return type(value) is tuple and len(value) == 2 and \
+        type(value[0]) is int and type(value[1]) is int and value[0] >= 0 and value[1] >= 0
+
+type_checks = {
+    'int': lambda value: type(value) is int,
+    'str': lambda value: type(value) is str,
+    'square': is_square,
+    'player': lambda value: type(value) is int and value >= 0 or type(value) is str and value.isdigit(),
+    }
+
+def compile_schema(params):
+    'The checks of the fixed parameters, and of the repeated last one (None if it isn\'t)'
+    if params[-1:] == ['...']:
+        return tuple(type_checks[x] for x in params[:-2]), type_checks[params[-2]]
+    return tuple(type_checks[x] for x in params), None
+
+# Actions the engine adds for its bookkeeping (not the game's), such as state hashes
+engine_actions = frozenset(name for name, (handled_by, _) in schemas.items() if handled_by == 'engine')
+
+# Compiled once, as every action received is checked
+checks = {name: compile_schema(params) for name, (_, params) in schemas.items()}
+
+def check(action_type, params):
+    'Why an action is malformed, or None if it is fine'
+    compiled = checks.get(action_type)
+    if compiled is None:
+        return 'no such action'
+    fixed, repeated = compiled
+    if len(params) != len(fixed) and (repeated is None or len(params) < len(fixed)):
+        return 'takes %d parameters%s, not %d' % (len(fixed), ' or more' if repeated else '', len(params))
+    for i, value in enumerate(params):
+        if not (fixed[i] if i < len(fixed) else repeated)(value):
+            return 'bad parameter %d: %r' % (i + 1, value)
+    return None
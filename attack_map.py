@@ -0,0 +1,218 @@
+'''
+Per-side sight and attack data maintained incrementally as pieces move.
+
+Every piece remembers which squares its move generation looked at.
+When a square changes only the pieces watching it are recomputed,
+which amounts to re-walking the rays that the move opened or blocked.
+Recomputation is deferred until someone reads the map.
+
+Pieces and visible squares are also partitioned per 8x8 board region,
+so consumers interested in one board of an arena only read its region.
+'''
+
+import chess
+from board import move_tables
+
+region_width = 8
+
+class AttackMap:
+    def __init__(self, game):
+        self.game = game
+        self.tables = move_tables(game.board_size)
+        n = len(self.tables.positions)
+        num_regions = -(-game.board_size[0] // region_width)
+        self.square_region = [x // region_width for x, _ in self.tables.positions]
+        # Number of pieces of each side seeing / attacking each square
+        self.seen = [[0] * n, [0] * n]
+        self.attacked = [[0] * n, [0] * n]
+        self.visible_squares = [[set() for _ in range(num_regions)] for _ in range(2)]
+        self.region_pieces = [set() for _ in range(num_regions)]
+        self.player_pieces = {}
+        # Square index -> pieces, sets are only created for squares in use
+        self.watchers = {}
+        # Reverse index: pieces having each square among their base moves
+        self.attackers = {}
+        self.kings = [set(), set()]
+        # piece -> (sight, moves, watched, move positions)
+        self.entries = {}
+        self.dirty = set()
+        # Pawns whose en passant options depend on their player's last move
+        self.en_passant_pawns = set()
+        # Piece.moves() lookups answered from an up to date entry or not
+        self.hits = 0
+        self.misses = 0
+
+    def region_of(self, pos):
+        return pos[0] // region_width
+
+    def add(self, piece):
+        'A piece was placed on the board'
+        self.region_pieces[self.region_of(piece.pos)].add(piece)
+        self.player_pieces.setdefault(piece.player, set()).add(piece)
+        self.dirty.add(piece)
+        self.touch(piece.pos)
+
+    def remove(self, piece):
+        'A piece left the board'
+        self.region_pieces[self.region_of(piece.pos)].discard(piece)
+        self.player_pieces[piece.player].discard(piece)
+        self._retract(piece)
+        self.dirty.discard(piece)
+        self.touch(piece.pos)
+
+    def moved(self, piece, src):
+        self.region_pieces[self.region_of(src)].discard(piece)
+        self.region_pieces[self.region_of(piece.pos)].add(piece)
+        self.dirty.add(piece)
+        self.touch(src, piece.pos)
+        for pawn in self.en_passant_pawns:
+            if pawn.player == piece.player:
+                self.dirty.add(pawn)
+
+    def touch(self, *positions):
+        'Squares changed occupancy, recompute whoever looks at them'
+        index = self.tables.index
+        for pos in positions:
+            self.dirty.update(self.watchers.get(index[pos], ()))
+
+    def flush(self):
+        while self.dirty:
+            self._refresh(self.dirty.pop())
+
+    def _refresh(self, piece):
+        self.dirty.discard(piece)
+        self._retract(piece)
+        if self.game.board.get(piece.pos) is piece:
+            self._compute(piece)
+
+    def _compute(self, piece):
+        index = self.tables.index
+        side = piece.side()
+        move_positions = tuple(piece.base_moves())
+        moves = {index[pos] for pos in move_positions}
+        if isinstance(piece, chess.King):
+            # Threats the king notices are added in visible()
+            sight = set(moves)
+        else:
+            sight = {index[pos] for pos in piece.sight()}
+        sight.add(index[piece.pos])
+        watched = self._watched(piece)
+        self.entries[piece] = (sight, moves, watched, move_positions)
+        self._add_counts(self.seen[side], self.visible_squares[side], sight, 1)
+        self._add_counts(self.attacked[side], None, moves, 1)
+        for i in moves:
+            self.attackers.setdefault(i, set()).add(piece)
+        for i in watched:
+            self.watchers.setdefault(i, set()).add(piece)
+        if isinstance(piece, chess.King):
+            self.kings[side].add(piece)
+
+    def _retract(self, piece):
+        entry = self.entries.pop(piece, None)
+        self.en_passant_pawns.discard(piece)
+        if entry is None:
+            return
+        sight, moves, watched, _ = entry
+        side = piece.side()
+        self._add_counts(self.seen[side], self.visible_squares[side], sight, -1)
+        self._add_counts(self.attacked[side], None, moves, -1)
+        for i in moves:
+            self.attackers[i].discard(piece)
+        for i in watched:
+            self.watchers[i].discard(piece)
+        self.kings[side].discard(piece)
+
+    def _add_counts(self, counts, visible, squares, delta):
+        positions = self.tables.positions
+        for i in squares:
+            counts[i] += delta
+            if visible is None:
+                continue
+            if counts[i] == 0:
+                visible[self.square_region[i]].discard(positions[i])
+            elif counts[i] == delta == 1:
+                visible[self.square_region[i]].add(positions[i])
+
+    def _watched(self, piece):
+        'Squares whose contents affect the moves or sight of the piece'
+        tables = self.tables
+        board = self.game.board
+        positions = tables.positions
+        i = tables.index[piece.pos]
+        watched = set()
+        if isinstance(piece, chess.Pawn):
+            x, y = piece.pos
+            delta = -1 if piece.side() else 1
+            candidates = [(x, y+delta), (x, y+2*delta)]
+            for a in [x-1, x+1]:
+                candidates += [(a, y+delta), (a, y)]
+                other = board.get((a, y))
+                if type(other) == chess.Pawn and other.side() != piece.side():
+                    self.en_passant_pawns.add(piece)
+            return {tables.index[pos] for pos in candidates if pos in tables.index}
+        for ray in getattr(tables, piece.table)[i]:
+            for j in ray:
+                watched.add(j)
+                if positions[j] in board:
+                    break
+        if isinstance(piece, chess.King) and piece.last_move_time is None:
+            # Castling looks along the row up to the first piece
+            x, y = piece.pos
+            for dir in [-1, 1]:
+                dest = x+dir
+                while (dest, y) in tables.index:
+                    watched.add(tables.index[dest, y])
+                    if (dest, y) in board:
+                        break
+                    dest += dir
+        return watched
+
+    def visible(self, side, regions=None):
+        'Squares (in the given regions) seen by a side, including pieces threatening its kings'
+        self.flush()
+        per_region = self.visible_squares[side]
+        if regions is None:
+            regions = range(len(per_region))
+        squares = set().union(*(per_region[r] for r in regions))
+        for piece in self.kings[side]:
+            squares.update(pos for pos in piece.sight() if self.region_of(pos) in regions)
+        return squares
+
+    def sees(self, side, pos):
+        'Is the square in the sight of a piece of the side (king threats aside)'
+        self.flush()
+        return self.seen[side][self.tables.index[pos]] > 0
+
+    def attacks(self, side, pos):
+        'Is the square a capture or move target of any piece of the side'
+        self.flush()
+        return self.attacked[side][self.tables.index[pos]] > 0
+
+    def attackers_of(self, pos, side=None):
+        'Pieces (optionally of a given side) that can move to or capture on a square'
+        i = self.tables.index.get(pos)
+        if i is None:
+            return []
+        self.flush()
+        pieces = self.attackers.get(i, ())
+        if side is None:
+            return list(pieces)
+        return [piece for piece in pieces if piece.side() == side]
+
+    def pieces_of(self, player):
+        return self.player_pieces.get(player, ())
+
+    def moves_of(self, piece):
+        '''
+        Base moves of a piece, ignoring cool-downs.
+
+        Only this piece is brought up to date,
+        so a move elsewhere in the arena costs nothing here.
+        '''
+        if piece in self.dirty or piece not in self.entries:
+            self.misses += 1
+            self._refresh(piece)
+        else:
+            self.hits += 1
+        entry = self.entries.get(piece)
+        return () if entry is None else entry[3]
@@ -0,0 +1,180 @@
+'''
+Batch of bot-vs-bot games, for balancing the cool-downs.
+
+Each setting of the cool-downs in the sweep (all combinations of the
+values given) plays the same seeded games between bots (see bot.py and
+simulate.py), so settings are compared on the same games. The games are
+independent and shared between worker processes, each setting the
+cool-downs before its games, so a batch runs about as many times faster as
+there are cores. Each game's result (see columns, and the README for the
+file format) is written to a CSV file as soon as it and the games before it
+are done, so a batch can be followed or cut short. Then the win rates and
+the distribution of game lengths of each setting are summarized, which
+python batch.py --summarize PATH repeats for a file.
+
+Usage: python batch.py [--piece-freeze TICKS,...] [--king-freeze TICKS,...]
+                       [--egg-time TICKS,...] [--player-freeze TICKS,...]
+                       [--games N] [--seed S] [--strength STRENGTH]
+                       [--max-ticks T] [--jobs N] [--output PATH]
+       python batch.py --summarize PATH
+'''
+
+import argparse
+import concurrent.futures
+import csv
+import functools
+import itertools
+import os
+import sys
+import time
+
+import chess
+from bot import Bot
+from game_model import GameModel
+from simulate import Simulation
+
+# Cool-down name -> the class attribute it sets
+cooldowns = {
+    'piece_freeze': (chess.Piece, 'freeze_time'),
+    'king_freeze': (chess.King, 'freeze_time'),
+    'egg_time': (chess.Pawn, 'egg_time'),
+    'player_freeze': (GameModel, 'player_freeze_time'),
+    }
+sides = ['white', 'black']
+columns = list(cooldowns) + ['seed', 'winner', 'ticks', 'white_captures', 'black_captures']
+
+def pieces_per_side(game):
+    # The attack map rather than the board, as a capturing piece is off the board while it captures
+    remaining = [0, 0]
+    for player in range(game.num_players):
+        remaining[player % 2] += len(game.attack_map.pieces_of(player))
+    return remaining
+
+def king_captured(game, ended, who):
+    if not ended:
+        # Counting the tick of the capture, which is being executed
+        ended.append((who, game.counter + 1, pieces_per_side(game)))
+
+def play(job):
+    'Play a game with the given cool-downs, returning its row of results'
+    setting, seed, strength, max_ticks = job
+    previous = {name: getattr(*cooldowns[name]) for name in setting}
+    for name, value in setting.items():
+        setattr(*cooldowns[name], value)
+    try:
+        simulation = Simulation(2, seed, bots=strength)
+        # (loser, ticks played, pieces remaining per side) when a king is captured
+        ended = []
+        for net_engine in simulation.engines:
+            # The first player to execute the capture ends the game, without a replay.
+            # The others may still be ticks behind, so the result is taken from its game.
+            net_engine.game.king_captured = functools.partial(king_captured, net_engine.game, ended)
+        simulation.run(max_ticks, until=lambda: ended)
+        if ended:
+            loser, ticks, remaining = ended[0]
+            winner = sides[1 - loser % 2]
+        else:
+            game = simulation.engines[0].game
+            ticks, remaining = game.counter, pieces_per_side(game)
+            winner = ''
+        # Promotions replace pawns, so the pieces missing from a side are the ones captured
+        return dict(
+            setting, seed=seed, winner=winner,
+            ticks=ticks, white_captures=16 - remaining[1], black_captures=16 - remaining[0])
+    finally:
+        for name, value in previous.items():
+            setattr(*cooldowns[name], value)
+
+def sweep(values, games, seed=0, strength=2, max_ticks=9000, jobs=None):
+    '''
+    Results of the games of all settings, in order, as they are played.
+
+    values maps cool-down names to the values they take.
+    jobs is the number of worker processes (all cores by default, 1 to play in this process).
+    '''
+    names = list(values)
+    settings = [dict(zip(names, x)) for x in itertools.product(*values.values())]
+    work = [(setting, seed + i, strength, max_ticks) for setting in settings for i in range(games)]
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1:
+        yield from map(play, work)
+        return
+    # Sending the games in chunks keeps the workers busy without a round trip per game,
+    # and leaves enough chunks for them to finish together
+    chunksize = max(1, len(work) // (jobs * 8))
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        yield from executor.map(play, work, chunksize=chunksize)
+
+def summarize(rows):
+    'Win rates and game lengths of each setting, from rows of results'
+    results = {}
+    for row in rows:
+        key = tuple((name, int(row[name])) for name in cooldowns if row.get(name, '') != '')
+        results.setdefault(key, []).append(row)
+    summary = []
+    for key, rows in results.items():
+        lengths = sorted(int(row['ticks']) for row in rows if row['winner'])
+        def percentile(p):
+            return lengths[min(len(lengths) - 1, len(lengths) * p // 100)] if lengths else None
+        summary.append(dict(
+            key, games=len(rows),
+            white_wins=sum(row['winner'] == 'white' for row in rows) / len(rows),
+            black_wins=sum(row['winner'] == 'black' for row in rows) / len(rows),
+            unfinished=sum(not row['winner'] for row in rows) / len(rows),
+            mean_ticks=sum(lengths) / len(lengths) if lengths else None,
+            p10_ticks=percentile(10), median_ticks=percentile(50), p90_ticks=percentile(90),
+            captures=sum(int(row['white_captures']) + int(row['black_captures']) for row in rows) / len(rows)))
+    return summary
+
+def print_summary(summary):
+    def fmt(value):
+        return '-' if value is None else '%.0f' % value
+    for result in summary:
+        print('%s: %d games, white %.0f%%, black %.0f%%, unfinished %.0f%%, '
+              'ticks mean %s (p10 %s, median %s, p90 %s), %.1f captures' % (
+            ' '.join('%s=%d' % (name, result[name]) for name in cooldowns if name in result),
+            result['games'], result['white_wins'] * 100, result['black_wins'] * 100,
+            result['unfinished'] * 100, fmt(result['mean_ticks']), fmt(result['p10_ticks']),
+            fmt(result['median_ticks']), fmt(result['p90_ticks']), result['captures']))
+
+def read_results(path):
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+def values_arg(text):
+    return [int(x) for x in text.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch of bot-vs-bot Chess Chase games, sweeping the cool-downs')
+    for name, (cls, attr) in cooldowns.items():
+        parser.add_argument('--' + name.replace('_', '-'), type=values_arg, default=[getattr(cls, attr)],
+                            help='comma separated values of %s.%s in ticks' % (cls.__name__, attr))
+    parser.add_argument('--games', type=int, default=100, help='games per setting')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first game of each setting')
+    parser.add_argument('--strength', type=int, default=2, choices=sorted(Bot.strengths))
+    parser.add_argument('--max-ticks', type=int, default=9000, help='games still going are unfinished')
+    parser.add_argument('--jobs', type=int, help='worker processes (default: one per core)')
+    parser.add_argument('--output', default='batch.csv')
+    parser.add_argument('--summarize', metavar='PATH', help='only summarize the results in a file')
+    args = parser.parse_args()
+    if args.summarize:
+        print_summary(summarize(read_results(args.summarize)))
+        return
+    values = {name: getattr(args, name) for name in cooldowns}
+    total = args.games
+    for x in values.values():
+        total *= len(x)
+    start = time.perf_counter()
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        for i, row in enumerate(sweep(values, args.games, args.seed, args.strength, args.max_ticks, args.jobs)):
+            writer.writerow(row)
+            f.flush()
+            print('\r%d/%d games' % (i + 1, total), end='', file=sys.stderr)
+    elapsed = time.perf_counter() - start
+    print('\r%d games in %.1f s: %.1f games/s' % (total, elapsed, total / elapsed), file=sys.stderr)
+    print_summary(summarize(read_results(args.output)))
+
+if __name__ == '__main__':
+    main()
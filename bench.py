@@ -0,0 +1,490 @@
+'''
+Benchmarks for the game engine.
+
+Usage: python bench.py [benchmark ...]
+'''
+
+import marshal
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+import urllib.request
+
+import wire
+from bot import Bot, worker_think
+from game_model import GameModel
+from match_server import MatchServer
+from matchmaking import MatchClient
+from net_engine import NetEngine
+from simulate import Simulation
+from tick_buffer import TickBuffer
+
+def measure_memory(func):
+    'Bytes allocated (and still held) by calling func, and its result'
+    tracemalloc.start()
+    result = func()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, result
+
+def new_game(num_boards):
+    game = GameModel()
+    game.init(num_boards=num_boards)
+    return game
+
+def bench_memory():
+    'Memory per game and the cost of copying its state'
+    for num_boards in [1, 2]:
+        # Move tables are shared between games, build them beforehand
+        new_game(num_boards)
+        game_size, game = measure_memory(lambda: new_game(num_boards))
+        maps_size, _ = measure_memory(game.attack_map.flush)
+        snapshot_size, snapshot = measure_memory(game.snapshot)
+        number = 1000
+        snapshot_time = timeit.timeit(game.snapshot, number=number) / number
+        restore_time = timeit.timeit(lambda: game.restore(snapshot), number=number) / number
+        hash_time = timeit.timeit(game.state_hash, number=number) / number
+        print(
+            '%d board(s): game %.1f KiB (+%.1f KiB attack map), snapshot %.1f KiB, '
+            'snapshot %.0f us, restore %.0f us, state hash %.1f us' % (
+                num_boards, game_size / 1024, maps_size / 1024, snapshot_size / 1024,
+                snapshot_time * 1e6, restore_time * 1e6, hash_time * 1e6))
+
+def bench_startup():
+    'Start-up time and peak RSS of a process importing the headless engine'
+    code = 'import game_model, net_engine; game_model.GameModel().init()'
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], check=True)
+    elapsed = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    print('headless start-up %.0f ms, peak RSS %.1f MiB' % (elapsed * 1000, rss / 1024))
+
+def bench_wire():
+    '''
+    Size and cost of lockstep packets, compared to the previous marshal format.
+
+    The steady state is a tick window that was already sent/received in the
+    previous frame, which is what each frame mostly resends.
+    '''
+    rand = random.Random(0)
+    my_id = rand.randrange(2**64)
+    number = 10000
+    for name, ticks in [
+            ('idle window', [(i, []) for i in range(5000, 5010)]),
+            ('one move', [(i, [('move', ((3, 1), (3, 3)))] if i == 5007 else []) for i in range(5000, 5010)]),
+            ('busy', [(i, [('move', ((rand.randrange(16), rand.randrange(8)), (rand.randrange(16), rand.randrange(8))))])
+                for i in range(5000, 5010)]),
+            ]:
+        legacy = marshal.dumps((my_id, ticks))
+        packets = wire.encode(my_id, ticks)
+        encoder = wire.Encoder()
+        decoder = wire.Decoder()
+        decoder.decode(packets[0])
+        timings = [
+            timeit.timeit(func, number=number) / number * 1e6 for func in [
+                lambda: marshal.dumps((my_id, ticks)),
+                lambda: marshal.loads(legacy),
+                lambda: wire.encode(my_id, ticks),
+                lambda: wire.decode(packets[0]),
+                lambda: encoder.encode(my_id, ticks),
+                lambda: decoder.decode(packets[0]),
+                ]]
+        print(
+            '%s: marshal %d bytes (encode %.1f us, decode %.1f us), '
+            'wire %d bytes (cold encode %.1f us, decode %.1f us; steady encode %.1f us, decode %.1f us)' % (
+                name, len(legacy), timings[0], timings[1],
+                sum(map(len, packets)), *timings[2:]))
+
+def rss():
+    'Current resident set size in bytes (peak RSS where /proc is unavailable)'
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def bench_session():
+    '''
+    Memory held by the lockstep tick store over a long simulated session.
+
+    Two peers at 30 ticks per second, each moving every few seconds,
+    with a new game (so a new replay start) every 10 minutes.
+    '''
+    ticks_per_hour = 30 * 3600
+    game_length = 30 * 600
+    hours = 3
+    peers = [2**63 + 1, 2**63 + 2]
+    for name, store in [('TickBuffer', TickBuffer()), ('dict', {})]:
+        rand = random.Random(0)
+        start_rss = rss()
+        start = time.perf_counter()
+        sizes = []
+        for tick in range(hours * ticks_per_hour):
+            acts = store.setdefault(tick, {})
+            for peer in peers:
+                acts[peer] = [('move', ((rand.randrange(16), rand.randrange(8)), (rand.randrange(16), rand.randrange(8))))] \
+                    if rand.random() < 0.01 else []
+            if tick % game_length == 0 and isinstance(store, TickBuffer):
+                store.release(tick)
+            if (tick + 1) % ticks_per_hour == 0:
+                sizes.append('%.1f' % ((rss() - start_rss) / 2**20))
+        elapsed = time.perf_counter() - start
+        print('%s: RSS growth per simulated hour %s MiB (%.1f us per tick)' % (
+            name, ', '.join(sizes), elapsed / (hours * ticks_per_hour) * 1e6))
+        del store
+
+def bench_topology():
+    '''
+    Bytes each player sends and receives per frame, directly to every peer or through a relay.
+
+    Every frame sends the two newest ticks (what's left once the rest was acknowledged),
+    and each player moves once every 10 ticks.
+    '''
+    rand = random.Random(0)
+    for num_players in [2, 4, 8]:
+        ids = [rand.randrange(2**64) for _ in range(num_players)]
+        ticks = [
+            (tick, [
+                (peer_id, [('move', ((rand.randrange(16), rand.randrange(8)), (rand.randrange(16), rand.randrange(8))))]
+                    if rand.random() < 0.1 else [])
+                for peer_id in ids])
+            for tick in range(5000, 5002)]
+        clock = (3600000, 3599950, 10)
+        own = [(tick, acts[0][1]) for tick, acts in ticks]
+        packet = sum(map(len, wire.encode(ids[0], own, ack=5000, clock=clock)))
+        merged = sum(map(len, wire.MergedEncoder().encode(1, ids, ticks, ack=5000, clock=clock)))
+        print('%d players: direct %d bytes up / %d down, relay %d up / %d down' % (
+            num_players, packet * (num_players - 1), packet * (num_players - 1), packet, merged))
+
+def bench_matchmaking():
+    '''
+    Connection set-up against a local matchmaking server:
+    request latency with a fresh connection per request or a kept-alive one,
+    and how long after a guest joins its host learns about it.
+    '''
+    server = MatchServer(('127.0.0.1', 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%d' % server.server_address[1]
+    client = MatchClient(url)
+    address = client.register('10.0.0.1', 1000)
+    number = 200
+    fresh = timeit.timeit(
+        lambda: urllib.request.urlopen(url + client.url('lookup', address)).read(), number=number) / number
+    pooled = timeit.timeit(lambda: client.request(client.url('lookup', address)), number=number) / number
+    delays = []
+    for i in range(20):
+        host, guest = MatchClient(url), MatchClient(url)
+        host_address = host.register('10.0.1.%d' % i, 1000)
+        guest_address = guest.register('10.0.2.%d' % i, 1000)
+        done = []
+        lookup = threading.Thread(target=lambda: done.append((host.lookup(host_address), time.perf_counter())))
+        lookup.start()
+        time.sleep(0.05)
+        start = time.perf_counter()
+        guest.connect(guest_address, host_address)
+        lookup.join()
+        delays.append(done[0][1] - start)
+    server.shutdown()
+    print('request %.2f ms with a new connection, %.2f ms kept alive; host notified %.1f ms after join (was up to 5 s)' % (
+        fresh * 1000, pooled * 1000, sum(delays) / len(delays) * 1000))
+
+def bench_seek():
+    '''
+    Seeking in the replay of a 5 minute game with moves on a third of the ticks,
+    from keyframes or from the start of the game.
+    '''
+    rand = random.Random(0)
+    game = GameModel()
+    game.init()
+    game.mode = 'play'
+    game.add_message = lambda msg: None
+    net_engine = NetEngine(game)
+    while game.counter < 9000:
+        (src, piece) = rand.choice(sorted(game.board.items()))
+        opts = sorted(piece.moves())
+        if opts and rand.random() < 0.3:
+            game.add_action('move', src, rand.choice(opts))
+        net_engine.iteration()
+    net_engine.start_replay()
+    net_engine.iteration()
+    targets = [rand.randrange(9000) for _ in range(20)]
+    number = len(targets)
+    keyframes = dict(net_engine.keyframes)
+    with_keyframes = timeit.timeit(lambda: net_engine.seek(targets.pop()), number=number) / number
+    net_engine.keyframes.clear()
+    targets = [rand.randrange(9000) for _ in range(20)]
+    from_start = timeit.timeit(lambda: net_engine.seek(targets.pop()), number=number) / number
+    print('seek %.1f ms with %d keyframes, %.0f ms from the start of the game' % (
+        with_keyframes * 1000, len(keyframes), from_start * 1000))
+
+def perft_position(num_boards, seed, plies, script=(), board_engine=None):
+    '''
+    A corpus position: the moves of a script from the opening (removing the pieces
+    moved to None), then plies random moves, seeded.
+
+    Each ply advances the clock by a few ticks, so pieces and players are in
+    mixed cooldown states, and the position is evaluated at several ticks after it.
+    '''
+    rand = random.Random(seed)
+    game = GameModel(board_engine=board_engine)
+    game.init(num_boards=num_boards)
+    for src, dst in script:
+        game.counter += 100
+        if dst is None:
+            game.board[src].die()
+        else:
+            game.action_move(None, src, dst)
+    for _ in range(plies):
+        game.counter += rand.choice([1, 2, 5, 20])
+        movable = [(pos, piece) for pos, piece in sorted(game.board.items()) if piece.moves()]
+        if not movable:
+            continue
+        (src, piece) = rand.choice(movable)
+        game.action_move(None, src, rand.choice(sorted(piece.moves())))
+    return game
+
+# name -> (boards, seed, plies, script)
+perft_corpus = {
+    'opening': (1, 0, 0, ()),
+    'opening-2': (2, 0, 0, ()),
+    'early': (1, 1, 12, ()),
+    'midgame': (1, 2, 50, ()),
+    'midgame-2': (2, 3, 100, ()),
+    'crowded-2': (2, 4, 40, ()),
+    # Castling on both wings for both sides, and an en passant capture for white
+    'special': (1, 0, 0, [
+        (pos, None) for x in [1, 2, 3, 5, 6] for pos in [(x, 0), (x, 7)]] + [
+        ((4, 1), (4, 3)), ((4, 3), (4, 4)), ((3, 6), (3, 4))]),
+    }
+# Ticks after the last move at which positions are evaluated:
+# all cooling down, players ready but some pieces frozen, everything ready
+perft_delays = [0, 25, 100]
+# (name, delay) -> (moves, depth 2 nodes, sight squares), with either board engine
+perft_counts = {
+    ('opening', 0): (40, 800, 68),
+    ('opening', 25): (40, 800, 68),
+    ('opening', 100): (40, 800, 68),
+    ('opening-2', 0): (80, 4808, 140),
+    ('opening-2', 25): (80, 4808, 140),
+    ('opening-2', 100): (80, 4808, 140),
+    ('early', 0): (25, 0, 87),
+    ('early', 25): (53, 1394, 87),
+    ('early', 100): (59, 1727, 87),
+    ('midgame', 0): (0, 0, 88),
+    ('midgame', 25): (56, 1561, 88),
+    ('midgame', 100): (60, 1795, 88),
+    ('midgame-2', 0): (88, 5109, 204),
+    ('midgame-2', 25): (138, 14163, 204),
+    ('midgame-2', 100): (155, 17833, 204),
+    ('crowded-2', 0): (72, 3408, 197),
+    ('crowded-2', 25): (107, 8518, 197),
+    ('crowded-2', 100): (137, 13970, 197),
+    ('special', 0): (26, 0, 79),
+    ('special', 25): (49, 1200, 79),
+    ('special', 100): (50, 1249, 79),
+    }
+
+def perft(game, depth):
+    '''
+    Number of move sequences of the given length, with the pieces' cooldowns.
+
+    The variant is real-time, so any piece may move whenever it isn't cooling down,
+    rather than sides taking turns.
+    '''
+    moves = [(pos, dst) for pos, piece in sorted(game.board.items()) for dst in piece.moves()]
+    if depth <= 1:
+        return len(moves)
+    snapshot = game.snapshot()
+    nodes = 0
+    for src, dst in moves:
+        game.action_move(None, src, dst)
+        nodes += perft(game, depth - 1)
+        game.restore(snapshot)
+    return nodes
+
+def sight_squares(game):
+    return sum(1 for piece in game.board.values() for _ in piece.sight())
+
+def perft_games(board_engine=None):
+    'Corpus positions, with the delays at which they are evaluated'
+    for name, (num_boards, seed, plies, script) in perft_corpus.items():
+        game = perft_position(num_boards, seed, plies, script, board_engine)
+        start = game.counter
+        for delay in perft_delays:
+            game.counter = start + delay
+            yield (name, delay), game
+
+def perft_result(game):
+    return perft(game, 1), perft(game, 2), sight_squares(game)
+
+def board_info(game, player):
+    'The colored squares that BoardView.board_info computes every frame, without the mouse'
+    see = game.attack_map.visible(player % 2)
+    movesee = {}
+    for piece in game.attack_map.pieces_of(player):
+        movesee[piece.pos] = piece.sight_color
+        for dst in set(piece.moves()):
+            movesee[dst] = [a + b for a, b in zip(movesee.get(dst, (0, 0, 0)), piece.sight_color)]
+    cols = dict.fromkeys(see, (240, 240, 240))
+    for pos, col in movesee.items():
+        cols[pos] = [128+a*127./max(col) for a in col]
+    return cols
+
+def bench_perft():
+    '''
+    Move generation over a fixed corpus of positions, checked against the stored node counts.
+
+    Generator rates bypass the attack map's move cache. board_info is the per frame cost
+    of coloring the board for a player, with the moves cached or all recomputed.
+    '''
+    for board_engine in ['array', 'dict']:
+        for key, game in perft_games(board_engine):
+            result = perft_result(game)
+            if result != perft_counts.get(key):
+                print('%s %s: node counts %s differ from the stored %s' % (board_engine, key, result, perft_counts.get(key)))
+        number = 20
+        games = [game.snapshot() for _, game in perft_games(board_engine)]
+        positions = []
+        for snapshot in games:
+            game = GameModel(board_engine=board_engine)
+            game.restore(snapshot)
+            positions.append(game)
+        pieces = [piece for game in positions for piece in game.board.values()]
+        base_moves = sum(1 for piece in pieces for _ in piece.base_moves())
+        sight = sum(1 for piece in pieces for _ in piece.sight())
+        base_time = timeit.timeit(lambda: [list(piece.base_moves()) for piece in pieces], number=number) / number
+        sight_time = timeit.timeit(lambda: [list(piece.sight()) for piece in pieces], number=number) / number
+        perft_time = timeit.timeit(lambda: [perft(game, 2) for game in positions], number=1)
+        cached = []
+        fresh = []
+        for game in positions:
+            players = range(game.num_players)
+            def frame():
+                for player in players:
+                    board_info(game, player)
+            def fresh_frame():
+                for player in players:
+                    # All squares changed, so every piece's moves are recomputed
+                    game.attack_map.touch(*game.board)
+                    game.board_version += 1
+                    board_info(game, player)
+            cached.append(timeit.timeit(frame, number=number) / number / len(players))
+            fresh.append(timeit.timeit(fresh_frame, number=number) / number / len(players))
+        print('%s board: base moves %.2fM/s, sight squares %.2fM/s, perft(2) %.0fk nodes/s, '
+              'board_info %.0f us per frame (%.0f us recomputing all moves)' % (
+                  board_engine, base_moves / base_time / 1e6, sight / sight_time / 1e6,
+                  sum(perft_counts[key][1] for key in perft_counts) / perft_time / 1e3,
+                  sum(cached) / len(cached) * 1e6, sum(fresh) / len(fresh) * 1e6))
+
+def bench_metrics():
+    'Cost of collecting metrics per frame, in a 2 player simulation'
+    ticks = 3000
+    timings = []
+    for enabled in [False, True]:
+        best = None
+        for _ in range(3):
+            simulation = Simulation(2)
+            if enabled:
+                simulation.instrument()
+            start = time.perf_counter()
+            simulation.run(ticks)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings.append(best / ticks)
+    print('frame of 2 players %.1f us without metrics, %.1f us with them' % (timings[0] * 1e6, timings[1] * 1e6))
+
+def bench_actions():
+    '''
+    Cost of executing and decoding actions, apart from what they do:
+    moves from empty squares, which the game ignores.
+    '''
+    game = GameModel()
+    game.init()
+    game.mode = 'play'
+    game.add_message = lambda msg: None
+    net_engine = NetEngine(game)
+    net_engine.game.counter = NetEngine.start_latency + 1
+    tick = [(1, [('move', ((3, 4), (3, 5)))] * 100)]
+    number = 1000
+    execute = timeit.timeit(lambda: net_engine.execute(tick), number=number) / number / 100
+    body = bytes(wire.encode_actions(tick[0][1]))
+    decode = timeit.timeit(lambda: wire.decode_actions(body), number=number) / number / 100
+    print('per action: execute %.2f us, decode %.2f us' % (execute * 1e6, decode * 1e6))
+
+def bench_bot():
+    'Time a bot takes to decide, over the perft corpus, with its node budget only'
+    positions = [game for (_, delay), game in perft_games() if delay == 100]
+    for strength in sorted(Bot.strengths):
+        elapsed = 0
+        nodes = 0
+        for game in positions:
+            game.players = {game.my_id: 0}
+            bot = Bot(game, strength, worker=False, time_budget=None)
+            request = bot.observe(), 0
+            start = time.perf_counter()
+            bot.think(*request)
+            elapsed += time.perf_counter() - start
+            nodes += bot.searched
+        print('strength %d: %.0f ms per move, %.0f positions searched per move' % (
+            strength, elapsed / len(positions) * 1000, nodes / len(positions)))
+    # Frames of a game loop (coloring the board with all moves recomputed) while a bot searches
+    game = positions[0]
+    snapshot = Bot(game, worker=False).observe()
+    def frame_times(between=lambda: None):
+        times = []
+        for _ in range(300):
+            between()
+            start = time.perf_counter()
+            game.attack_map.touch(*game.board)
+            game.board_version += 1
+            board_info(game, 0)
+            times.append(time.perf_counter() - start)
+        return 'frame %.2f ms (max %.1f)' % (sum(times) / len(times) * 1000, max(times) * 1000)
+    alone = frame_times()
+    searcher = Bot(game, 5, worker=False, time_budget=None)
+    stop = threading.Event()
+    def search_go():
+        while not stop.is_set():
+            searcher.think(snapshot, 0)
+    thread = threading.Thread(target=search_go)
+    thread.start()
+    threaded = frame_times()
+    stop.set()
+    thread.join()
+    bot = Bot(game, 5, time_budget=None)
+    # Start the worker before measuring
+    searches = [bot.executor.submit(worker_think, snapshot, 0)]
+    searches[0].result()
+    def resubmit():
+        if searches[0].done():
+            searches[0] = bot.executor.submit(worker_think, snapshot, 0)
+    resubmit()
+    in_worker = frame_times(resubmit)
+    bot.stop()
+    print('%s alone, %s with a search thread, %s with a search process (%d cores)' % (
+        alone, threaded, in_worker, os.cpu_count()))
+
+benchmarks = {
+    'memory': bench_memory,
+    'startup': bench_startup,
+    'wire': bench_wire,
+    'session': bench_session,
+    'topology': bench_topology,
+    'matchmaking': bench_matchmaking,
+    'seek': bench_seek,
+    'perft': bench_perft,
+    'metrics': bench_metrics,
+    'actions': bench_actions,
+    'bot': bench_bot,
+    }
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or benchmarks:
+        print('# ' + name)
+        benchmarks[name]()
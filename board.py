@@ -0,0 +1,114 @@
+'''
+Flat-array board representation with precomputed move tables.
+
+Squares are indexed by ``x * height + y``. For every square the tables hold
+the rays a sliding piece walks and the squares a knight or king jumps to,
+so move generation becomes plain table walks without any bounds checks.
+'''
+
+import functools
+from collections.abc import MutableMapping
+
+rook_dirs = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+bishop_dirs = [(1, 1), (-1, -1), (1, -1), (-1, 1)]
+knight_jumps = [
+    (a*s, b*t) for a, b in [(1, 2), (2, 1)] for s in [-1, 1] for t in [-1, 1]]
+king_steps = [(a, b) for a in [-1, 0, 1] for b in [-1, 0, 1] if (a, b) != (0, 0)]
+
+class MoveTables:
+    'Per-square rays and jumps for a given board size'
+
+    def __init__(self, size):
+        self.size = size
+        width, height = size
+        self.positions = [(x, y) for x in range(width) for y in range(height)]
+        self.index = {pos: i for i, pos in enumerate(self.positions)}
+
+        def ray(pos, d, limit=None):
+            r = []
+            (x, y), (dx, dy) = pos, d
+            while len(r) != limit:
+                x += dx
+                y += dy
+                if not (0 <= x < width and 0 <= y < height):
+                    break
+                r.append(x * height + y)
+            return tuple(r)
+
+        def rays(dirs, limit=None):
+            return [
+                tuple(r for r in (ray(pos, d, limit) for d in dirs) if r)
+                for pos in self.positions]
+
+        self.rook = rays(rook_dirs)
+        self.bishop = rays(bishop_dirs)
+        self.queen = [a + b for a, b in zip(self.rook, self.bishop)]
+        self.knight = rays(knight_jumps, 1)
+        self.king = rays(king_steps, 1)
+
+def move_tables(size):
+    'Tables are built once per board size and shared between games'
+    return _move_tables(tuple(size))
+
+@functools.lru_cache(maxsize=None)
+def _move_tables(size):
+    return MoveTables(size)
+
+class ArrayBoard(MutableMapping):
+    '''
+    Board stored as a flat list of squares.
+
+    Behaves like the ``{(x, y): piece}`` dict it replaces,
+    while move generation can walk ``squares`` directly by index.
+    '''
+
+    def __init__(self, size):
+        self.tables = move_tables(size)
+        self.squares = [None] * len(self.tables.positions)
+        self.num_pieces = 0
+
+    def __getitem__(self, pos):
+        piece = self.get(pos)
+        if piece is None:
+            raise KeyError(pos)
+        return piece
+
+    def get(self, pos, default=None):
+        i = self.tables.index.get(pos)
+        if i is None:
+            return default
+        piece = self.squares[i]
+        return default if piece is None else piece
+
+    def __contains__(self, pos):
+        return self.get(pos) is not None
+
+    def __setitem__(self, pos, piece):
+        i = self.tables.index[pos]
+        if self.squares[i] is None:
+            self.num_pieces += 1
+        self.squares[i] = piece
+
+    def __delitem__(self, pos):
+        i = self.tables.index.get(pos)
+        if i is None or self.squares[i] is None:
+            raise KeyError(pos)
+        self.squares[i] = None
+        self.num_pieces -= 1
+
+    def __iter__(self):
+        for pos, piece in zip(self.tables.positions, self.squares):
+            if piece is not None:
+                yield pos
+
+    def items(self):
+        return [
+            (pos, piece)
+            for pos, piece in zip(self.tables.positions, self.squares)
+            if piece is not None]
+
+    def values(self):
+        return [piece for piece in self.squares if piece is not None]
+
+    def __len__(self):
+        return self.num_pieces
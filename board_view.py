@@ -1,7 +1,7 @@
-import itertools
 import operator
 import random
 
+from kivy.core.text import Label as CoreLabel
 from kivy.core.window import Window
 from kivy.graphics import Color, Rectangle
 from kivy.uix.widget import Widget
@@ -15,6 +15,8 @@ class BoardView(Widget):
         Window.bind(mouse_pos=self.mouse_motion)
         self.bind(size=self.resized)
         self.mouse_pos = None
+        # Text drawn over the board, such as metrics
+        self.overlay_texture = None
         self.reset()
 
     def resized(self, *args):
@@ -80,6 +82,24 @@ class BoardView(Widget):
                     pos=(x-self.square_size//2, y-self.square_size//2),
                     size=sq)
 
+            if self.overlay_texture is not None:
+                size = self.overlay_texture.size
+                pos = (self.x, self.top - size[1])
+                Color(0, 0, 0, .6)
+                Rectangle(pos=pos, size=size)
+                Color(1, 1, 1)
+                Rectangle(texture=self.overlay_texture, pos=pos, size=size)
+
+    def set_overlay(self, lines):
+        'Lines of text to draw over the top left of the board'
+        if not lines:
+            self.overlay_texture = None
+            return
+        # Rendered once here rather than on every frame
+        label = CoreLabel(text='\n'.join(lines), font_size=12)
+        label.refresh()
+        self.overlay_texture = label.texture
+
     def board_info(self):
         player = None if self.game.mode == 'replay' else self.game.player()
         flash = {}
@@ -90,21 +110,18 @@ class BoardView(Widget):
                     flash[pos] = flashy.sight_color
 
         movesee = {}
-        see = set()
-        for piece in self.game.board.values():
-            if player is not None and piece.side() != player%2:
-                continue
-            see.add(piece.pos)
-            if piece.player == player:
-                moves = set(piece.moves())
-                if self.mouse_pos in moves and not self.is_dragging and piece == self.selected:
-                    flash[piece.pos] = piece.sight_color
-                else:
-                    movesee[piece.pos] = piece.sight_color
-            for dst in itertools.chain(piece.sight()):
-                see.add(dst)
-                if piece.player == player and dst in moves:
-                    movesee[dst] = list(map(operator.add, movesee.get(dst, [0]*3), piece.sight_color))
+        if player is None:
+            see = self.game.attack_map.visible(0) | self.game.attack_map.visible(1)
+        else:
+            see = self.game.attack_map.visible(player%2)
+        for piece in self.game.attack_map.pieces_of(player):
+            moves = set(piece.moves())
+            if self.mouse_pos in moves and not self.is_dragging and piece == self.selected:
+                flash[piece.pos] = piece.sight_color
+            else:
+                movesee[piece.pos] = piece.sight_color
+            for dst in moves:
+                movesee[dst] = list(map(operator.add, movesee.get(dst, [0]*3), piece.sight_color))
 
         cols = {}
         for pos in see:
@@ -177,10 +194,10 @@ class BoardView(Widget):
             return
         self.is_dragging = False
         self.potential_pieces = []
-        for piece in self.game.board.values():
+        for piece in self.game.attack_map.attackers_of(self.mouse_pos):
             if piece.player == self.game.player() and self.mouse_pos in piece.moves():
                 self.potential_pieces.append(piece)
-        self.potential_pieces.sort(key = lambda x: x.move_preference)
+        self.potential_pieces.sort(key = lambda x: (x.move_preference, x.pos))
         if [] == self.potential_pieces:
             self.selected = None
         else:
@@ -0,0 +1,246 @@
+'''
+Headless bot player, for playing solo and load-testing games.
+
+A bot plays through GameModel.add_action('move', ...) like BoardView does.
+It only knows what its side sees: it searches a copy of the game holding its
+side's pieces and the enemy pieces in sight, so fog of war applies to it as
+to players. Moves are those Piece.moves allows, so it keeps the cool-downs.
+
+The search is a negamax with alpha-beta pruning and a transposition table,
+deepened until its time or node budget runs out. As there are no turns, the
+sides are assumed to alternate, the clock advancing by a player's cool-down
+on each ply. It runs in a worker process, which is handed the snapshot the bot
+sees, so the search neither stalls the game loop nor competes with it for the
+GIL. The worker only imports the rules engine, not Kivy (see main.py). Or it runs synchronously with only a node budget, so that seeded games are
+reproduced exactly (see simulate.py).
+'''
+
+import concurrent.futures
+import math
+import multiprocessing
+import random
+import time
+
+from game_model import GameModel
+
+# Value of a piece by its kind (see chess.Piece.kind): rook, knight, bishop, queen, king and pawn
+piece_values = [5, 3, 3, 9, 1000, 1]
+
+class OutOfBudget(Exception):
+    pass
+
+class Bot:
+    # Strength -> (deepest search in plies, most positions searched per move,
+    # random bonus of up to this many pawns added to the moves' scores)
+    strengths = {
+        1: (1, 100, 3),
+        2: (1, 500, 1),
+        3: (2, 2000, 0.3),
+        4: (3, 8000, 0.1),
+        5: (4, 30000, 0),
+        }
+    # Value of each square in sight after our move, so that the bot explores
+    sight_value = 0.02
+    # Ticks to wait for a queued move to be executed before deciding again
+    move_timeout = 60
+    # Positions kept in the transposition table
+    table_size = 100000
+
+    def __init__(self, game, strength=3, seed=0, worker=True, time_budget=1/30):
+        self.game = game
+        self.depth, self.max_nodes, self.noise = self.strengths[strength]
+        self.random = random.Random(seed)
+        # Seconds a search may take (None for no limit, as in reproducible games)
+        self.time_budget = time_budget
+        # The bot's copy of the game, which only the search touches
+        self.model = GameModel(board_engine='array')
+        self.model.add_message = lambda msg: None
+        # (board hash, tick, whether we are to move) -> (depth, score, bound, best move)
+        self.table = {}
+        self.nodes = 0
+        self.searched = 0
+        self.queued_at = None
+        # Future of the move being thought of
+        self.thinking = None
+        # The worker process searching, with a bot of its own (see start_worker)
+        self.executor = None
+        if worker:
+            # Spawned rather than forked, as the game has threads and a GL context
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context('spawn'),
+                initializer=start_worker, initargs=(strength, seed, time_budget))
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def update(self):
+        'Called by the game loop on every tick: queues the move found, and starts thinking when due'
+        if self.thinking is not None:
+            if not self.thinking.done():
+                return
+            self.play(self.thinking.result())
+            self.thinking = None
+        if not self.ready():
+            return
+        request = self.observe(), self.game.player()
+        if self.executor is not None:
+            self.thinking = self.executor.submit(worker_think, *request)
+        else:
+            # Played on the next tick, like a move found by the worker
+            self.thinking = concurrent.futures.Future()
+            self.thinking.set_result(self.think(*request))
+
+    def ready(self):
+        'Can we move, and was our previous move executed'
+        game = self.game
+        player = game.player()
+        if game.mode != 'play' or player is None:
+            return False
+        last_move = game.player_last_move.get(player)
+        if self.queued_at is not None and (last_move is None or last_move < self.queued_at) and \
+                game.counter - self.queued_at < self.move_timeout:
+            return False
+        return last_move is None or game.counter >= last_move + game.player_freeze_time
+
+    def observe(self):
+        'Snapshot of the game as our side sees it'
+        game = self.game
+        side = game.player() % 2
+        visible = game.attack_map.visible(side)
+        num_boards, board_size, counter, player_last_move, pieces = game.snapshot()
+        pieces = tuple(x for x in pieces if x[1] % 2 == side or x[2] in visible)
+        return num_boards, board_size, counter, player_last_move, pieces
+
+    def play(self, move):
+        if move is None:
+            return
+        src, dst = move
+        piece = self.game.board.get(src)
+        # The game went on while we were thinking
+        if piece is None or piece.player != self.game.player() or dst not in piece.moves():
+            return
+        self.game.add_action('move', src, dst)
+        self.queued_at = self.game.counter
+
+    def think(self, snapshot, player):
+        'Best move found within the budget, or None'
+        model = self.model
+        model.restore(snapshot)
+        self.player = player
+        self.side = player % 2
+        self.enemies = {x[1] for x in snapshot[4] if x[1] % 2 != self.side}
+        self.ply_ticks = model.player_freeze_time + 1
+        deadline = None if self.time_budget is None else time.perf_counter() + self.time_budget
+        self.nodes = 0
+        if len(self.table) > self.table_size:
+            self.table.clear()
+        noise = {}
+        best = None
+        for depth in range(1, self.depth + 1):
+            # The first search always finishes, for there to be a move
+            self.limited = best is not None
+            self.deadline = deadline
+            try:
+                scores = self.root(model, depth)
+            except OutOfBudget:
+                model.restore(snapshot)
+                break
+            if not scores:
+                break
+            for move in scores:
+                if move not in noise:
+                    noise[move] = self.random.uniform(0, self.noise) if self.noise else 0
+            best = max(sorted(scores), key=lambda move: scores[move] + noise[move])
+        self.searched += self.nodes
+        return best
+
+    def root(self, model, depth):
+        'Scores of our moves, searched to a depth'
+        snapshot = model.snapshot()
+        scores = {}
+        for _, move in self.moves(model, True):
+            model.action_move(None, *move)
+            # Restoring rebuilds the attack map, so what we see is only counted here rather than in evaluate
+            sight = self.sight_value * len(model.attack_map.visible(self.side))
+            model.counter += self.ply_ticks
+            scores[move] = sight - self.negamax(model, depth - 1, -math.inf, math.inf, False)
+            model.restore(snapshot)
+        return scores
+
+    def negamax(self, model, depth, alpha, beta, us):
+        'Score of a position for the side to move'
+        self.nodes += 1
+        if self.limited and (self.nodes >= self.max_nodes or self.deadline is not None and
+                             self.nodes % 64 == 0 and time.perf_counter() > self.deadline):
+            raise OutOfBudget()
+        score = self.evaluate(model) if us else -self.evaluate(model)
+        if depth == 0:
+            return score
+        if depth == 1:
+            # The last ply only matters for what it captures, scored without making the moves
+            return score + max([gain for gain, _ in self.moves(model, us)], default=0)
+        key = model.board_hash, model.counter, us
+        entry = self.table.get(key)
+        hint = None
+        if entry is not None:
+            entry_depth, score, bound, hint = entry
+            if entry_depth >= depth and (bound == 0 or bound < 0 and score <= alpha or bound > 0 and score >= beta):
+                return score
+        moves = [move for _, move in self.moves(model, us)]
+        if hint in moves:
+            moves.remove(hint)
+            moves.insert(0, hint)
+        snapshot = model.snapshot()
+        original_alpha = alpha
+        best_score = -math.inf
+        best_move = None
+        # With nothing to move, the side waits
+        for move in moves or [None]:
+            if move is not None:
+                model.action_move(None, *move)
+            model.counter += self.ply_ticks
+            score = -self.negamax(model, depth - 1, -beta, -alpha, not us)
+            model.restore(snapshot)
+            if score > best_score:
+                best_score, best_move = score, move
+            alpha = max(alpha, score)
+            if alpha >= beta:
+                break
+        bound = -1 if best_score <= original_alpha else 1 if best_score >= beta else 0
+        self.table[key] = depth, best_score, bound, best_move
+        return best_score
+
+    def moves(self, model, us):
+        '''
+        (value captured, move) of the moves of our player or of the enemies,
+        captures of the most valuable pieces first
+        '''
+        players = [self.player] if us else sorted(self.enemies)
+        board = model.board
+        moves = []
+        for player in players:
+            for piece in sorted(model.attack_map.pieces_of(player), key=lambda piece: piece.pos):
+                for dst in piece.moves():
+                    target = board.get(dst)
+                    moves.append((0 if target is None else piece_values[target.kind], (piece.pos, dst)))
+        moves.sort(key=lambda x: -x[0])
+        return moves
+
+    def evaluate(self, model):
+        'Material balance for us'
+        score = 0
+        for piece in model.board.values():
+            value = piece_values[piece.kind]
+            score += value if piece.side() == self.side else -value
+        return score
+
+# The bot of a worker process
+worker_bot = None
+
+def start_worker(strength, seed, time_budget):
+    global worker_bot
+    worker_bot = Bot(None, strength, seed, worker=False, time_budget=time_budget)
+
+def worker_think(snapshot, player):
+    return worker_bot.think(snapshot, player)
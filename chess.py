@@ -1,33 +1,68 @@
 import itertools
 from itertools import count
 
-from kivy.uix.image import Image
-
 import env
 
+mask = 2**64 - 1
+
+def zobrist_key(*values):
+    '''
+    64-bit key of a tuple of integers.
+
+    The same in every process and Python version, unlike ``hash()``,
+    so peers can compare hashes made of such keys.
+    '''
+    h = 0x9e3779b97f4a7c15
+    for value in values:
+        h = (h ^ value) * 0xbf58476d1ce4e5b9 & mask
+        h ^= h >> 31
+    return h
+
 class Piece:
+    __slots__ = ['player', 'pos', 'freeze_until', 'game', 'last_move_time', 'last_pos', 'prev_pos', 'hashed']
+    table = None
     freeze_time = 0 if env.dev_mode else 80
-    last_move_time = None
+    _images = None
 
-    last_pos = None
-
-    def __init__(self, player, pos, game):
+    def __init__(self, player, pos, game, freeze_until=0, last_move_time=None, last_pos=None):
         self.player = player
         self.pos = pos
-        self.freeze_until = 0
+        self.freeze_until = freeze_until
+        self.last_move_time = last_move_time
+        self.last_pos = last_pos
         self.game = game
         game.board[pos] = self
+        game.board_version += 1
+        game.attack_map.add(self)
+        self.hashed = self.zobrist()
+        game.board_hash ^= self.hashed
 
     def image(self):
         'Get image for piece'
+        if self._images is None:
+            load_images()
         return self._images[self.player]
 
     def side(self):
         return self.player % 2
 
+    def state(self):
+        'Compact record of the piece, see GameModel.snapshot'
+        return (type(self), self.player, self.pos, self.freeze_until, self.last_move_time, self.last_pos)
+
+    def zobrist(self):
+        'Key of the piece in GameModel.board_hash'
+        x, y = self.pos
+        moved = 0 if self.last_move_time is None else self.last_move_time + 1
+        return zobrist_key((self.player << 3 | self.kind) << 16 | x << 8 | y, self.freeze_until << 32 | moved)
+
     def die(self):
         if self.game.board[self.pos] == self:
             del self.game.board[self.pos]
+        self.game.board_version += 1
+        self.game.move_cache.pop(self, None)
+        self.game.attack_map.remove(self)
+        self.game.board_hash ^= self.hashed
         self.on_die()
 
     def on_die(self):
@@ -52,21 +87,62 @@ class Piece:
             self.game.board[pos].die()
         self.game.board[self.pos] = self
         self.freeze_until = self.game.counter+self.freeze_time
-        self.game.player_last_move[self.player] = self.game.counter
+        self.game.set_last_move(self.player, self.game.counter)
+        self.game.board_version += 1
+        self.game.attack_map.moved(self, self.last_pos)
+        self.game.rehash(self)
 
-    def moves(self):
+    def cooling_down(self):
         freeze_time = self.game.player_freeze_time
-        if self.game.counter < max(
-                self.freeze_until,
-                self.game.player_last_move.get(self.player, -freeze_time) + freeze_time):
-            return
-        yield from self.base_moves()
+        return self.game.counter < max(
+            self.freeze_until,
+            self.game.player_last_move.get(self.player, -freeze_time) + freeze_time)
+
+    def moves(self):
+        'Moves available right now (cached for the current tick and board)'
+        game = self.game
+        key = (game.counter, game.board_version)
+        entry = game.move_cache.get(self)
+        if entry is not None and entry[0] == key:
+            game.move_cache.hits += 1
+            return entry[1]
+        game.move_cache.misses += 1
+        moves = self._legal_moves()
+        game.move_cache[self] = (key, moves)
+        return moves
+
+    def _legal_moves(self):
+        'Moves when not cooling down (base moves are kept up to date in the attack map)'
+        if self.cooling_down():
+            return ()
+        return self.game.attack_map.moves_of(self)
 
     def sight(self):
         'What squares can this piece see (overridden for Pawn)'
         yield from self.base_moves()
 
     def base_moves(self):
+        if self.table is None or self.game.tables is None:
+            return self._streak_moves()
+        return self._table_moves()
+
+    def _table_moves(self):
+        'Walk the precomputed rays of an array board'
+        tables = self.game.tables
+        squares = self.game.board.squares
+        positions = tables.positions
+        side = self.side()
+        for ray in getattr(tables, self.table)[tables.index[self.pos]]:
+            for i in ray:
+                piece = squares[i]
+                if piece is None:
+                    yield positions[i]
+                    continue
+                if piece.side() != side:
+                    yield positions[i]
+                break
+
+    def _streak_moves(self):
         for streak in self._moves(*self.pos):
             for dst in streak:
                 if dst in self.game.board and self.game.board[dst].side() == self.side():
@@ -79,7 +155,9 @@ class Piece:
                     break
 
 class Rook(Piece):
+    __slots__ = ()
     sight_color = (0.5, 0.5, 1)
+    table = 'rook'
     @staticmethod
     def _moves(x, y):
         yield ((x+d, y) for d in count(1))
@@ -88,7 +166,9 @@ class Rook(Piece):
         yield ((x, y-d) for d in count(1))
 
 class Bishop(Piece):
+    __slots__ = ()
     sight_color = (0, 0, 1)
+    table = 'bishop'
     @staticmethod
     def _moves(x, y):
         yield ((x+d, y+d) for d in count(1))
@@ -97,13 +177,17 @@ class Bishop(Piece):
         yield ((x-d, y+d) for d in count(1))
 
 class Queen(Rook, Bishop):
+    __slots__ = ()
     sight_color = (1, 0, 0)
+    table = 'queen'
     @staticmethod
     def _moves(x, y):
         return itertools.chain(Rook._moves(x, y), Bishop._moves(x, y))
 
 class Knight(Piece):
+    __slots__ = ()
     sight_color = (0, 1, 0)
+    table = 'knight'
     @staticmethod
     def _moves(x, y):
         for a in [-1, 1]:
@@ -112,18 +196,37 @@ class Knight(Piece):
                 yield [(x+b, y+a)]
 
 class King(Piece):
+    __slots__ = ()
     sight_color = (0, 1, 1)
+    table = 'king'
     freeze_time = 60
 
+    def on_die(self):
+        self.game.king_captured(self.player)
+
     def sight(self):
         yield from self.base_moves()
+        if self.game.tables is None:
+            # Reference implementation, walking out from the king
+            for pos in self._nearby_pieces():
+                if self.pos in self.game.board[pos].base_moves():
+                    yield pos
+            return
+        for piece in self.threats():
+            yield piece.pos
+
+    def threats(self):
+        'Enemy pieces attacking the king'
+        return self.game.attack_map.attackers_of(self.pos, 1 - self.side())
+
+    def _nearby_pieces(self):
+        'First piece on each knight jump and queen ray from the king'
         for streak in itertools.chain(Knight._moves(*self.pos), Queen._moves(*self.pos)):
             for pos in streak:
                 if not self.game.in_bounds(pos):
                     break
                 if pos in self.game.board:
-                    if self.pos in self.game.board[pos].base_moves():
-                        yield pos
+                    yield pos
                     break
 
     def move(self, pos):
@@ -141,6 +244,15 @@ class King(Piece):
         piece._move((sx + dir, sy))
         return True
 
+    def _table_moves(self):
+        yield from super(King, self)._table_moves()
+        if self.last_move_time is not None:
+            return
+        x, y = self.pos
+        for dir in [-1, 1]:
+            if self.castling(x, y, dir):
+                yield (x+dir*2, y)
+
     def _moves(self, x, y):
         for a in range(x-1, x+2):
             for b in range(y-1, y+2):
@@ -163,6 +275,7 @@ class King(Piece):
             dest += dir
 
 class Pawn(Piece):
+    __slots__ = ()
     sight_color = (0.5, 0.5, 0.5)
     egg_time = 0 if env.dev_mode else 60
 
@@ -175,8 +288,7 @@ class Pawn(Piece):
         if (self.side() == 0 and pos[1] == 7) or (self.side() == 1 and pos[1] == 0):
             # Become Queen
             self.die()
-            new_piece = Queen(self.player, pos, self.game)
-            new_piece.freeze_until = self.game.counter+self.egg_time
+            Queen(self.player, pos, self.game, self.game.counter+self.egg_time)
 
         x, y = pos
         if dst_piece is None and x != prev_x:
@@ -216,7 +328,7 @@ class Pawn(Piece):
 
         # En passant
         for piece in self.en_passant(x, y):
-            yield [(a, y+delta)]
+            yield [(piece.pos[0], y+delta)]
 
     def en_passant(self, x, y):
         for a in [x-1, x+1]:
@@ -235,11 +347,18 @@ class Pawn(Piece):
 
 first_row = [Rook, Knight, Bishop, Queen, King, Bishop, Knight, Rook]
 
-pieces_image = Image(source='chess.png').texture
-S = pieces_image.size[1]/2
+def load_images():
+    'Load the piece textures (only the UI needs them, and they require Kivy)'
+    from kivy.uix.image import Image
+
+    pieces_image = Image(source='chess.png').texture
+    S = pieces_image.size[1]/2
 
-for x, piece in enumerate([King, Queen, Bishop, Knight, Rook, Pawn]):
-    piece._images = [pieces_image.get_region(S*x, S*y, S, S) for y in range(2)][::-1]
+    for x, piece in enumerate([King, Queen, Bishop, Knight, Rook, Pawn]):
+        piece._images = [pieces_image.get_region(S*x, S*y, S, S) for y in range(2)][::-1]
 
 for preference, piece in enumerate([King, Pawn, Knight, Bishop, Rook, Queen]):
     piece.move_preference = preference
+
+for kind, piece in enumerate(first_row[:5] + [Pawn]):
+    piece.kind = kind
@@ -1,6 +1,29 @@
 import os
 
-from kivy.utils import platform
-
 dev_mode = os.environ.get('CHESSCHASE_DEV')
-is_mobile = platform in ['ios', 'android']
+# 'array' (flat board with move tables) or 'dict' (reference implementation)
+board_engine = os.environ.get('CHESSCHASE_BOARD', 'array')
+# Directory where played matches are logged (see replay_log.py)
+replay_dir = os.environ.get('CHESSCHASE_REPLAYS')
+# Matchmaking server (see matchmaking.py, and match_server.py for a local one)
+match_server = os.environ.get('CHESSCHASE_MATCH_SERVER', 'http://game-match.herokuapp.com')
+# host:port of a relay to play through (see relay.py)
+relay = os.environ.get('CHESSCHASE_RELAY')
+# host:port of a relay whose game to watch as a spectator
+spectate = os.environ.get('CHESSCHASE_SPECTATE')
+# Execute ticks ahead of late peers, rolling back when their actions arrive
+rollback = bool(os.environ.get('CHESSCHASE_ROLLBACK'))
+# Per tick metrics (see metrics.py): shown in the game, appended to a JSON-lines file,
+# and served on a local HTTP port
+metrics = bool(os.environ.get('CHESSCHASE_METRICS'))
+metrics_log = os.environ.get('CHESSCHASE_METRICS_LOG')
+metrics_port = os.environ.get('CHESSCHASE_METRICS_PORT')
+
+def __getattr__(name):
+    # Platform detection needs Kivy, so only the UI pays for importing it
+    if name == 'is_mobile':
+        from kivy.utils import platform
+        global is_mobile
+        is_mobile = platform in ['ios', 'android']
+        return is_mobile
+    raise AttributeError(name)
@@ -1,13 +1,27 @@
+import action_registry
 import chess
 import env
+from attack_map import AttackMap
+from board import ArrayBoard
+
+class MoveCache(dict):
+    'Legal moves per piece, keyed by tick and board version'
+
+    def __init__(self):
+        super().__init__()
+        self.hits = 0
+        self.misses = 0
 
 class GameModel:
     player_freeze_time = 0 if env.dev_mode else 20
 
-    def __init__(self):
+    def __init__(self, board_engine=None):
         self.mode = None
-        self.board = {}
+        self.board_engine = board_engine or env.board_engine
         self.board_size = [4, 4]
+        self.board_version = 0
+        self.move_cache = MoveCache()
+        self.new_board()
         self.num_boards = 1
         self.messages = []
         self.on_message = []
@@ -44,18 +58,80 @@ class GameModel:
         if num_boards is not None:
             self.num_boards = num_boards
         self.player_last_move = {}
-        self.board = {}
         self.board_size = [8*self.num_boards, 8]
+        self.new_board()
         self.num_players = self.num_boards * 2
-        for who, (x, y0, y1) in enumerate([(0, 0, 1), (0, 7, 6), (8, 0, 1), (8, 7, 6)][:self.num_players]):
+        for who in range(self.num_players):
+            # Each board hosts a white and a black player
+            x = 8 * (who // 2)
+            y0, y1 = [(0, 1), (7, 6)][who % 2]
             for dx, piece in enumerate(chess.first_row):
-                p = piece(who, (x+dx, y0), self)
-                if piece == chess.King:
-                    p.on_die = lambda who=who: self.king_captured(who)
+                piece(who, (x+dx, y0), self)
                 chess.Pawn(who, (x+dx, y1), self)
         for x in self.on_init:
             x()
 
+    def king_captured(self, who):
+        'Callback for when a player loses its king (set by the game UI)'
+        pass
+
+    def snapshot(self):
+        'Compact copy of the game state, which restore() brings back'
+        return (
+            self.num_boards, tuple(self.board_size), self.counter,
+            tuple(sorted(self.player_last_move.items())),
+            tuple(piece.state() for piece in self.board.values()))
+
+    def restore(self, state):
+        self.num_boards, board_size, self.counter, player_last_move, pieces = state
+        self.board_size = list(board_size)
+        self.num_players = self.num_boards * 2
+        self.player_last_move = {}
+        self.new_board()
+        for player, tick in player_last_move:
+            self.set_last_move(player, tick)
+        for piece_type, player, pos, freeze_until, last_move_time, last_pos in pieces:
+            piece_type(player, pos, self, freeze_until, last_move_time, last_pos)
+
+    def set_last_move(self, player, tick):
+        last = self.player_last_move.get(player)
+        if last is not None:
+            self.board_hash ^= chess.zobrist_key(-1, player, last)
+        self.player_last_move[player] = tick
+        self.board_hash ^= chess.zobrist_key(-1, player, tick)
+
+    def rehash(self, piece):
+        'Update board_hash after a piece changed'
+        self.board_hash ^= piece.hashed
+        piece.hashed = piece.zobrist()
+        self.board_hash ^= piece.hashed
+
+    def state_hash(self):
+        '''
+        Hash of the state that all peers should agree on.
+
+        Pieces and last moves are hashed incrementally as they change (board_hash),
+        so it is cheap enough to compute on every tick.
+        '''
+        h = chess.zobrist_key(self.board_hash, self.counter, self.num_boards)
+        for i, player in sorted(self.players.items()):
+            h = chess.zobrist_key(h, i, player)
+        return h
+
+    def new_board(self):
+        'Create an empty board of the selected engine'
+        # XOR of the zobrist keys of the pieces and the players' last moves
+        self.board_hash = 0
+        self.board_version += 1
+        self.move_cache.clear()
+        if self.board_engine == 'array':
+            self.board = ArrayBoard(self.board_size)
+            self.tables = self.board.tables
+        else:
+            self.board = {}
+            self.tables = None
+        self.attack_map = AttackMap(self)
+
     def in_bounds(self, pos):
         for x, s in zip(pos, self.board_size):
             if not (0 <= x < s):
@@ -63,7 +139,11 @@ class GameModel:
         return True
 
     def add_action(self, act_type, *params):
-        'Queue an action to be executed'
+        'Queue an action to be executed, unless it is malformed'
+        error = action_registry.check(act_type, params)
+        if error is not None:
+            self.add_message('%s: %s' % (act_type, error))
+            return
         self.cur_actions.append((act_type, params))
 
     def nick(self, i):
@@ -125,7 +205,8 @@ class GameModel:
 
     def help(self):
         self.add_message('')
-        self.add_message('commands: /help | /nick <name> | /surrender | /credits')
+        self.add_message('commands: /help | /nick <name> | /surrender | /credits | /net | /bot [strength]')
+        self.add_message('replays: /seek <seconds> | /speed <ticks per frame>')
         self.add_message('')
         latency = 5
         rate = 30
@@ -0,0 +1,297 @@
+'''
+The game's screen (board, messages and chat input) and the Kivy app showing it
+'''
+
+import os
+import random
+
+from kivy.app import App
+from kivy.clock import Clock, mainthread
+from kivy.uix.boxlayout import BoxLayout
+from kivy.uix.textinput import TextInput
+
+import env
+from board_view import BoardView
+from bot import Bot
+from game_model import GameModel
+from metrics import Metrics
+from net_engine import NetEngine
+from transport import LoopbackNetwork
+from widgets import WrappedLabel, WrappedButton
+
+num_msg_lines = 3 if env.is_mobile else 8
+
+class Game(BoxLayout):
+    game_title = 'Chess Chase: No turns, no sight!'
+
+    def __init__(self, **kwargs):
+        super(Game, self).__init__(**kwargs)
+        self.game_model = GameModel()
+        self.game_model.king_captured = self.king_captured
+        self.game_model.on_message.append(self.update_label)
+        self.net_engine = NetEngine(self.game_model)
+        # Opponent in practice games, and its engine
+        self.bot = None
+        self.bot_engine = None
+
+        self.score = [0, 0]
+
+        self.board_view = BoardView(self.game_model)
+        self.add_widget(self.board_view)
+
+        self.metrics = None
+        if env.metrics or env.metrics_log or env.metrics_port:
+            self.metrics = Metrics()
+            self.metrics.instrument(self.board_view, 'update_dst')
+            self.metrics.instrument(self.board_view, 'show_board')
+            self.instrument_net_engine()
+            if env.metrics_log:
+                self.metrics.log_to(env.metrics_log)
+            if env.metrics_port:
+                self.metrics.serve(int(env.metrics_port))
+
+        self.game_model.on_init.append(self.board_view.reset)
+        self.game_model.on_init.append(self.on_game_init)
+
+        self.info_pane = BoxLayout(orientation='vertical', size_hint_min_y=500)
+        self.add_widget(self.info_pane)
+
+        row_args = {'size_hint': (1, 0), 'size_hint_min_y': 70}
+
+        if not env.is_mobile:
+            self.info_pane.add_widget(WrappedLabel(halign='center', text=self.game_title, **row_args))
+
+        self.button_pane = BoxLayout(orientation='vertical', size_hint=(1, .4))
+        self.info_pane.add_widget(self.button_pane)
+
+        self.button_pane.add_widget(WrappedButton(
+            halign='center',
+            text='Tutorial: How to play',
+            on_press=self.start_tutorial))
+        self.button_pane.add_widget(WrappedButton(
+            halign='center',
+            text='Start Game' if env.is_mobile else 'Start Game: Play with friends',
+            on_press=self.start_game))
+
+        self.score_label = WrappedLabel(
+            halign='center',
+            **row_args)
+        self.info_pane.add_widget(self.score_label)
+
+        self.label = WrappedLabel(halign='center', valign='bottom')
+        self.info_pane.add_widget(self.label)
+
+        self.text_input = TextInput(
+            multiline=False,
+            text_validate_unfocus=env.is_mobile,
+            **row_args)
+        self.text_input.bind(on_text_validate=self.handle_text_input)
+        if env.is_mobile:
+            self.text_input.keyboard_mode = 'managed'
+            def on_focus(*args):
+                if self.text_input.focus:
+                    self.text_input.show_keyboard()
+        else:
+            def on_focus(*args):
+                if not self.text_input.focus:
+                    # Steal focus
+                    self.text_input.focus = True
+        self.text_input.bind(focus=on_focus)
+        self.info_pane.add_widget(self.text_input)
+
+        self.game_model.add_message('')
+        self.game_model.add_message(self.game_title if env.is_mobile else 'Welcome to Chess Chase!')
+
+        self.bind(size=self.resized)
+        Clock.schedule_interval(self.on_clock, 1/30)
+
+    @mainthread
+    def on_game_init(self):
+        if env.is_mobile and self.game_model.mode == 'play':
+            self.text_input.hide_keyboard()
+
+    def instrument_net_engine(self):
+        if self.metrics is None:
+            return
+        self.metrics.instrument(self.net_engine, 'communicate')
+        self.metrics.instrument(self.net_engine, 'act')
+        self.metrics.add_source('net', self.net_engine.stats)
+        self.net_engine.action_timings = {}
+        self.metrics.add_source('actions', self.net_engine.action_stats)
+
+    def stop_net_engine(self):
+        if self.bot is not None:
+            self.bot.stop()
+            self.bot_engine.stop()
+            self.bot = self.bot_engine = None
+        if not self.net_engine:
+            return
+        self.net_engine.stop()
+
+    def restart_net_engine(self):
+        self.stop_net_engine()
+        self.net_engine = NetEngine(
+            self.game_model,
+            replay_dir=env.replay_dir or os.path.join(App.get_running_app().user_data_dir, 'replays'))
+        self.instrument_net_engine()
+
+    def start_game(self, _):
+        self.text_input.focus = True
+        if env.is_mobile:
+            self.text_input.show_keyboard()
+        self.game_model.mode = 'connect'
+        self.score = [0, 0]
+        self.restart_net_engine()
+        self.game_model.messages.clear()
+        self.game_model.add_message('Establishing server connection...')
+        self.game_model.init()
+        self.net_engine.start()
+
+    def start_practice(self, strength):
+        'Play against a bot, whose engine runs in this process over a loopback network'
+        self.score = [0, 0]
+        self.restart_net_engine()
+        bot_game = GameModel()
+        bot_game.add_message = lambda msg: None
+        bot_game.mode = 'play'
+        bot_game.init()
+        self.bot_engine = NetEngine(bot_game)
+        def bot_king_captured(who):
+            if bot_game.mode != 'replay':
+                self.bot_engine.start_replay()
+        bot_game.king_captured = bot_king_captured
+        network = LoopbackNetwork()
+        for net_engine, addr, peer in [(self.net_engine, 'player', 'bot'), (self.bot_engine, 'bot', 'player')]:
+            net_engine.transport = network.transport(addr, net_engine.decoder.decode)
+            net_engine.peers = [peer]
+        self.bot = Bot(bot_game, strength, seed=random.randrange(2**32))
+        self.game_model.messages.clear()
+        self.game_model.add_message('Playing against a bot of strength %d' % strength)
+        self.game_model.reset()
+        self.game_model.mode = 'play'
+        self.game_model.init()
+
+    def start_tutorial(self, i):
+        if env.is_mobile:
+            self.text_input.hide_keyboard()
+        self.game_model.mode = 'tutorial'
+        self.game_model.reset()
+        self.restart_net_engine()
+        self.game_model.messages.clear()
+        self.game_model.add_message('Move the chess pieces and see what happens!')
+        self.game_model.tutorial_messages = [
+            'Keep moving the pieces at your own pace.',
+            'Each piece has its own color, and the board is painted to show where it can move.',
+            'You only see where your pieces can move',
+            'You will also see any piece that threatens the king.',
+            'Note that unlike classic chess, the king can move to a threatened position!',
+            'There are no turns!',
+            'There are cool-downs (rate limits) instead.',
+            'You win the game by capturing the opponent king',
+            'The game is played with friends over the internet.',
+            'To start a game both you and your friend need to click "Start Game".',
+            'Then either you or the friend should type the game identifier that the other was given.',
+            'This concludes our tutorial!',
+            ]
+        self.game_model.init()
+        self.game_model.players[self.game_model.my_id] = 0
+        self.net_engine.iter_actions.clear()
+
+    def update_label(self):
+        self.score_label.text = 'White: %d   Black: %d' % tuple(self.score)
+        self.label.text = '\n'.join(self.game_model.messages[-num_msg_lines:])
+
+    def resized(self, *args):
+        self.orientation = 'horizontal' if self.size[0] > self.size[1] else 'vertical'
+        p = 1/3
+        if self.orientation == 'horizontal':
+            self.info_pane.size_hint = (p, 1)
+            self.board_view.size_hint = (self.game_model.num_boards, 1)
+            self.button_pane.orientation = 'vertical'
+            self.button_pane.size_hint = (1, .4)
+            self.button_pane.size_hint_min_y = 140
+        else:
+            self.info_pane.size_hint = (1, p)
+            self.board_view.size_hint = (1, 1 / self.game_model.num_boards)
+            self.button_pane.orientation = 'horizontal'
+            self.button_pane.size_hint = (1, .4)
+            self.button_pane.size_hint_min_y = 70
+
+    def handle_text_input(self, entry):
+        if env.is_mobile:
+            self.text_input.hide_keyboard()
+        command = entry.text
+        entry.text = ''
+        if not command:
+            return
+        if command[:1] == '/':
+            if command == '/help':
+                self.game_model.help()
+                return
+            if command == '/net':
+                self.game_model.add_message(self.net_engine.status())
+                return
+            name, *args = command[1:].split() or ['']
+            if name == 'bot':
+                try:
+                    strength = int(args[0]) if args else 3
+                except ValueError:
+                    strength = None
+                if strength not in Bot.strengths:
+                    self.game_model.add_message('usage: /bot [strength %d-%d]' % (min(Bot.strengths), max(Bot.strengths)))
+                    return
+                self.start_practice(strength)
+                return
+            if name in ['seek', 'speed'] and self.game_model.mode == 'replay':
+                try:
+                    value = float(args[0])
+                except (IndexError, ValueError):
+                    self.game_model.add_message('usage: /seek <seconds> | /speed <ticks per frame>')
+                    return
+                if name == 'speed':
+                    self.net_engine.replay_speed = max(0, value)
+                else:
+                    # Seconds from the start of the replayed game
+                    self.net_engine.seek(self.game_model.last_start + int(value / self.net_engine.tick_duration))
+                return
+            self.game_model.add_action(*command[1:].split())
+            return
+        if self.game_model.mode in [None, 'connect']:
+            self.net_engine.connect(command)
+            return
+        # Chat
+        self.game_model.add_action('msg', command)
+
+    def king_captured(self, who):
+        if self.game_model.mode == 'replay':
+            return
+        winner = 1 - who%2
+        self.score[winner] += 1
+        self.game_model.add_message('')
+        self.game_model.add_message('%s King Captured!' % self.game_model.player_str(who))
+        self.game_model.add_message('%s wins!' % self.game_model.player_str(winner))
+        self.net_engine.start_replay()
+
+    def on_clock(self, _interval):
+        if self.bot is not None:
+            # The bot thinks in a worker process, this only hands it the game as it sees it
+            self.bot.update()
+            self.bot_engine.iteration()
+        self.net_engine.iteration()
+        self.board_view.update_dst()
+        self.board_view.show_board()
+        if self.metrics is not None:
+            self.metrics.end_tick()
+            if env.metrics and self.metrics.tick % self.metrics.report_interval == 0:
+                self.board_view.set_overlay(self.metrics.overlay())
+
+class ChessChaseApp(App):
+    def build(self):
+        self.game = Game()
+        if not env.is_mobile:
+            self.game.text_input.focus = True
+        return self.game
+    def stop(self):
+        self.game.stop_net_engine()
+        if self.game.metrics is not None:
+            self.game.metrics.close()
@@ -0,0 +1,103 @@
+'''
+Local matchmaking server, implementing the protocol described in matchmaking.py.
+
+For playing on a LAN, and measuring and testing connection set-up offline.
+
+Usage: python match_server.py [--port PORT]
+(and run the game with CHESSCHASE_MATCH_SERVER=http://HOST:PORT)
+'''
+
+import argparse
+import random
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+words = '''
+    apple baker candle dragon eagle falcon garden harbor island jungle
+    kettle lemon marble needle orange pepper quartz river saddle tiger
+    umbrella violin walnut yellow zebra anchor bridge cactus desert ember
+    forest glacier hammer igloo jacket kitten ladder meadow nectar oyster
+    '''.split()
+
+class MatchServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Longest a lookup may wait for someone to join (seconds)
+    max_wait = 60
+
+    def __init__(self, addr):
+        super().__init__(addr, MatchHandler)
+        self.changed = threading.Condition()
+        # (game, address) -> endpoint
+        self.endpoints = {}
+        # (game, address) -> endpoints of the players in its game, shared by its players
+        self.games = {}
+
+    def register(self, game, endpoint):
+        with self.changed:
+            while True:
+                address = ' '.join(random.choice(words) for _ in range(3))
+                if (game, address) not in self.endpoints:
+                    break
+            self.endpoints[game, address] = endpoint
+            self.games[game, address] = [endpoint]
+            return address
+
+    def lookup(self, game, address, wait=0):
+        with self.changed:
+            players = self.games.get((game, address))
+            if players is None:
+                return None
+            self.changed.wait_for(lambda: len(players) > 1, min(wait, self.max_wait))
+            return list(players)
+
+    def connect(self, game, address, other):
+        with self.changed:
+            players = self.games.get((game, other))
+            endpoint = self.endpoints.get((game, address))
+            if players is None or endpoint is None:
+                return None
+            if endpoint not in players:
+                players.append(endpoint)
+            self.games[game, address] = players
+            self.changed.notify_all()
+            return list(players)
+
+class MatchHandler(BaseHTTPRequestHandler):
+    # Keep connections alive
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, which with Nagle's algorithm
+    # delays kept-alive responses by the client's delayed ack
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = [urllib.parse.unquote(x) for x in url.path.strip('/').split('/')]
+        query = urllib.parse.parse_qs(url.query)
+        command, game, args = parts[0], parts[1] if len(parts) > 1 else None, parts[2:]
+        result = None
+        if command == 'register' and len(args) == 2:
+            result = self.server.register(game, '%s:%s' % tuple(args))
+        elif command == 'lookup' and len(args) == 1:
+            players = self.server.lookup(game, args[0].lower(), float(query.get('wait', ['0'])[0]))
+            result = None if players is None else ' '.join(players)
+        elif command == 'connect' and len(args) == 2:
+            players = self.server.connect(game, args[0].lower(), args[1].lower())
+            result = None if players is None else ' '.join(players)
+        body = ('Not found' if result is None else result).encode('utf-8')
+        self.send_response(404 if result is None else 200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local matchmaking server for Chess Chase')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+    server = MatchServer(('', args.port))
+    print('matchmaking on port %d' % args.port)
+    server.serve_forever()
@@ -0,0 +1,104 @@
+'''
+Client of the matchmaking server, which pairs players by three word addresses.
+
+The protocol (see match_server.py for a local implementation):
+
+* /register/GAME/HOST/PORT/ gives an address to a player's external UDP endpoint
+* /lookup/GAME/ADDRESS/ lists the endpoints of the players in a game
+* /connect/GAME/MY_ADDRESS/ADDRESS/ joins a game, 404 if there is no such game
+
+Lookups may wait for players to join (long polling) with ``?wait=SECONDS``.
+Servers that don't support it answer at once, so the client then paces its lookups.
+'''
+
+import http.client
+import threading
+import time
+import urllib.parse
+
+class MatchError(Exception):
+    def __init__(self, status):
+        super().__init__('matchmaking server responded with status %d' % status)
+        self.status = status
+
+class MatchClient:
+    '''
+    Keeps its HTTP connections alive between requests.
+
+    Connections are pooled, so the long polling lookup of a host
+    doesn't hold back other requests.
+    '''
+
+    game = 'chesschase0'
+    # Seconds the server may hold a lookup until someone joins
+    long_poll = 20
+    # Least time between lookups answered without waiting
+    poll_interval = 5
+
+    def __init__(self, url):
+        parts = urllib.parse.urlsplit(url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.idle = []
+        self.lock = threading.Lock()
+        self.connections_opened = 0
+
+    def url(self, command, *args):
+        return '%s/%s/' % (self.prefix, '/'.join(urllib.parse.quote(str(x)) for x in (command, self.game) + args))
+
+    def request(self, path, timeout=30):
+        'GET a path, returning the response body'
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        # A pooled connection may have been closed by the server, retry once with a fresh one
+        for fresh in [conn is None, True]:
+            if fresh:
+                conn = self.new_connection()
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                body = response.read().decode('utf-8')
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if fresh:
+                    raise
+                continue
+            break
+        with self.lock:
+            self.idle.append(conn)
+        if response.status != 200:
+            raise MatchError(response.status)
+        return body
+
+    def new_connection(self):
+        self.connections_opened += 1
+        if self.https:
+            return http.client.HTTPSConnection(self.host)
+        return http.client.HTTPConnection(self.host)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+    def register(self, host, port):
+        'Address of our endpoint'
+        return self.request(self.url('register', host, port))
+
+    def lookup(self, address):
+        'Endpoints of the players in our game, waiting for a while for someone to join'
+        start = time.monotonic()
+        body = self.request(self.url('lookup', address) + '?wait=%d' % self.long_poll, self.long_poll + 10)
+        elapsed = time.monotonic() - start
+        if len(body.split()) < 2 and elapsed < self.poll_interval:
+            time.sleep(self.poll_interval - elapsed)
+        return body
+
+    def connect(self, address, other):
+        'Join the game of another address, returning the endpoints of its players'
+        return self.request(self.url('connect', address, other))
@@ -0,0 +1,162 @@
+'''
+Per tick instrumentation of the game loop.
+
+Metrics times instrumented methods (wrapping them on their instances, so
+nothing is added to the code paths of uninstrumented games) and samples
+counters, such as NetEngine.stats(), once per tick. It keeps a rolling window
+of recent ticks for an in-game overlay, and every report_interval ticks it
+summarizes them to its sinks: a JSON-lines file and a local HTTP endpoint
+serving the latest summary.
+
+Enabled by CHESSCHASE_METRICS (overlay), CHESSCHASE_METRICS_LOG (JSON-lines path)
+or CHESSCHASE_METRICS_PORT (HTTP endpoint on localhost), see env.py.
+'''
+
+import collections
+import functools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class Metrics:
+    # Ticks in the rolling window
+    window = 300
+    # Ticks between summaries
+    report_interval = 30
+    # Counters the overlay shows as rates
+    traffic = ('packets_sent', 'bytes_sent', 'packets_received', 'bytes_received')
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.tick = 0
+        # Timer name -> seconds spent in it during the current tick
+        self.current = {}
+        # Timer name -> seconds spent per tick, in the rolling window
+        self.timings = {}
+        # Counter name prefix -> function returning the counters' totals
+        self.sources = {}
+        # Counters at the previous summary, and when it was made
+        self.reported = {}
+        self.reported_at = None
+        self.summary = None
+        self.log = None
+        self.server = None
+
+    def instrument(self, obj, method, name=None):
+        'Time calls to a method of an object, replacing it on the instance'
+        func = getattr(obj, method)
+        name = name or '%s.%s' % (type(obj).__name__, method)
+        self.current.setdefault(name, 0)
+        current = self.current
+        clock = self.clock
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                current[name] += clock() - start
+        setattr(obj, method, timed)
+
+    def add_source(self, prefix, counters):
+        'Sample the numeric values of counters() every tick'
+        self.sources[prefix] = counters
+
+    def counters(self):
+        result = {}
+        for prefix, counters in self.sources.items():
+            for key, value in counters().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    result['%s.%s' % (prefix, key)] = value
+        return result
+
+    def end_tick(self):
+        'Record the timings of the tick, and summarize every report_interval ticks'
+        for name, seconds in self.current.items():
+            timings = self.timings.get(name)
+            if timings is None:
+                timings = self.timings[name] = collections.deque(maxlen=self.window)
+            timings.append(seconds)
+            self.current[name] = 0
+        self.tick += 1
+        if self.tick % self.report_interval == 0:
+            self.report()
+
+    def report(self):
+        now = time.time()
+        counters = self.counters()
+        elapsed = None if self.reported_at is None else now - self.reported_at
+        rates = {}
+        if elapsed:
+            for key, value in counters.items():
+                # Counters restart when their source is replaced (a new connection)
+                rates[key] = max(0, value - self.reported.get(key, 0)) / elapsed
+        recent = -self.report_interval
+        self.summary = {
+            'tick': self.tick,
+            'time': now,
+            'timings_ms': {
+                name: {
+                    'mean': sum(timings) / len(timings) * 1000,
+                    'max': max(timings) * 1000,
+                    'interval_mean': sum(list(timings)[recent:]) / min(len(timings), self.report_interval) * 1000,
+                    }
+                for name, timings in self.timings.items() if timings},
+            'counters': counters,
+            'rates': rates,
+            }
+        self.reported = counters
+        self.reported_at = now
+        if self.log is not None:
+            self.log.write(json.dumps(self.summary, sort_keys=True) + '\n')
+            self.log.flush()
+
+    def overlay(self):
+        'Lines of text summarizing the rolling window'
+        if self.summary is None:
+            return []
+        lines = ['%s %.2f ms (max %.1f)' % (name, timing['mean'], timing['max'])
+                 for name, timing in sorted(self.summary['timings_ms'].items())]
+        rates = self.summary['rates']
+        for key, value in sorted(self.summary['counters'].items()):
+            if key.endswith(self.traffic):
+                lines.append('%s %.0f/s' % (key, rates.get(key, 0)))
+            elif value:
+                lines.append('%s %g' % (key, value))
+        return lines
+
+    def log_to(self, path):
+        'Append the summaries to a JSON-lines file'
+        self.log = open(path, 'a')
+
+    def serve(self, port, host='127.0.0.1'):
+        'Serve the latest summary as JSON over HTTP, returning the server'
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+        self.server.metrics = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        # The summary is replaced rather than modified, so it is read without a lock
+        body = json.dumps(self.server.metrics.summary, sort_keys=True).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -1,30 +1,92 @@
-import marshal
+import collections
+import math
+import os
 import random
-import select
 import socket
+import tempfile
 import threading
 import time
-import urllib.error
-import urllib.request
 
 import stun
 
+import action_registry
 import env
+import wire
+from matchmaking import MatchClient, MatchError
+from replay_log import ReplayReader, ReplayWriter
+from tick_buffer import TickBuffer
+from transport import UdpTransport
 
-def poll(sock):
-    return select.select([sock], [], [], 0)[0] != []
+def game_actions(actions):
+    'A player\'s actions without the engine\'s bookkeeping (delay proposals and state hashes)'
+    return [action for action in actions if action[0] not in action_registry.engine_actions]
 
 def any_actions(actions):
-    return any(acts for _, acts in actions)
+    'Does a tick have game actions, and isn\'t just bookkeeping to skip in replays'
+    return any(game_actions(acts) for _, acts in actions)
+
+def effective(all_actions):
+    'The game actions of a tick (players without any are left out)'
+    return [(i, acts) for i, acts in ((i, game_actions(acts)) for i, acts in all_actions) if acts]
 
 class NetEngine:
-    latency = 5
+    # Input delay (in ticks) at the start of a session
+    start_latency = 5
+    # Bounds of the input delay as adapted to the measured round-trip times
+    min_latency = 2
+    max_latency = 30
+    tick_duration = 1 / 30
+    # How often (in ticks) to reconsider the proposed input delay
+    delay_interval = 30
+    # How often (in ticks) the peers compare their state hashes
+    hash_interval = 30
+    # State hashes kept for comparing with the peers'
+    hash_history = 8
+    # Bookkeeping that only reads the confirmed state, so in rollback mode, when a peer's
+    # arrives late, it is done once its tick is confirmed rather than rolled back for
+    confirmed_actions = {'hash'}
     replay_max_wait = 30
+    # How often (in ticks) to keep a copy of the game state for seeking in replays
+    keyframe_interval = 150
+    # Spectators further behind the relay than this (in ticks) fast-forward,
+    # executing up to max_catch_up ticks per frame
+    spectator_lag = 15
+    max_catch_up = 300
+    # Seconds between a spectator's requests when it has nothing new to acknowledge
+    spectator_request_interval = 0.25
+    # Newest ticks of the window that are resent even when acknowledged,
+    # so that a lost packet doesn't wait for the acknowledgement round-trip
+    resend_floor = 2
+    # Most ticks executed ahead of the peers' actions in rollback mode
+    max_rollback = 8
 
-    def __init__(self, game_model):
+    def __init__(self, game_model, replay_dir=None):
         self.game = game_model
         self.socket = None
         self.threads = []
+        # Played matches are logged in this directory (if given)
+        self.replay_dir = replay_dir or env.replay_dir
+        self.replay_log = None
+        self.logged_match = None
+        # Reader of a logged match being watched
+        self.replay_source = None
+        # Address of the relay when playing through one (see relay.py)
+        self.relay_addr = None
+        # Watching a game through a relay, without taking part in it
+        self.spectating = False
+        # Execute ticks before the peers' actions arrive rather than waiting for them,
+        # rolling back if they turn out to have acted
+        self.rollback = env.rollback
+        self.match = MatchClient(env.match_server)
+        # Time in seconds (simulate.py substitutes a simulated clock)
+        self.clock = time.monotonic
+        # Action -> (its handler, whether it is quiet), built once (see action_registry.py)
+        self.handlers = {}
+        for name, (handled_by, _) in action_registry.schemas.items():
+            handler = getattr(self if handled_by == 'engine' else self.game, 'action_' + name)
+            self.handlers[name] = handler, getattr(handler, 'quiet', False)
+        # Action -> [times executed, seconds spent], when timing them (say for metrics)
+        self.action_timings = None
         self.reset()
         self.game.my_id = random.randrange(2**64)
 
@@ -34,7 +96,64 @@ class NetEngine:
         self.last_comm_time = None
         self.comm_gap_msg_at = 10
         self.should_start_replay = False
-        self.iter_actions = {}
+        self.iter_actions = TickBuffer()
+        self.encoder = wire.Encoder()
+        self.decoder = wire.Decoder()
+        # Malformed actions from the peers that were reported
+        self.reported_rejections = 0
+        # Created on first use, as the socket is set up by the net thread
+        # (or set directly, like the loopback transports of simulations)
+        self.transport = None
+        # Peer address -> its id, as learned from its packets
+        self.peer_ids = {}
+        # Peer id -> tick up to which the peer has all our actions
+        self.peer_acks = {}
+        # Peer id -> tick up to which we have all of the peer's actions
+        self.holding = {}
+        # Input delay in effect, the largest proposal of the peers (see action_delay)
+        self.latency = self.start_latency
+        self.delay_proposals = {}
+        self.my_proposal = self.start_latency
+        self.proposal_tick = 0
+        # Latest tick holding our actions
+        self.last_scheduled = 0
+        # Peer id -> smoothed round-trip time and its mean deviation (in seconds)
+        self.rtt = {}
+        self.jitter = {}
+        # Peer id -> (its latest clock reading, when we received it)
+        self.peer_clocks = {}
+        self.clock_start = self.clock()
+        # Frames act() waited for peers, and the number of ticks that were waited on
+        self.stalls = 0
+        self.stalled_ticks = 0
+        self.last_stalled_tick = None
+        # Actions that failed or don't exist, and idle replay ticks skipped over
+        self.action_failures = 0
+        self.replay_skips = 0
+        self.relay_id = None
+        # Merged ticks received from the relay, beyond those it was acknowledged for
+        self.relayed = set()
+        # (state before the tick, actions it was executed with, kings it captured)
+        # of the ticks executed speculatively, from the oldest
+        self.speculated = collections.deque()
+        # Times rolled back, deepest rollback and ticks re-executed (and the seconds it took)
+        self.rollbacks = 0
+        self.rollback_depth = 0
+        self.resimulated_ticks = 0
+        self.resimulation_time = 0
+        # Tick -> (hash of the state before it, snapshot), every hash_interval ticks
+        self.state_hashes = {}
+        self.hash_sent = 0
+        # Ticks on which the peers' states were found to diverge from ours (once per game)
+        self.desyncs = []
+        # Tick -> (game snapshot, players, nicknames) before it, for seeking in replays of the current game
+        self.keyframes = {}
+        # Replay ticks executed per frame (0 pauses), and the fraction of a tick due
+        self.replay_speed = 1
+        self.replay_progress = 0
+        # A spectator's latest request: the tick it asked from and when
+        self.requested = None
+        self.last_request = 0
 
     def start(self):
         self.game.reset()
@@ -44,7 +163,24 @@ class NetEngine:
         if not env.dev_mode:
             net_thread.start()
 
+    def stop(self):
+        self.should_stop = True
+        self.match.close()
+        if self.transport is not None:
+            self.transport.close()
+        if self.replay_log is not None:
+            self.replay_log.close()
+            self.replay_log = None
+
     def net_thread_go(self):
+        relay = env.spectate or env.relay
+        if relay:
+            host, port = relay.rsplit(':', 1)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('', 0))
+            self.socket = sock
+            self.connect_relay((socket.gethostbyname(host), int(port)), spectate=bool(env.spectate))
+            return
         self.setup_socket()
         if self.should_stop:
             return
@@ -75,9 +211,8 @@ class NetEngine:
         self.socket = sock
 
     def setup_addr_name(self):
-        url = 'http://game-match.herokuapp.com/register/chesschase0/%s/%d/' % self.my_addr
-        print('registering at %s' % url)
-        self.address = urllib.request.urlopen(url).read().decode('utf-8')
+        print('registering %s:%d' % self.my_addr)
+        self.address = self.match.register(*self.my_addr)
         self.game.add_message('')
         self.game.add_message('Your address is:')
         self.game.add_message(self.address.upper())
@@ -86,12 +221,11 @@ class NetEngine:
 
     def wait_for_connections(self):
         while not self.peers:
-            time.sleep(5)
             if self.should_stop:
                 return
-            url = 'http://game-match.herokuapp.com/lookup/chesschase0/%s/' % self.address.replace(' ', '%20')
-            print('checking game at %s' % url)
-            self.add_peers(urllib.request.urlopen(url).read().decode('utf-8'))
+            print('checking game %s' % self.address)
+            # Returns once someone joins, or after a while
+            self.add_peers(self.match.lookup(self.address))
 
     def connect(self, address):
         connect_thread = threading.Thread(target=self.connect_thread_go, args=(address, ))
@@ -103,17 +237,16 @@ class NetEngine:
         while self.address is None:
             # Net thread didn't finish
             time.sleep(1)
-        url = 'http://game-match.herokuapp.com/connect/chesschase0/%s/%s/' % (self.address.replace(' ', '%20'), addr.lower().replace(' ', '%20'))
-        print('looking up host at %s' % url)
+        print('looking up host %s' % addr)
         try:
-            response = urllib.request.urlopen(url).read()
-        except urllib.error.HTTPError as err:
-            if err.code == 404:
+            response = self.match.connect(self.address, addr.lower())
+        except MatchError as err:
+            if err.status == 404:
                 self.game.add_message('No such game: %s' % addr)
             else:
                 self.game.add_message('Server error when looking up game: %s' % addr)
             return
-        self.add_peers(response.decode('utf-8'))
+        self.add_peers(response)
 
     def add_peers(self, peers_str):
         for x in peers_str.split():
@@ -131,97 +264,541 @@ class NetEngine:
             self.game.add_message('THE GAME BEGINS!')
             self.game.mode = 'play'
             self.game.init()
-            self.last_comm_time = time.time()
+            self.last_comm_time = self.clock()
             self.comm_gap_msg_at = 10
 
+    def connect_relay(self, addr, spectate=False):
+        'Play through a relay rather than directly with the peers, or watch the game it relays'
+        print('%s through relay at %s:%d' % (('spectating' if spectate else 'playing', ) + addr))
+        self.relay_addr = addr
+        self.spectating = spectate
+        if spectate:
+            # Spectators only execute complete ticks
+            self.rollback = False
+        self.peers = [addr]
+        self.decoder = wire.MergedDecoder()
+        self.reported_rejections = 0
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        self.game.messages.clear()
+        self.game.add_message('Waiting for the game to start' if spectate else 'Waiting for the players to join the relay')
+        self.game.mode = 'play'
+        self.game.init()
+        self.last_comm_time = self.clock()
+
     def communicate(self):
-        if self.socket is None:
-            return
-        packet = marshal.dumps((
-            self.game.my_id,
-            [(i, self.iter_actions.setdefault(i, {}).setdefault(self.game.my_id, []))
-                for i in
-                range(
-                    max(0, self.game.counter-self.latency),
-                    self.game.counter+self.latency)]))
-        for peer in self.peers:
-            self.socket.sendto(packet, 0, peer)
-        while poll(self.socket):
-            self.last_comm_time = time.time()
-            packet, peer = self.socket.recvfrom(0x1000)
-            peer_id, peer_iter_actions = marshal.loads(packet)
-            for i, actions in peer_iter_actions:
+        if self.socket is not None and (self.transport is None or self.transport.socket is not self.socket):
+            if self.transport is not None:
+                self.transport.close()
+            self.transport = UdpTransport(self.socket, self.decoder.decode)
+        if self.transport is None:
+            return
+        now = self.clock()
+        if self.spectating:
+            self.request_ticks(now)
+        else:
+            self.send_actions(now)
+        for peer, packet, received_at in self.transport.receive():
+            self.last_comm_time = self.clock()
+            if self.relay_addr is None:
+                peer_id, ack, clock, peer_iter_actions = packet
+                merged = [(i, [(peer_id, actions)]) for i, actions in peer_iter_actions]
+            else:
+                peer_id, ack, clock, roster, merged = packet
+                self.relay_id = peer_id
+                self.set_roster(roster)
+            self.peer_ids[peer] = peer_id
+            self.peer_acks[peer_id] = max(ack, self.peer_acks.get(peer_id, 0))
+            self.measure(peer_id, clock, received_at)
+            for i, senders_actions in merged:
                 acts = self.iter_actions.setdefault(i, {})
-                if peer_id in acts:
-                    assert acts[peer_id] == actions, '%s %s' % (acts[peer_id], actions)
-                else:
-                    acts[peer_id] = actions
+                for sender, actions in senders_actions:
+                    if sender in acts:
+                        assert acts[sender] == actions, '%s %s' % (acts[sender], actions)
+                    else:
+                        acts[sender] = actions
+                if self.relay_addr is not None:
+                    self.relayed.add(i)
+            self.update_holding(peer_id)
+        if self.decoder.rejected_actions > self.reported_rejections:
+            self.game.add_message('Left out %d malformed actions from peers (%s)' % (
+                self.decoder.rejected_actions - self.reported_rejections, self.decoder.last_rejected))
+            self.reported_rejections = self.decoder.rejected_actions
 
         if self.last_comm_time is None:
             return
-        time_since_comm = time.time() - self.last_comm_time
+        time_since_comm = self.clock() - self.last_comm_time
         if time_since_comm >= self.comm_gap_msg_at:
             self.game.add_message('No communication for %d seconds' % self.comm_gap_msg_at)
             self.comm_gap_msg_at += 5
         elif time_since_comm < 5:
             self.comm_gap_msg_at = 5
 
+    def send_actions(self, now):
+        'Send the peers our actions for the window of ticks around the current one'
+        # In rollback mode, peers may be behind by the ticks that both of us speculated
+        behind = 2 * self.max_rollback if self.rollback else 0
+        start = self.game.counter-self.latency-behind
+        if self.game.mode != 'replay':
+            # A peer may be stalled before that, waiting for a tick whose packets were lost
+            start = min([start] + [self.peer_acks.get(self.peer_ids.get(peer), 0) for peer in self.peers])
+        start = max(0, start)
+        end = self.game.counter+self.latency
+        if self.game.mode != 'replay':
+            # Ticks scheduled before the delay decreased are sent too
+            end = max(end, self.last_scheduled+1)
+        window = [
+            (i, self.iter_actions.setdefault(i, {}).setdefault(self.game.my_id, []))
+            for i in range(start, end)]
+        self.encoder.forget(start)
+        for peer in self.peers:
+            peer_id = self.peer_ids.get(peer)
+            acked = self.peer_acks.get(peer_id, 0)
+            ticks = [(i, actions) for i, actions in window if i >= acked or i >= end-self.resend_floor]
+            packets = self.encoder.encode(
+                self.game.my_id, ticks, self.holding.get(peer_id, 0), self.clock_for(peer_id, now))
+            for packet in packets:
+                self.transport.send(packet, peer)
+
+    def request_ticks(self, now):
+        'Ask the relay for the ticks we miss, when that changed or every once in a while'
+        holding = self.holding.get(self.relay_id, 0)
+        if holding == self.requested and now - self.last_request < self.spectator_request_interval:
+            return
+        self.requested = holding
+        self.last_request = now
+        request = wire.spectator_request(self.game.my_id, holding, self.clock_for(self.relay_id, now))
+        self.transport.send(request, self.relay_addr)
+
+    def ms(self, t):
+        return int((t - self.clock_start) * 1000)
+
+    def clock_for(self, peer_id, now):
+        'Clock of a packet to a peer, echoing its latest clock reading'
+        peer_clock = self.peer_clocks.get(peer_id)
+        if peer_clock is None:
+            return self.ms(now), None, 0
+        sent, received_at = peer_clock
+        return self.ms(now), sent, int((now - received_at) * 1000)
+
+    def measure(self, peer_id, clock, received_at):
+        'Update the round-trip time estimate of a peer from its packet'
+        sent, echo, held = clock
+        peer_clock = self.peer_clocks.get(peer_id)
+        if peer_clock is None or sent >= peer_clock[0]:
+            self.peer_clocks[peer_id] = sent, received_at
+        if echo is None:
+            return
+        sample = max(0, self.ms(received_at) - echo - held) / 1000
+        rtt = self.rtt.get(peer_id)
+        if rtt is None:
+            self.rtt[peer_id] = sample
+            self.jitter[peer_id] = sample / 2
+            return
+        # Smoothed as in TCP's retransmission timer (RFC 6298)
+        self.jitter[peer_id] = 3/4 * self.jitter[peer_id] + 1/4 * abs(rtt - sample)
+        self.rtt[peer_id] = 7/8 * rtt + 1/8 * sample
+
+    def proposed_delay(self):
+        '''
+        Input delay (in ticks) for our actions to reach the farthest peer in time.
+
+        Covers a one-way trip plus four times the jitter,
+        and a frame between a packet's arrival and its use.
+        '''
+        if not self.rtt:
+            return None
+        # Through a relay, actions take a round-trip to reach the other players
+        hops = 1 if self.relay_addr is None else 2
+        trip = max(self.rtt[peer_id] / 2 * hops + 4 * self.jitter[peer_id] for peer_id in self.rtt)
+        delay = math.ceil(trip / self.tick_duration) + 1
+        return min(self.max_latency, max(self.min_latency, delay))
+
+    def propose_delay(self):
+        'Propose a new input delay to the peers when ours changed enough'
+        if self.game.mode != 'play' or self.game.counter < self.proposal_tick + self.delay_interval:
+            return
+        delay = self.proposed_delay()
+        # Decreasing by a single tick isn't worth reacting to jitter
+        if delay is None or self.my_proposal - 1 <= delay <= self.my_proposal:
+            return
+        self.my_proposal = delay
+        self.proposal_tick = self.game.counter
+        self.game.add_action('delay', delay)
+
+    def action_delay(self, i, ticks):
+        '''
+        A peer proposes an input delay.
+
+        All peers execute the proposals on the same ticks,
+        so they agree on the delay from the next tick on: the largest proposal.
+        '''
+        if self.game.mode == 'replay':
+            return
+        self.delay_proposals[i] = min(self.max_latency, max(self.min_latency, int(ticks)))
+        self.latency = max(self.delay_proposals.values())
+    action_delay.quiet = True
+
+    def share_hash(self):
+        'Send the peers the hash of our latest confirmed state (every hash_interval ticks)'
+        confirmed = self.game.counter - len(self.speculated)
+        tick = confirmed - confirmed % self.hash_interval
+        if self.game.mode != 'play' or not self.peers or tick <= self.hash_sent or tick not in self.state_hashes:
+            return
+        self.hash_sent = tick
+        self.game.add_action('hash', tick, self.state_hashes[tick][0])
+
+    def record_hash(self):
+        'Keep the hash of the current state, if it is to be compared'
+        tick = self.game.counter
+        if self.game.mode != 'play' or tick % self.hash_interval:
+            return
+        self.state_hashes[tick] = self.game.state_hash(), self.game.snapshot()
+        self.state_hashes.pop(tick - self.hash_interval * self.hash_history, None)
+
+    def action_hash(self, i, tick, value):
+        '''
+        A peer's hash of its state before a tick.
+
+        When it differs from ours, the game diverged (say because an action failed
+        on one side only), and we write our state to a file for diagnosis.
+        '''
+        if self.game.mode == 'replay' or i == self.game.my_id:
+            return
+        if self.desyncs and self.desyncs[-1] >= self.game.last_start:
+            # Already reported for this game, which stays diverged
+            return
+        if tick > self.game.counter - len(self.speculated):
+            # Our own state at that tick wasn't confirmed
+            return
+        ours = self.state_hashes.get(tick)
+        if ours is None or ours[0] == value:
+            return
+        self.desyncs.append(tick)
+        path = self.dump_state(tick, i, value)
+        self.game.add_message('Out of sync with %s since tick %d, state written to %s' % (
+            self.game.nick(i), tick, path))
+    action_hash.quiet = True
+
+    def dump_state(self, tick, peer_id, peer_hash):
+        'Write our state before a tick to a file, to compare with the peer\'s'
+        h, (num_boards, board_size, counter, player_last_move, pieces) = self.state_hashes[tick]
+        path = os.path.join(
+            self.replay_dir or tempfile.gettempdir(), 'desync-%d-%016x.txt' % (tick, self.game.my_id))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write('tick %d, hash %016x, peer %016x hash %016x\n' % (counter, h, peer_id, peer_hash))
+            f.write('boards %d, size %s\n' % (num_boards, board_size))
+            f.write('players %s\n' % sorted(self.game.players.items()))
+            f.write('last moves %s\n' % (player_last_move, ))
+            for piece_type, player, pos, freeze_until, last_move_time, last_pos in pieces:
+                f.write('%s %d at %s, frozen until %d, moved at %s from %s\n' % (
+                    piece_type.__name__, player, pos, freeze_until, last_move_time, last_pos))
+        return path
+
+    def stats(self):
+        transport = self.transport
+        return {
+            'delay': self.latency,
+            'stalls': self.stalls,
+            'stalled_ticks': self.stalled_ticks,
+            'action_failures': self.action_failures,
+            'rejected_actions': self.decoder.rejected_actions,
+            'replay_skips': self.replay_skips,
+            'packets_sent': getattr(transport, 'packets_sent', 0),
+            'bytes_sent': getattr(transport, 'bytes_sent', 0),
+            'packets_received': getattr(transport, 'packets_received', 0),
+            'bytes_received': getattr(transport, 'bytes_received', 0),
+            'rtt': dict(self.rtt),
+            'jitter': dict(self.jitter),
+            'rollbacks': self.rollbacks,
+            'rollback_depth': self.rollback_depth,
+            'resimulated_ticks': self.resimulated_ticks,
+            'resimulation_ms': self.resimulation_time * 1000,
+            'desyncs': list(self.desyncs),
+            }
+
+    def action_stats(self):
+        'Times each action was executed and the milliseconds it took, if timed'
+        result = {}
+        for action_type, (calls, seconds) in sorted((self.action_timings or {}).items()):
+            result[action_type + '.calls'] = calls
+            result[action_type + '.ms'] = seconds * 1000
+        return result
+
+    def status(self):
+        'Summary of the stats for the player'
+        result = 'input delay %d ticks, stalled %d times on %d ticks' % (
+            self.latency, self.stalls, self.stalled_ticks)
+        if self.spectating:
+            result = 'spectating %d ticks behind the relay, stalled %d times on %d ticks' % (
+                self.holding.get(self.relay_id, 0) - self.game.counter, self.stalls, self.stalled_ticks)
+        if self.rollback:
+            result += ', rolled back %d times (up to %d ticks, %d ticks in %.0f ms)' % (
+                self.rollbacks, self.rollback_depth, self.resimulated_ticks, self.resimulation_time * 1000)
+        if self.decoder.rejected_actions:
+            result += ', left out %d malformed actions' % self.decoder.rejected_actions
+        for peer_id, rtt in sorted(self.rtt.items()):
+            result += ', %s rtt %.0f±%.0f ms' % (self.game.nick(peer_id), rtt * 1000, self.jitter[peer_id] * 1000)
+        return result
+
+    def update_holding(self, peer_id):
+        tick = self.holding.get(peer_id, 0)
+        if peer_id == self.relay_id:
+            while tick in self.relayed:
+                self.relayed.discard(tick)
+                tick += 1
+        else:
+            while peer_id in self.iter_actions.get(tick, ()):
+                tick += 1
+        self.holding[peer_id] = tick
+
+    def set_roster(self, roster):
+        'The relay sends its roster once all players joined'
+        num_boards = (len(roster) + 1) // 2
+        if num_boards != self.game.num_boards and self.game.counter <= self.start_latency:
+            self.game.init(num_boards)
+
+    def tick_ready(self, tick):
+        'Do we have the actions of all players for a tick'
+        if self.relay_addr is not None:
+            # The relay only sends complete ticks
+            return tick < self.holding.get(self.relay_id, 0)
+        return len(self.iter_actions.get(tick, {})) > len(self.peers)
+
     def get_replay_actions(self):
+        if self.replay_source is not None:
+            return self.replay_source.actions_at(self.game.counter)
         return sorted(self.iter_actions.get(self.game.counter, {}).items())
 
+    def log_tick(self, tick, all_actions):
+        'Write the actions of a played tick to the replay log'
+        if self.replay_log is None:
+            os.makedirs(self.replay_dir, exist_ok=True)
+            self.replay_log = ReplayWriter(os.path.join(
+                self.replay_dir, '%s-%016x.ccr' % (time.strftime('%Y%m%d-%H%M%S'), self.game.my_id)))
+        if self.logged_match != self.game.last_start:
+            self.logged_match = self.game.last_start
+            self.replay_log.start_match(
+                tick, dict(self.game.players), dict(self.game.nicknames), self.game.num_boards)
+        # Bookkeeping does nothing in replays
+        self.replay_log.append(tick, [(i, game_actions(acts)) for i, acts in all_actions])
+
+    def play_recorded(self, path, match=-1):
+        'Watch a match from a replay log'
+        reader = ReplayReader(path)
+        if not reader.matches:
+            self.game.add_message('No matches in %s' % path)
+            return
+        info = reader.matches[match]
+        self.replay_source = reader
+        self.keyframes.clear()
+        self.replay_progress = 0
+        self.game.mode = 'replay'
+        self.game.counter = info.start
+        self.game.last_start = info.start
+        self.replay_stop = info.stop
+        self.replay_wait = 0
+        self.game.players = dict(info.players)
+        self.game.nicknames = dict(info.nicknames)
+        self.game.init(info.num_boards)
+
+    def execute(self, all_actions, speculative=False):
+        'Execute the actions of the current tick'
+        if self.game.counter == self.start_latency:
+            # Assign players
+            for player, i in enumerate(i for i, _ in all_actions):
+                self.game.players[i] = player
+
+        if self.replay_dir and self.game.mode == 'play' and not speculative:
+            self.log_tick(self.game.counter, all_actions)
+
+        self.perform(all_actions)
+
+        self.game.counter += 1
+        self.record_hash()
+        if not speculative:
+            self.record_keyframe(self.game.counter)
+
+    def record_keyframe(self, tick, state=None):
+        '''
+        Keep the confirmed state before a tick, when it is due a keyframe.
+
+        state is the (snapshot, players, nicknames) before the tick, the current ones by default.
+        '''
+        if tick % self.keyframe_interval or tick in self.keyframes:
+            return
+        if state is None:
+            state = self.game.snapshot(), self.game.players, self.game.nicknames
+        snapshot, players, nicknames = state
+        self.keyframes[tick] = snapshot, dict(players), dict(nicknames)
+
+    def perform(self, all_actions):
+        'Run the handlers of the actions of a tick'
+        timings = self.action_timings
+        for i, actions in all_actions:
+            for action_type, params in actions:
+                # Actions were checked when queued or decoded, but replays of old logs may have others
+                handler, quiet = self.handlers.get(action_type, (None, False))
+                if handler is None:
+                    self.action_failures += 1
+                    self.game.add_message(action_type + ': no such action')
+                    continue
+                prev_messages = len(self.game.messages)
+                if timings is not None:
+                    start = time.perf_counter()
+                if env.dev_mode:
+                    handler(i, *params)
+                else:
+                    try:
+                        handler(i, *params)
+                    except Exception:
+                        self.action_failures += 1
+                        self.game.add_message('action ' + action_type + ' failed')
+                if timings is not None:
+                    timing = timings.setdefault(action_type, [0, 0])
+                    timing[0] += 1
+                    timing[1] += time.perf_counter() - start
+                if not quiet and prev_messages == len(self.game.messages):
+                    self.game.add_message('%s did %s' % (self.game.nick(i), action_type.upper()))
+
+    def save_state(self):
+        'State that executing a tick may change'
+        return (
+            self.game.snapshot(), dict(self.game.players), dict(self.game.nicknames),
+            len(self.game.messages), self.latency, dict(self.delay_proposals))
+
+    def load_state(self, state):
+        snapshot, players, nicknames, num_messages, self.latency, delay_proposals = state
+        self.game.restore(snapshot)
+        self.game.players = dict(players)
+        self.game.nicknames = dict(nicknames)
+        self.delay_proposals = dict(delay_proposals)
+        # Messages of the undone ticks are shown again as they are re-executed
+        del self.game.messages[num_messages:]
+
+    def speculate(self):
+        '''
+        Execute the current tick with the actions we have, predicting that the peers we miss did nothing.
+
+        Captured kings are only reported once the tick is confirmed.
+        '''
+        all_actions = sorted(self.iter_actions.get(self.game.counter, {}).items())
+        state = self.save_state()
+        captured = []
+        king_captured = self.game.king_captured
+        self.game.king_captured = captured.append
+        try:
+            self.execute(all_actions, speculative=True)
+        finally:
+            self.game.king_captured = king_captured
+        self.speculated.append((state, all_actions, captured))
+
+    def reconcile(self):
+        'Confirm the ticks executed ahead whose actions arrived, rolling back on the first mispredicted one'
+        while self.speculated:
+            tick = self.game.counter - len(self.speculated)
+            if not self.tick_ready(tick):
+                return
+            _, predicted, captured = self.speculated[0]
+            all_actions = sorted(self.iter_actions[tick].items())
+            # Bookkeeping of the peers we missed isn't a misprediction, unless it changes the engine's state
+            predicted_peers = {i for i, _ in predicted}
+            missed = [(i, acts) for i, acts in all_actions if i not in predicted_peers]
+            if effective(all_actions) != effective(predicted) or any(
+                    action_type not in self.confirmed_actions for _, acts in missed for action_type, _ in acts):
+                self.resimulate()
+                return
+            self.speculated.popleft()
+            self.perform(missed)
+            # The state after the confirmed tick is the one saved before the next speculative tick
+            self.record_keyframe(tick + 1, self.speculated[0][0][:3] if self.speculated else None)
+            if self.replay_dir:
+                self.log_tick(tick, all_actions)
+            if captured:
+                # Undo the ticks after the capture, as the game ends with it
+                if self.speculated:
+                    self.load_state(self.speculated[0][0])
+                    self.speculated.clear()
+                for who in captured:
+                    self.game.king_captured(who)
+                return
+
+    def resimulate(self):
+        'Roll back to the oldest speculative tick and execute again up to the current one'
+        start = time.perf_counter()
+        present = self.game.counter
+        self.load_state(self.speculated[0][0])
+        self.speculated.clear()
+        depth = present - self.game.counter
+        self.rollbacks += 1
+        self.rollback_depth = max(self.rollback_depth, depth)
+        self.resimulated_ticks += depth
+        while self.game.counter < present:
+            if not self.speculated and self.tick_ready(self.game.counter):
+                self.execute(sorted(self.iter_actions[self.game.counter].items()))
+                if self.should_start_replay:
+                    break
+            else:
+                self.speculate()
+        self.resimulation_time += time.perf_counter() - start
+
     def act(self):
         if self.game.mode == 'replay':
             all_actions = self.get_replay_actions()
             if any_actions(all_actions):
                 self.replay_wait = 0
-            else:
+            elif self.game.counter+1 < self.replay_stop:
+                # Logged matches can end with an empty tick
                 self.game.counter += 1
+                self.replay_skips += 1
                 all_actions = self.get_replay_actions()
                 self.replay_wait += 1
                 if self.replay_wait == self.replay_max_wait:
                     self.replay_wait = 0
                     while not any_actions(all_actions) and self.game.counter+1 < self.replay_stop:
                         self.game.counter += 1
+                        self.replay_skips += 1
                         all_actions = self.get_replay_actions()
+            self.execute(all_actions)
         elif self.game.active():
-            if self.game.counter < self.latency:
+            if self.game.counter < self.start_latency:
                 self.game.counter += 1
                 return
-            if len(self.iter_actions.get(self.game.counter, {})) <= len(self.peers):
+            if self.speculated:
+                self.reconcile()
+            if self.should_start_replay:
+                # A king was captured on a tick executed ahead
+                pass
+            elif not self.speculated and self.tick_ready(self.game.counter):
+                self.execute(sorted(self.iter_actions[self.game.counter].items()))
+            elif self.rollback and self.game.counter > self.start_latency and \
+                    len(self.speculated) < self.max_rollback:
+                self.speculate()
+            else:
                 # We haven't got communications from all peers for this iteration.
                 # So we'll wait.
+                self.stalls += 1
+                if self.last_stalled_tick != self.game.counter:
+                    self.last_stalled_tick = self.game.counter
+                    self.stalled_ticks += 1
                 return
-            all_actions = sorted(self.iter_actions[self.game.counter].items())
         else:
             return
 
-        if self.game.counter == self.latency:
-            # Assign players
-            for player, i in enumerate(i for i, _ in all_actions):
-                self.game.players[i] = player
-
-        for i, actions in all_actions:
-            for action_type, params in actions:
-                action_func = getattr(self.game, 'action_'+action_type, None)
-                if action_func is None:
-                    self.game.add_message(action_type + ': no such action')
-                else:
-                    prev_messages = len(self.game.messages)
-                    if env.dev_mode:
-                        action_func(i, *params)
-                    else:
-                        try:
-                            action_func(i, *params)
-                        except:
-                            self.game.add_message('action ' + action_type + ' failed')
-                    if prev_messages == len(self.game.messages) and not getattr(action_func, 'quiet', False):
-                        self.game.add_message('%s did %s' % (self.game.nick(i), action_type.upper()))
-
-        self.game.counter += 1
-
+        if self.game.mode == 'replay' and self.game.counter == self.replay_stop and self.replay_source is not None:
+            # Finished watching a logged match
+            self.replay_source.close()
+            self.replay_source = None
+            self.game.mode = None
+            self.game.add_message('Replay finished')
+            return
         if self.game.mode == 'replay' and self.game.counter == self.replay_stop:
             self.game.mode = 'play'
             self.game.last_start = self.game.counter
+            self.iter_actions.release(self.game.last_start)
+            self.keyframes.clear()
             self.game.init()
         assert not self.game.mode == 'replay' or self.game.counter < self.replay_stop
 
@@ -232,16 +809,68 @@ class NetEngine:
             self.replay_stop = self.game.counter
             self.game.counter = self.game.last_start
             self.replay_wait = 0
+            self.replay_progress = 0
             self.game.init()
 
+    def seek(self, tick):
+        '''
+        Jump to a tick of the replay.
+
+        Restores the latest keyframe before it (unless the replay is already
+        between them) and executes the ticks from there, without their messages.
+        '''
+        if self.game.mode != 'replay':
+            return
+        tick = max(self.game.last_start, min(tick, self.replay_stop - 1))
+        keyframe = max((x for x in self.keyframes if self.game.last_start <= x <= tick), default=None)
+        if tick < self.game.counter or keyframe is not None and keyframe > self.game.counter:
+            if keyframe is None:
+                self.game.counter = self.game.last_start
+                self.game.init()
+            else:
+                snapshot, players, nicknames = self.keyframes[keyframe]
+                self.game.restore(snapshot)
+                self.game.players = dict(players)
+                self.game.nicknames = dict(nicknames)
+        num_messages = len(self.game.messages)
+        while self.game.counter < tick:
+            self.execute(self.get_replay_actions())
+        del self.game.messages[num_messages:]
+        self.replay_wait = 0
+
+    def play_replay(self):
+        'Execute as many replay ticks as the playback speed calls for, rendering only the last'
+        self.replay_progress += self.replay_speed
+        while self.replay_progress >= 1 and self.game.mode == 'replay':
+            self.replay_progress -= 1
+            self.act()
+
     def iteration(self):
         self.communicate()
+        if self.spectating:
+            self.act()
+            for _ in range(self.max_catch_up):
+                live = self.replay_stop if self.game.mode == 'replay' else self.game.counter
+                if self.holding.get(self.relay_id, 0) - live <= self.spectator_lag:
+                    break
+                self.act()
+            return
+        self.propose_delay()
+        self.share_hash()
 
-        if self.game.mode != 'replay' and self.game.my_id not in self.iter_actions.setdefault(self.game.counter+self.latency, {}):
-            self.iter_actions[self.game.counter+self.latency][self.game.my_id] = self.game.cur_actions
+        tick = self.game.counter+self.latency
+        if self.game.mode != 'replay' and self.game.my_id not in self.iter_actions.setdefault(tick, {}):
+            # When the delay grows, the ticks skipped over have no actions from us
+            for gap in range(self.last_scheduled+1, tick):
+                self.iter_actions.setdefault(gap, {}).setdefault(self.game.my_id, [])
+            self.iter_actions[tick][self.game.my_id] = self.game.cur_actions
             self.game.cur_actions = []
+            self.last_scheduled = tick
 
-        self.act()
+        if self.game.mode == 'replay':
+            self.play_replay()
+        else:
+            self.act()
 
     def start_replay(self):
         self.should_start_replay = True
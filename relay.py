@@ -0,0 +1,199 @@
+'''
+Relay for games with many participants.
+
+Instead of every player sending its actions to every other player,
+players send them to the relay only. Once the relay has the actions of all
+players in its roster for a tick, it sends the merged tick to all of them,
+so each player's traffic doesn't grow with the number of players.
+
+The roster is made of the first players to contact the relay,
+and a tick is complete once all of them sent their actions for it.
+
+Spectators send spectator requests instead of actions. They aren't part of
+the roster, so they never hold the game back. The relay sends them the
+complete ticks in batches, optionally delayed, so serving many spectators
+is only work for the relay. As spectators may join at any time and replay
+the session from its start, the relay keeps its ticks (spilled compactly
+by TickBuffer) when it accepts spectators.
+
+Usage: python relay.py [--port PORT] [--players N] [--spectators N]
+                       [--spectator-delay TICKS] [--spectator-interval SECONDS]
+'''
+
+import argparse
+import random
+import select
+import socket
+import time
+
+import wire
+from tick_buffer import TickBuffer
+
+class Relay:
+    tick_duration = 1 / 30
+    # Most ticks sent to a player in a packet, when it is behind
+    max_window = 64
+    # Newest complete ticks that are resent even when acknowledged
+    resend_floor = 2
+    # Seconds between the batches sent to a spectator, unless it is catching up
+    spectator_interval = 0.25
+    # Spectators are forgotten when they didn't send a request for this long (seconds)
+    spectator_timeout = 10
+
+    def __init__(self, sock, num_players=2, max_spectators=64, spectator_delay=0):
+        self.socket = sock
+        self.num_players = num_players
+        self.max_spectators = max_spectators
+        # Ticks that spectators are kept behind the players
+        self.spectator_delay = spectator_delay
+        self.my_id = random.randrange(2**64)
+        # Ids of the players in the order they joined, and their addresses
+        self.roster = []
+        self.addrs = {}
+        self.ticks = TickBuffer()
+        # Ticks before this one are complete
+        self.complete = 0
+        self.decoder = wire.Decoder()
+        self.encoder = wire.MergedEncoder()
+        # Player id -> tick up to which it has the merged ticks
+        self.acks = {}
+        # Player id -> tick up to which we have its actions
+        self.holding = {}
+        # Player id -> (its latest clock reading, when we received it)
+        self.peer_clocks = {}
+        self.clock_start = time.monotonic()
+        self.last_broadcast = None
+        # Spectator id -> [address, tick up to which it has the merged ticks,
+        # when it last sent a request, when we last sent it ticks]
+        self.spectators = {}
+        # Spectators mostly want the same old ticks, which players no longer need
+        self.spectator_encoder = wire.MergedEncoder()
+
+    def run(self):
+        while True:
+            self.step(self.tick_duration)
+
+    def step(self, timeout=0):
+        'Handle the packets that arrive within the timeout, and send the merged ticks'
+        complete = self.complete
+        wait = timeout
+        while select.select([self.socket], [], [], wait)[0]:
+            wait = 0
+            try:
+                packet, addr = self.socket.recvfrom(wire.max_datagram_size)
+            except OSError:
+                break
+            try:
+                self.receive(packet, addr)
+            except wire.DecodeError:
+                print('dropping malformed packet from %s:%d' % addr)
+        now = time.monotonic()
+        if self.complete > complete or self.last_broadcast is None or \
+                now - self.last_broadcast >= self.tick_duration:
+            self.broadcast(now)
+
+    def receive(self, packet, addr):
+        received_at = time.monotonic()
+        if packet[:1] == bytes([wire.spectator_magic]):
+            self.spectator_request(packet, addr, received_at)
+            return
+        rejected_actions = self.decoder.rejected_actions
+        peer_id, ack, clock, ticks = self.decoder.decode(packet)
+        if self.decoder.rejected_actions > rejected_actions:
+            print('left out malformed actions from %016x (%s)' % (peer_id, self.decoder.last_rejected))
+        if peer_id not in self.addrs:
+            if len(self.roster) == self.num_players:
+                return
+            print('player %016x joined from %s:%d' % ((peer_id, ) + addr))
+            self.roster.append(peer_id)
+        self.addrs[peer_id] = addr
+        self.acks[peer_id] = max(ack, self.acks.get(peer_id, 0))
+        sent = clock[0]
+        peer_clock = self.peer_clocks.get(peer_id)
+        if peer_clock is None or sent >= peer_clock[0]:
+            self.peer_clocks[peer_id] = sent, received_at
+        for tick, actions in ticks:
+            self.ticks.setdefault(tick, {}).setdefault(peer_id, actions)
+        tick = self.holding.get(peer_id, 0)
+        while peer_id in self.ticks.get(tick, ()):
+            tick += 1
+        self.holding[peer_id] = tick
+        if len(self.roster) == self.num_players:
+            self.complete = max(self.complete, min(self.holding[x] for x in self.roster))
+
+    def spectator_request(self, packet, addr, received_at):
+        spectator_id, ack, clock = wire.read_spectator_request(packet)
+        spectator = self.spectators.get(spectator_id)
+        if spectator is None:
+            if len(self.spectators) >= self.max_spectators:
+                return
+            print('spectator %016x joined from %s:%d' % ((spectator_id, ) + addr))
+            spectator = self.spectators[spectator_id] = [addr, 0, received_at, None]
+        spectator[0] = addr
+        spectator[1] = max(spectator[1], ack)
+        spectator[2] = received_at
+        self.peer_clocks[spectator_id] = clock[0], received_at
+
+    def merged(self, tick):
+        acts = self.ticks.get(tick, {})
+        return [(peer_id, acts[peer_id]) for peer_id in self.roster]
+
+    def broadcast(self, now):
+        self.last_broadcast = now
+        if len(self.roster) < self.num_players:
+            return
+        acked = min(self.acks.get(peer_id, 0) for peer_id in self.roster)
+        self.encoder.forget(acked)
+        if not self.max_spectators:
+            self.ticks.release(acked)
+        for peer_id in self.roster:
+            start = max(self.acks.get(peer_id, 0), self.complete - self.max_window)
+            start = max(0, min(start, self.complete - self.resend_floor))
+            ticks = [(tick, self.merged(tick)) for tick in range(start, self.complete)]
+            sent, received_at = self.peer_clocks[peer_id]
+            clock = int((now - self.clock_start) * 1000), sent, int((now - received_at) * 1000)
+            packets = self.encoder.encode(
+                self.my_id, self.roster, ticks, self.holding.get(peer_id, 0), clock)
+            for packet in packets:
+                self.socket.sendto(packet, 0, self.addrs[peer_id])
+        if self.spectators:
+            self.serve_spectators(now)
+
+    def serve_spectators(self, now):
+        'Send the spectators that are due a batch the ticks they miss'
+        for spectator_id in [x for x, spectator in self.spectators.items() if now - spectator[2] > self.spectator_timeout]:
+            print('spectator %016x left' % spectator_id)
+            del self.spectators[spectator_id]
+            del self.peer_clocks[spectator_id]
+        available = self.complete - self.spectator_delay
+        if not self.spectators or available <= 0:
+            return
+        self.spectator_encoder.forget(min(spectator[1] for spectator in self.spectators.values()))
+        for spectator_id, spectator in self.spectators.items():
+            addr, ack, _, last_sent = spectator
+            catching_up = available - ack > self.max_window
+            if ack >= available or not catching_up and last_sent is not None and \
+                    now - last_sent < self.spectator_interval:
+                continue
+            spectator[3] = now
+            ticks = [(tick, self.merged(tick)) for tick in range(ack, min(available, ack + self.max_window))]
+            sent, received_at = self.peer_clocks[spectator_id]
+            clock = int((now - self.clock_start) * 1000), sent, int((now - received_at) * 1000)
+            for packet in self.spectator_encoder.encode(self.my_id, self.roster, ticks, 0, clock):
+                self.socket.sendto(packet, 0, addr)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Relay for Chess Chase games')
+    parser.add_argument('--port', type=int, default=7777)
+    parser.add_argument('--players', type=int, default=2)
+    parser.add_argument('--spectators', type=int, default=64, help='most spectators at once (0 for none)')
+    parser.add_argument('--spectator-delay', type=int, default=0, help='ticks spectators are kept behind')
+    parser.add_argument('--spectator-interval', type=float, default=Relay.spectator_interval,
+                        help='seconds between the batches sent to spectators')
+    args = parser.parse_args()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('', args.port))
+    print('relaying for %d players on port %d' % (args.players, args.port))
+    relay = Relay(sock, args.players, args.spectators, args.spectator_delay)
+    relay.spectator_interval = args.spectator_interval
+    relay.run()
@@ -0,0 +1,223 @@
+'''
+Append-only on-disk log of the actions of played matches.
+
+The log is a header followed by records, each a kind byte,
+a varint body length and the body:
+
+* MATCH: a match starts at the given tick (with the players, nicknames
+  and number of boards needed to replay it from its start).
+* TICKS: a block of consecutive ticks, zlib compressed. The body starts with
+  the first tick and the number of ticks, which index the log without
+  decompressing it.
+
+ReplayWriter buffers ticks and compresses and writes them in a background
+thread, so the frame loop only queues them. ReplayReader memory-maps a log
+and decompresses one block at a time, so replaying doesn't load the whole log.
+
+Usage: python replay_log.py LOG... (lists the matches in logs)
+'''
+
+import collections
+import mmap
+import os
+import queue
+import struct
+import sys
+import threading
+import zlib
+from bisect import bisect_right
+
+import wire
+
+header = b'CCRL\1'
+MATCH, TICKS = 1, 2
+
+Match = collections.namedtuple('Match', 'start stop players nicknames num_boards')
+
+def encode_ticks(first_tick, ticks):
+    'Body of a TICKS record holding [(tick, [(peer_id, actions)])] of consecutive ticks'
+    peer_ids = sorted({peer_id for _, acts in ticks for peer_id, _ in acts})
+    peer_index = {peer_id: i for i, peer_id in enumerate(peer_ids)}
+    data = bytearray()
+    wire.write_varint(data, len(peer_ids))
+    for peer_id in peer_ids:
+        data += struct.pack('<Q', peer_id)
+    for _, acts in ticks:
+        wire.write_varint(data, len(acts))
+        for peer_id, actions in acts:
+            wire.write_varint(data, peer_index[peer_id])
+            data += wire.encode_actions(actions)
+    body = bytearray()
+    wire.write_varint(body, first_tick)
+    wire.write_varint(body, len(ticks))
+    return bytes(body) + zlib.compress(data)
+
+def decode_ticks(r, num_ticks):
+    'Decode the ticks of a decompressed TICKS record'
+    peer_ids = [struct.unpack('<Q', r.bytes(8))[0] for _ in range(r.varint())]
+    result = []
+    for _ in range(num_ticks):
+        acts = []
+        for _ in range(r.varint()):
+            peer_id = peer_ids[r.varint()]
+            # Logs hold the actions as they were executed, which
+            # before action_registry.py may include malformed ones
+            acts.append((peer_id, r.actions(check=False)))
+        result.append(acts)
+    return result
+
+def record(kind, body):
+    out = bytearray([kind])
+    wire.write_varint(out, len(body))
+    return bytes(out + body)
+
+class ReplayWriter:
+    'Appends matches to a log file, writing from a background thread'
+
+    # Ticks per compressed block
+    block_ticks = 256
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(header)
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.write_thread_go, daemon=True)
+        self.thread.start()
+
+    def start_match(self, tick, players, nicknames, num_boards):
+        self.queue.put((MATCH, (tick, players, nicknames, num_boards)))
+
+    def append(self, tick, acts):
+        'Log the actions ``[(peer_id, actions)]`` executed on a tick'
+        self.queue.put((TICKS, (tick, acts)))
+
+    def flush(self):
+        'Write everything appended so far (blocks until written)'
+        done = threading.Event()
+        self.queue.put((None, done))
+        done.wait()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+    def write_thread_go(self):
+        ticks = []
+
+        def write_block():
+            if ticks:
+                self.file.write(record(TICKS, encode_ticks(ticks[0][0], ticks)))
+                ticks.clear()
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            kind, data = item
+            if kind == TICKS:
+                if ticks and data[0] != ticks[-1][0] + 1:
+                    write_block()
+                ticks.append(data)
+                if len(ticks) >= self.block_ticks:
+                    write_block()
+            elif kind == MATCH:
+                write_block()
+                tick, players, nicknames, num_boards = data
+                body = bytearray()
+                wire.write_varint(body, tick)
+                wire.write_value(body, sorted(players.items()))
+                wire.write_value(body, sorted(nicknames.items()))
+                wire.write_varint(body, num_boards)
+                self.file.write(record(MATCH, body))
+            else:
+                write_block()
+                self.file.flush()
+                data.set()
+
+class ReplayReader:
+    '''
+    Reads a log, possibly while it is still being written.
+
+    Only the record headers are read on opening,
+    a block of ticks is decompressed when one of its ticks is read.
+    '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        if self.data[:len(header)] != header:
+            raise wire.DecodeError('not a replay log')
+        self.matches = []
+        # (first tick, number of ticks, body offset, body end)
+        self.blocks = []
+        self.cached = None
+        r = wire.Reader(self.data)
+        r.pos = len(header)
+        while not r.at_end():
+            try:
+                kind = r.byte()
+                end = r.varint()
+                end += r.pos
+            except wire.DecodeError:
+                break
+            if end > len(self.data):
+                # A record cut short by the writer exiting
+                break
+            if kind == MATCH:
+                start = r.varint()
+                self.matches.append(Match(
+                    start, start, dict(r.value()), dict(r.value()), r.varint()))
+            elif kind == TICKS and self.matches:
+                first_tick = r.varint()
+                num_ticks = r.varint()
+                self.blocks.append((first_tick, num_ticks, r.pos, end))
+                self.matches[-1] = self.matches[-1]._replace(stop=first_tick + num_ticks)
+            r.pos = end
+        self.block_starts = [block[0] for block in self.blocks]
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def block(self, i):
+        if self.cached is None or self.cached[0] != i:
+            first_tick, num_ticks, start, end = self.blocks[i]
+            r = wire.Reader(zlib.decompress(self.data[start:end]))
+            self.cached = i, decode_ticks(r, num_ticks)
+        return self.cached[1]
+
+    def actions_at(self, tick):
+        'The ``[(peer_id, actions)]`` executed on a tick'
+        i = bisect_right(self.block_starts, tick) - 1
+        if i < 0:
+            return []
+        first_tick, num_ticks, _, _ = self.blocks[i]
+        if tick >= first_tick + num_ticks:
+            return []
+        return self.block(i)[tick - first_tick]
+
+    def ticks(self, start=0, stop=None):
+        'Iterate over the logged ``(tick, [(peer_id, actions)])`` in a range of ticks'
+        for i, (first_tick, num_ticks, _, _) in enumerate(self.blocks):
+            if first_tick + num_ticks <= start:
+                continue
+            if stop is not None and first_tick >= stop:
+                break
+            for tick, acts in enumerate(self.block(i), first_tick):
+                if start <= tick and (stop is None or tick < stop):
+                    yield tick, acts
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        reader = ReplayReader(path)
+        print(path)
+        for match in reader.matches:
+            actions = sum(len(actions) for _, acts in reader.ticks(match.start, match.stop) for _, actions in acts)
+            print('  ticks %d-%d, %d boards, %d players, %d actions' % (
+                match.start, match.stop, match.num_boards, len(match.players), actions))
+        reader.close()
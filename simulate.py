@@ -0,0 +1,164 @@
+'''
+Headless simulation of games between NetEngines in one process.
+
+Players connected by an in-memory network (transport.LoopbackNetwork)
+make random moves (or are bots, see bot.py), and the simulation runs as fast as the CPU allows on a
+simulated clock. Everything random is seeded, so a run is reproduced
+exactly by its arguments, and the peers' final state hashes (which must
+all be equal) tell whether an engine change altered the game.
+
+Usage: python simulate.py [--players N] [--ticks T] [--seed S]
+                          [--latency MS] [--loss P] [--rollback] [--metrics PATH]
+                          [--bots STRENGTH]
+'''
+
+import argparse
+import random
+import time
+
+from bot import Bot
+from game_model import GameModel
+from metrics import Metrics
+from net_engine import NetEngine
+from transport import LoopbackNetwork
+
+class Simulation:
+    # Chance that a player moves on a frame
+    move_rate = 0.3
+    # Replay ticks per frame after a king is captured
+    replay_speed = 100
+
+    def __init__(self, num_players=2, seed=0, latency=0.03, loss=0, rollback=False, bots=None):
+        self.random = random.Random(seed)
+        self.now = 0
+        self.network = LoopbackNetwork(self.clock, latency, loss, self.random.getrandbits(64))
+        self.engines = []
+        # Bots of the players (when they aren't random), searching synchronously
+        # with a node budget only, so that games are reproduced exactly
+        self.bots = []
+        self.actions = 0
+        self.games = 0
+        # Metrics of the first player (see instrument)
+        self.metrics = None
+        addrs = [('sim', i) for i in range(num_players)]
+        for addr in addrs:
+            game = GameModel()
+            game.add_message = lambda msg: None
+            game.init((num_players + 1) // 2)
+            game.mode = 'play'
+            net_engine = NetEngine(game)
+            net_engine.clock = self.clock
+            net_engine.reset()
+            net_engine.rollback = rollback
+            net_engine.replay_speed = self.replay_speed
+            game.my_id = self.random.getrandbits(64)
+            game.king_captured = self.king_captured_callback(net_engine)
+            net_engine.transport = self.network.transport(addr, net_engine.decoder.decode)
+            net_engine.peers = [x for x in addrs if x != addr]
+            self.engines.append(net_engine)
+            if bots is not None:
+                self.bots.append(Bot(game, bots, self.random.getrandbits(64), worker=False, time_budget=None))
+
+    def instrument(self):
+        'Collect the metrics of the first player, per frame'
+        net_engine = self.engines[0]
+        self.metrics = Metrics()
+        self.metrics.instrument(net_engine, 'communicate')
+        self.metrics.instrument(net_engine, 'act')
+        self.metrics.add_source('net', net_engine.stats)
+        net_engine.action_timings = {}
+        self.metrics.add_source('actions', net_engine.action_stats)
+        return self.metrics
+
+    def clock(self):
+        return self.now
+
+    def king_captured_callback(self, net_engine):
+        def king_captured(who):
+            if net_engine.game.mode == 'replay':
+                return
+            if net_engine is self.engines[0]:
+                self.games += 1
+            net_engine.start_replay()
+        return king_captured
+
+    def move(self, game):
+        'Queue a random move of one of the player\'s pieces'
+        player = game.player()
+        if player is None or game.mode != 'play' or self.random.random() >= self.move_rate:
+            return
+        pieces = sorted(game.attack_map.pieces_of(player), key=lambda piece: piece.pos)
+        if not pieces:
+            return
+        piece = self.random.choice(pieces)
+        moves = sorted(piece.moves())
+        if moves:
+            game.add_action('move', piece.pos, self.random.choice(moves))
+            self.actions += 1
+
+    def run(self, ticks, until=None):
+        '''
+        Run until all players executed the given number of ticks, or until() is true.
+
+        Players that got there only keep communicating (and confirming the ticks
+        they executed ahead in rollback mode), for the others to catch up.
+        '''
+        def arrived(net_engine):
+            return net_engine.game.counter >= ticks and net_engine.game.mode == 'play'
+        while not all(arrived(x) and not x.speculated for x in self.engines):
+            if until is not None and until():
+                return
+            for i, net_engine in enumerate(self.engines):
+                if arrived(net_engine):
+                    net_engine.communicate()
+                    net_engine.reconcile()
+                    continue
+                if self.bots:
+                    queued = len(net_engine.game.cur_actions)
+                    self.bots[i].update()
+                    self.actions += len(net_engine.game.cur_actions) - queued
+                else:
+                    self.move(net_engine.game)
+                net_engine.iteration()
+            if self.metrics is not None:
+                self.metrics.end_tick()
+            self.now += NetEngine.tick_duration
+
+    def hashes(self):
+        return [net_engine.game.state_hash() for net_engine in self.engines]
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless simulation of Chess Chase games')
+    parser.add_argument('--players', type=int, default=2)
+    parser.add_argument('--ticks', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=30, help='one-way latency in milliseconds')
+    parser.add_argument('--loss', type=float, default=0, help='share of packets lost')
+    parser.add_argument('--rollback', action='store_true')
+    parser.add_argument('--metrics', help='JSON-lines file for the first player\'s metrics')
+    parser.add_argument('--bots', type=int, choices=sorted(Bot.strengths), help='bots of this strength play')
+    args = parser.parse_args()
+    simulation = Simulation(args.players, args.seed, args.latency / 1000, args.loss, args.rollback, args.bots)
+    if args.metrics:
+        simulation.instrument().log_to(args.metrics)
+    start = time.perf_counter()
+    simulation.run(args.ticks)
+    elapsed = time.perf_counter() - start
+    stats = simulation.engines[0].stats()
+    print('%d players, %d ticks (%.0f s simulated) in %.2f s: %.0f ticks/s, %.0f actions/s' % (
+        args.players, args.ticks, simulation.now, elapsed,
+        args.ticks / elapsed, simulation.actions / elapsed))
+    print('%d games, %d packets of %.1f bytes on average, delay %d ticks, %d stalls' % (
+        simulation.games, simulation.network.packets_sent,
+        simulation.network.bytes_sent / max(1, simulation.network.packets_sent),
+        stats['delay'], stats['stalls']))
+    if simulation.metrics is not None:
+        simulation.metrics.close()
+    hashes = simulation.hashes()
+    print('state hash %s' % ' '.join('%016x' % h for h in hashes))
+    if len(set(hashes)) > 1:
+        print('DESYNC: the players\' states differ')
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,54 @@
+import contextlib
+import io
+import json
+import os
 import random
+import shutil
 import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib.request
 
+import batch
+import bench
+import wire
+from bot import Bot
 from game_model import GameModel
+from match_server import MatchServer
+from matchmaking import MatchClient, MatchError
 from net_engine import NetEngine
+from relay import Relay
+from replay_log import ReplayReader, ReplayWriter
+from simulate import Simulation
+from tick_buffer import TickBuffer
+from transport import LoopbackNetwork, UdpTransport
+
+def poll(condition, step, timeout=5):
+    'Call step until the condition holds or the timeout passes, returning whether it holds'
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        step()
+    return condition()
 
 class GameInstance:
-    def __init__(self):
+    def __init__(self, network=None, addr=None):
         self.game = GameModel()
         self.game.king_captured = self.king_captured
         self.game.init()
         self.game.mode = 'play'
         self.game.add_message = print
         self.net_engine = NetEngine(self.game)
-        self.init_net_engine_socket()
+        if network is None:
+            self.init_net_engine_socket()
+            return
+        self.net_engine.clock = network.clock
+        self.net_engine.reset()
+        self.game.my_id = network.random.getrandbits(64)
+        self.net_engine.transport = network.transport(addr, self.net_engine.decoder.decode)
 
     def king_captured(self, who):
         if self.game.mode != 'replay':
@@ -30,28 +65,811 @@ class GameInstance:
                 continue
             break
 
+class TestBoardEngines(unittest.TestCase):
+    def test_same_moves(self):
+        rand = random.Random(0)
+        games = [GameModel(board_engine=engine) for engine in ['dict', 'array']]
+        for game in games:
+            game.init(num_boards=2)
+        for _ in range(1000):
+            for game in games:
+                game.counter += 1
+            pieces = [sorted(game.board.items()) for game in games]
+            self.assertEqual(
+                [[(pos, type(piece)) for pos, piece in x] for x in pieces[1:]],
+                [[(pos, type(piece)) for pos, piece in x] for x in pieces[:1]])
+            for (pos, a), (_, b) in zip(*pieces):
+                self.assertEqual(sorted(a.base_moves()), sorted(b.base_moves()), pos)
+                self.assertEqual(sorted(a.sight()), sorted(b.sight()), pos)
+            (src, piece) = rand.choice(pieces[0])
+            opts = sorted(piece.moves())
+            if not opts:
+                continue
+            dst = rand.choice(opts)
+            for game in games:
+                game.action_move(None, src, dst)
+
+class TestAttackMap(unittest.TestCase):
+    def test_matches_generators(self):
+        for engine in ['dict', 'array']:
+            rand = random.Random(1)
+            game = GameModel(board_engine=engine)
+            game.init(num_boards=2)
+            for step in range(1500):
+                game.counter += 1
+                if step % 10 == 0:
+                    for side in range(2):
+                        pieces = [x for x in game.board.values() if x.side() == side]
+                        see = {x.pos for x in pieces}
+                        see.update(pos for x in pieces for pos in x.sight())
+                        self.assertEqual(game.attack_map.visible(side), see)
+                        threats = {pos for x in pieces for pos in x.base_moves()}
+                        for pos in game.attack_map.tables.positions:
+                            self.assertEqual(game.attack_map.attacks(side, pos), pos in threats)
+                (src, piece) = rand.choice(sorted(game.board.items()))
+                opts = sorted(piece.moves())
+                if opts:
+                    game.action_move(None, src, rand.choice(opts))
+
+    def test_en_passant(self):
+        for engine in ['dict', 'array']:
+            game = GameModel(board_engine=engine)
+            game.king_captured = lambda who: None
+            game.init()
+            game.counter = 100
+            game.action_move(None, (4, 1), (4, 3))
+            game.counter = 200
+            game.action_move(None, (4, 3), (4, 4))
+            game.counter = 300
+            game.action_move(None, (3, 6), (3, 4))
+            game.counter = 400
+            pawn = game.board[4, 4]
+            # Captured on the file of the pawn taken, not the other side's
+            self.assertIn((3, 5), pawn.moves())
+            self.assertNotIn((5, 5), pawn.moves())
+            game.action_move(None, (4, 4), (3, 5))
+            self.assertIs(game.board[3, 5], pawn)
+            self.assertNotIn((3, 4), game.board)
+
+class TestMoveCache(unittest.TestCase):
+    def test_cache_follows_cooldowns(self):
+        rand = random.Random(2)
+        game = GameModel()
+        game.init()
+        for _ in range(2000):
+            game.counter += rand.choice([0, 1, 5])
+            pieces = sorted(game.board.items())
+            for _pos, piece in pieces:
+                self.assertEqual(piece.moves(), piece._legal_moves())
+                expected = () if piece.cooling_down() else tuple(piece.base_moves())
+                self.assertEqual(piece.moves(), expected)
+            (src, piece) = rand.choice(pieces)
+            if piece.moves():
+                game.action_move(None, src, rand.choice(piece.moves()))
+        self.assertGreater(game.move_cache.hits, 0)
+        self.assertGreater(game.move_cache.misses, 0)
+        self.assertGreater(game.attack_map.hits, 0)
+        self.assertGreater(game.attack_map.misses, 0)
+
+class TestPerft(unittest.TestCase):
+    def test_node_counts(self):
+        for engine in ['dict', 'array']:
+            counts = {key: bench.perft_result(game) for key, game in bench.perft_games(engine)}
+            self.assertEqual(counts, bench.perft_counts, engine)
+
+class TestActions(unittest.TestCase):
+    def test_dispatch(self):
+        game = GameModel()
+        game.init()
+        game.mode = 'play'
+        net_engine = NetEngine(game)
+        net_engine.action_timings = {}
+        # Malformed actions are rejected when queued
+        game.add_action('nick')
+        game.add_action('become', 'white')
+        game.add_action('dance')
+        self.assertEqual(game.cur_actions, [])
+        self.assertEqual(game.messages[-3:], [
+            'nick: takes 1 parameters, not 0', "become: bad parameter 1: 'white'", 'dance: no such action'])
+        game.add_action('nick', 'alice')
+        game.add_action('move', (4, 1), (4, 3))
+        game.counter = NetEngine.start_latency + 1
+        net_engine.execute([(game.my_id, game.cur_actions)])
+        self.assertEqual(game.nick(game.my_id), 'alice')
+        self.assertIn((4, 3), game.board)
+        self.assertEqual(sorted(net_engine.action_stats()), ['move.calls', 'move.ms', 'nick.calls', 'nick.ms'])
+        self.assertEqual(net_engine.action_failures, 0)
+        # Replays of old logs may have actions without a handler
+        net_engine.execute([(game.my_id, [('dance', ())])])
+        self.assertEqual(net_engine.action_failures, 1)
+
+class TestArena(unittest.TestCase):
+    def test_regions(self):
+        game = GameModel()
+        game.init(num_boards=5)
+        self.assertEqual(game.board_size, [40, 8])
+        for player in range(10):
+            self.assertEqual(len(game.attack_map.pieces_of(player)), 16)
+        for region in game.attack_map.region_pieces:
+            self.assertEqual(len(region), 32)
+        game.attack_map.flush()
+        game.counter = 1000
+        game.action_move(None, (12, 1), (12, 3))
+        self.assertEqual({game.attack_map.region_of(x.pos) for x in game.attack_map.dirty}, {1})
+
+class TestSnapshot(unittest.TestCase):
+    def test_restore(self):
+        rand = random.Random(3)
+        game = GameModel()
+        game.init(num_boards=2)
+        snapshots = []
+        for _ in range(1000):
+            game.counter += 1
+            if rand.random() < 0.05:
+                snapshots.append((game.snapshot(), sorted((pos, piece.moves()) for pos, piece in game.board.items())))
+            (src, piece) = rand.choice(sorted(game.board.items()))
+            if piece.moves():
+                game.action_move(None, src, rand.choice(piece.moves()))
+        for snapshot, moves in snapshots:
+            game.restore(snapshot)
+            self.assertEqual(game.snapshot(), snapshot)
+            self.assertEqual(sorted((pos, piece.moves()) for pos, piece in game.board.items()), moves)
+
+class TestWire(unittest.TestCase):
+    def round_trip(self, ticks, **kwargs):
+        decoder = wire.Decoder()
+        result = []
+        packets = wire.encode(12345678901234567890, ticks, ack=777, clock=(300000, 299000, 12), **kwargs)
+        for packet in reversed(packets):
+            sender_id, ack, clock, decoded = decoder.decode(packet)
+            self.assertEqual(sender_id, 12345678901234567890)
+            self.assertEqual(ack, 777)
+            self.assertEqual(clock, (300000, 299000, 12))
+            result += decoded
+        self.assertEqual(sorted(result, key=lambda x: x[0]), ticks)
+        return packets
+
+    def test_round_trip(self):
+        ticks = [
+            (1000, []),
+            (1001, [('move', ((3, 1), (3, 3)))]),
+            (1002, [('msg', ('hello', 'world')), ('become', (1, ))]),
+            (1003, []),
+            (1004, [('hash', (1004, 2**64 - 1)), ('delay', (-5, ))]),
+            ]
+        packets = self.round_trip(ticks)
+        decoder = wire.Decoder()
+        self.assertEqual(decoder.decode(packets[0])[3], ticks)
+        self.assertEqual(decoder.decode(packets[0])[3], [])
+        self.assertEqual(wire.Encoder().encode(5, ticks), wire.encode(5, ticks))
+
+    def test_values(self):
+        actions = [('custom', (None, True, False, -5, 2.5, [(1, 2)], (16, 9), 'שלום'))]
+        body = wire.encode_actions(actions)
+        self.assertEqual(wire.Reader(body).actions(check=False), actions)
+        # Actions are checked against their schemas when received, and malformed ones left out
+        good = [('move', ((1, 2), (1, 3)))]
+        for bad in [actions, [('move', ((1, 2), ))], [('move', ((1, 2), 'x'))], [('become', ('x', ))]]:
+            rejected = []
+            self.assertEqual(wire.decode_actions(wire.encode_actions(bad + good), rejected), good)
+            self.assertEqual(len(rejected), 1)
+            self.assertTrue(rejected[0].startswith(bad[0][0] + ': '))
+
+    def test_empty_ticks(self):
+        packets = self.round_trip([(i, []) for i in range(70000, 70010)])
+        self.assertEqual(len(packets), 1)
+        self.assertLessEqual(len(packets[0]), 2+8+2+3+3+2+3+10)
+
+    def test_ack_only(self):
+        packets = wire.encode(3, [], ack=1000)
+        self.assertEqual(len(packets), 1)
+        self.assertEqual(wire.decode(packets[0]), (3, 1000, (0, None, 0), [], []))
+
+    def test_fragments(self):
+        chat = [('msg', ('x' * 300, )) for _ in range(20)]
+        packets = self.round_trip([(5, []), (6, chat), (7, chat[:2]), (8, [])])
+        self.assertGreater(len(packets), 1)
+        self.assertTrue(all(len(packet) <= wire.max_packet_size for packet in packets))
+
+    def test_merged(self):
+        roster = [7, 2**64-1, 12345]
+        chat = [('msg', ('x' * 300, )) for _ in range(10)]
+        ticks = [
+            (40, [(7, []), (2**64-1, []), (12345, [])]),
+            (41, [(7, [('move', ((3, 1), (3, 3)))]), (2**64-1, chat), (12345, [('delay', (4, ))])]),
+            ]
+        packets = wire.MergedEncoder().encode(99, roster, ticks, ack=3, clock=(10, 5, 1))
+        self.assertGreater(len(packets), 1)
+        decoder = wire.MergedDecoder()
+        result = []
+        for packet in reversed(packets):
+            sender_id, ack, clock, packet_roster, decoded = decoder.decode(packet)
+            self.assertEqual((sender_id, ack, clock, packet_roster), (99, 3, (10, 5, 1), roster))
+            result += decoded
+        self.assertEqual(sorted(result), ticks)
+        with self.assertRaises(wire.DecodeError):
+            wire.decode(packets[0])
+
+    def test_malformed(self):
+        packet = wire.encode(1, [(5, [('msg', ('hello', ))])])[0]
+        for bad in [b'', packet[:-1], b'\0' + packet[1:], packet + b'\xff']:
+            with self.assertRaises(wire.DecodeError):
+                wire.decode(bad)
+
+    def test_resend_after_malformed(self):
+        # The packet with a corrupt second entry is dropped, so a resend of its first entry is new
+        good = [(5, [('move', ((1, 2), (1, 3)))])]
+        [(kind, body)] = wire.tick_entries(good[0][1])
+        corrupt = wire.varint_bytes(2) + wire.encode_actions([]) + b'\0'
+        decoder = wire.Decoder()
+        with self.assertRaises(wire.DecodeError):
+            decoder.decode(wire.pack(1, [(5, kind, body), (6, wire.ACTIONS, corrupt)])[0])
+        self.assertEqual(decoder.decode(wire.pack(1, [(5, kind, body)])[0])[3], good)
+        # And likewise for merged packets, with a bad roster index
+        merged = [(5, [(7, good[0][1])])]
+        [(kind, body)] = wire.merged_tick_entries(merged[0][1], {7: 0})
+        corrupt = wire.varint_bytes(3) + wire.varint_bytes(1) + wire.varint_bytes(4) + wire.encode_actions([])
+        decoder = wire.MergedDecoder()
+        with self.assertRaises(wire.DecodeError):
+            decoder.decode(wire.pack(1, [(5, kind, body), (6, wire.ACTIONS, corrupt)], roster=[7])[0])
+        self.assertEqual(decoder.decode(wire.pack(1, [(5, kind, body)], roster=[7])[0])[4], merged)
+
+class TestTickBuffer(unittest.TestCase):
+    def test_spill(self):
+        buffer = TickBuffer(capacity=16)
+        expected = {}
+        for tick in range(200):
+            if tick % 7 == 3:
+                # A gap
+                continue
+            acts = buffer.setdefault(tick, {})
+            acts[5] = [('move', ((tick % 16, 1), (tick % 16, 3)))] if tick % 3 else []
+            acts[2**63 + tick % 2] = [('msg', ('hi', tick))]
+            expected[tick] = acts
+            if tick == 100:
+                buffer.release(60)
+        self.assertEqual(dict(buffer), {tick: acts for tick, acts in expected.items() if tick >= 60})
+        self.assertNotIn(30, buffer)
+        buffer.release(152)
+        self.assertEqual(min(buffer), 152)
+        self.assertEqual(buffer[198], expected[198])
+        # Dropped ticks can't be written back
+        buffer[20] = {}
+        self.assertNotIn(20, buffer)
+
+class TestReplayLog(unittest.TestCase):
+    def test_blocks(self):
+        ticks = [(t, [(1, [('move', ((t % 8, 1), (t % 8, 2)))] if t % 3 else []), (2**64-1, [])]) for t in range(30, 60)]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'log')
+            writer = ReplayWriter(path)
+            writer.block_ticks = 4
+            writer.start_match(30, {1: 0, 2**64-1: 1}, {1: 'bob'}, 2)
+            for tick, acts in ticks:
+                writer.append(tick, acts)
+            writer.close()
+            reader = ReplayReader(path)
+            self.assertEqual(reader.matches, [((30, 60, {1: 0, 2**64-1: 1}, {1: 'bob'}, 2))])
+            self.assertEqual(list(reader.ticks()), ticks)
+            self.assertEqual(reader.actions_at(45), ticks[15][1])
+            self.assertEqual(reader.actions_at(60), [])
+            reader.close()
+            # A log cut short keeps its complete blocks
+            with open(path, 'rb') as f:
+                data = f.read()
+            with open(path, 'wb') as f:
+                f.write(data[:-5])
+            reader = ReplayReader(path)
+            self.assertEqual(list(reader.ticks()), ticks[:28])
+            reader.close()
+
+    def test_play_recorded(self):
+        rand = random.Random(6)
+        with tempfile.TemporaryDirectory() as replay_dir:
+            instances = [GameInstance() for _ in range(2)]
+            instances[0].net_engine.replay_dir = replay_dir
+            for i in range(2):
+                instances[i].net_engine.peers = [('127.0.0.1', instances[1-i].port)]
+            for i in range(400):
+                inst = instances[i % 2]
+                inst.net_engine.iteration()
+                (src, piece) = rand.choice(sorted(inst.game.board.items()))
+                opts = sorted(piece.moves())
+                if opts:
+                    inst.game.add_action('move', src, rand.choice(opts))
+            game = instances[0].game
+            instances[0].net_engine.stop()
+            self.assertEqual(game.mode, 'play')
+            [name] = os.listdir(replay_dir)
+            viewer = GameModel()
+            viewer.add_message = lambda msg: None
+            net_engine = NetEngine(viewer)
+            net_engine.play_recorded(os.path.join(replay_dir, name))
+            while viewer.mode == 'replay':
+                net_engine.act()
+            self.assertEqual(viewer.players, game.players)
+            self.assertEqual(viewer.snapshot(), game.snapshot())
+
+class TestSeek(unittest.TestCase):
+    def test_seek(self):
+        rand = random.Random(4)
+        inst = GameInstance()
+        net_engine = inst.net_engine
+        net_engine.keyframe_interval = 50
+        hashes = {}
+        while inst.game.counter < 600:
+            (src, piece) = rand.choice(sorted(inst.game.board.items()))
+            opts = sorted(piece.moves())
+            if opts and rand.random() < 0.5:
+                inst.game.add_action('move', src, rand.choice(opts))
+            net_engine.iteration()
+            hashes[inst.game.counter] = inst.game.state_hash()
+        net_engine.start_replay()
+        net_engine.iteration()
+        self.assertEqual(inst.game.mode, 'replay')
+        self.assertEqual(sorted(net_engine.keyframes), list(range(50, 601, 50)))
+        # Forward, backward, before the first keyframe and between keyframes
+        for tick in [420, 130, 20, 333, 340, 599]:
+            net_engine.seek(tick)
+            self.assertEqual(inst.game.counter, tick)
+            self.assertEqual(inst.game.state_hash(), hashes[tick])
+        net_engine.seek(100)
+        net_engine.replay_speed = 2.5
+        for _ in range(4):
+            net_engine.iteration()
+        # Ten ticks were executed (idle ones are skipped through faster)
+        self.assertGreaterEqual(inst.game.counter, 110)
+        self.assertEqual(inst.game.state_hash(), hashes[inst.game.counter])
+
+    def test_seek_rollback(self):
+        simulation = Simulation(2, seed=2, latency=0.15, rollback=True)
+        for net_engine in simulation.engines:
+            # An input delay shorter than the latency, so that most ticks are executed ahead
+            net_engine.max_latency = NetEngine.min_latency
+        net_engine = simulation.engines[0]
+        net_engine.keyframe_interval = 50
+        simulation.run(600)
+        self.assertGreater(net_engine.rollbacks, 0)
+        # Ticks confirmed after being executed ahead have keyframes too
+        self.assertEqual(sorted(net_engine.keyframes), list(range(50, 601, 50)))
+        net_engine.start_replay()
+        net_engine.iteration()
+        self.assertEqual(net_engine.game.mode, 'replay')
+        keyframes = net_engine.keyframes
+        for tick in [420, 130, 20, 333, 599]:
+            net_engine.seek(tick)
+            seeked = net_engine.game.state_hash()
+            # The same as executing from the start
+            net_engine.keyframes = {}
+            net_engine.seek(0)
+            net_engine.seek(tick)
+            self.assertEqual(net_engine.game.state_hash(), seeked)
+            net_engine.keyframes = keyframes
+
 class TestSync(unittest.TestCase):
     def test_sync(self):
-        instances = [GameInstance() for _ in range(2)]
+        # Engines on a loopback network and a simulated clock, so that the run is reproducible
+        rand = random.Random(1)
+        now = [0]
+        network = LoopbackNetwork(lambda: now[0], 0.03, 0.05, rand.getrandbits(64))
+        instances = []
         for i in range(2):
-            other = 1-i
-            instances[i].net_engine.peers = [('127.0.0.1', instances[other].port)]
-        for i in range(1000000):
-            inst = random.choice(instances)
-            r = random.random()
+            inst = GameInstance(network, ('loop', i))
+            inst.net_engine.peers = [('loop', 1-i)]
+            instances.append(inst)
+        for i in range(30000):
+            now[0] += NetEngine.tick_duration / 3
+            inst = rand.choice(instances)
+            r = rand.random()
             if r < 0.3:
                 inst.net_engine.iteration()
-            elif r < 0.99999:
+            elif r < 0.999:
                 if len(inst.game.cur_actions) > 3:
                     continue
-                (src, piece) = random.choice(list(inst.game.board.items()))
-                opts = list(piece.moves())
+                (src, piece) = rand.choice(sorted(inst.game.board.items()))
+                opts = sorted(piece.moves())
                 if not opts:
                     continue
-                dst = random.choice(opts)
+                dst = rand.choice(opts)
                 inst.game.add_action('move', src, dst)
             else:
                 inst.game.add_action('surrender')
+        for inst in instances:
+            self.assertEqual(inst.net_engine.desyncs, [])
+        self.assertGreater(min(inst.game.counter for inst in instances), 1000)
+
+    def test_acks(self):
+        instances = [GameInstance() for _ in range(2)]
+        for i in range(2):
+            instances[i].net_engine.peers = [('127.0.0.1', instances[1-i].port)]
+            # Keep the input delay fixed
+            instances[i].net_engine.min_latency = NetEngine.start_latency
+        def iterate():
+            for inst in instances:
+                inst.net_engine.iteration()
+        self.assertTrue(poll(lambda: min(inst.game.counter for inst in instances) >= 50, iterate))
+        def acked():
+            # Each side holds everything the other sent before its window
+            return all(
+                instances[i].net_engine.holding[instances[1-i].game.my_id] >= instances[i].game.counter and
+                instances[i].net_engine.peer_acks[instances[1-i].game.my_id] >= instances[i].game.counter - 1
+                for i in range(2))
+        # Packets are received by the transport thread, communicate until they all arrived
+        self.assertTrue(poll(acked, lambda: [inst.net_engine.communicate() for inst in instances]))
+        for inst in instances:
+            inst.net_engine.stop()
+
+    def test_adaptive_delay(self):
+        instances = [GameInstance() for _ in range(2)]
+        for i in range(2):
+            instances[i].net_engine.peers = [('127.0.0.1', instances[1-i].port)]
+        for _ in range(100):
+            for inst in instances:
+                inst.net_engine.iteration()
+            time.sleep(0.002)
+        engines = [inst.net_engine for inst in instances]
+        # Both executed the same proposals, and a local connection needs less than the start delay
+        self.assertEqual(engines[0].delay_proposals, engines[1].delay_proposals)
+        self.assertEqual(len(engines[0].delay_proposals), 2)
+        for net_engine in engines:
+            self.assertLess(net_engine.stats()['delay'], NetEngine.start_latency)
+            self.assertLess(max(net_engine.rtt.values()), 0.1)
+
+    def test_rollback(self):
+        instances = [GameInstance() for _ in range(2)]
+        for i in range(2):
+            instances[i].net_engine.peers = [('127.0.0.1', instances[1-i].port)]
+            instances[i].net_engine.rollback = True
+            # Keep both in the same game
+            instances[i].game.king_captured = lambda who: None
+        rand = random.Random(5)
+        target = 300
+        while any(inst.game.counter < target or inst.net_engine.speculated for inst in instances):
+            # The first runs three times as often, so it executes ticks before the other's actions arrive
+            for inst in instances[:1] * 3 + instances[1:]:
+                if inst.game.counter >= target:
+                    inst.net_engine.communicate()
+                    inst.net_engine.reconcile()
+                    continue
+                inst.net_engine.iteration()
+                (src, piece) = rand.choice(sorted(inst.game.board.items()))
+                opts = sorted(piece.moves())
+                if opts and rand.random() < 0.3:
+                    inst.game.add_action('move', src, rand.choice(opts))
+            time.sleep(0.001)
+        engines = [inst.net_engine for inst in instances]
+        self.assertGreater(engines[0].rollbacks, 0)
+        self.assertLessEqual(engines[0].rollback_depth, NetEngine.max_rollback)
+        self.assertEqual(instances[0].game.players, instances[1].game.players)
+        self.assertEqual(instances[0].game.snapshot(), instances[1].game.snapshot())
+
+    def test_desync(self):
+        instances = [GameInstance() for _ in range(2)]
+        replay_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, replay_dir)
+        for i in range(2):
+            instances[i].net_engine.peers = [('127.0.0.1', instances[1-i].port)]
+            instances[i].net_engine.replay_dir = replay_dir
+        for step in range(300):
+            if step == 100:
+                # A pawn dies on one side only
+                instances[0].game.board[1, 1].die()
+            for inst in instances:
+                inst.net_engine.iteration()
+            time.sleep(0.001)
+        for inst in instances:
+            desyncs = inst.net_engine.desyncs
+            self.assertEqual(len(desyncs), 1)
+            self.assertGreater(desyncs[0], 90)
+            path = os.path.join(replay_dir, 'desync-%d-%016x.txt' % (desyncs[0], inst.game.my_id))
+            with open(path) as f:
+                self.assertEqual('(1, 1)' in f.read(), inst is instances[1])
+        for inst in instances:
+            inst.net_engine.stop()
+
+class TestTransport(unittest.TestCase):
+    def test_udp(self):
+        def decode(packet):
+            if packet == b'bad':
+                raise wire.DecodeError('malformed')
+            return packet
+        sockets = []
+        transports = []
+        for _ in range(2):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            sockets.append(sock)
+            transports.append(UdpTransport(sock, decode))
+        a, b = transports
+        b_addr = sockets[1].getsockname()
+        received = []
+        def receive():
+            received.extend(b.receive())
+        a.send(b'hello', b_addr)
+        self.assertTrue(poll(lambda: received, receive))
+        [(addr, packet, received_at)] = received
+        self.assertEqual((addr, packet), (sockets[0].getsockname(), b'hello'))
+        self.assertLessEqual(received_at, time.monotonic())
+        # A malformed packet is dropped, and the thread goes on receiving
+        del received[:]
+        with contextlib.redirect_stdout(io.StringIO()):
+            a.send(b'bad', b_addr)
+            a.send(b'good', b_addr)
+            self.assertTrue(poll(lambda: received, receive))
+        self.assertEqual([x[1] for x in received], [b'good'])
+        self.assertTrue(b.thread.is_alive())
+        self.assertEqual((a.packets_sent, b.packets_received), (3, 3))
+        for transport in transports:
+            transport.close()
+            transport.thread.join(5)
+            self.assertFalse(transport.thread.is_alive())
+        for sock in sockets:
+            sock.close()
+
+class TestSimulation(unittest.TestCase):
+    def test_reproducible(self):
+        hashes = []
+        for _ in range(2):
+            simulation = Simulation(3, seed=4, loss=0.1)
+            simulation.run(600)
+            hashes.append(simulation.hashes())
+            self.assertEqual(len(set(hashes[-1])), 1)
+            self.assertGreater(simulation.actions, 0)
+        self.assertEqual(hashes[0], hashes[1])
+
+    def test_rollback(self):
+        simulation = Simulation(2, seed=2, loss=0.2, rollback=True)
+        simulation.run(400)
+        self.assertEqual(len(set(simulation.hashes())), 1)
+        self.assertGreater(simulation.engines[0].rollbacks, 0)
+
+    def test_bookkeeping(self):
+        simulation = Simulation(2, seed=2, loss=0.2, rollback=True)
+        # Nobody moves, so the ticks only have delay proposals and state hashes
+        simulation.move_rate = 0
+        simulation.run(900)
+        self.assertEqual(len(set(simulation.hashes())), 1)
+        for net_engine in simulation.engines:
+            self.assertEqual(net_engine.rollbacks, 0)
+            self.assertEqual(net_engine.desyncs, [])
+        net_engine = simulation.engines[0]
+        self.assertGreater(sum(
+            action_type == 'hash' for tick in range(900)
+            for acts in net_engine.iter_actions[tick].values() for action_type, _ in acts), 0)
+        net_engine.replay_speed = 1
+        net_engine.start_replay()
+        net_engine.iteration()
+        frames = 0
+        while net_engine.game.mode == 'replay':
+            net_engine.act()
+            frames += 1
+        # Idle, so after waiting for replay_max_wait frames the replay skips to its end
+        self.assertLessEqual(frames, NetEngine.replay_max_wait + 1)
+
+    def test_malformed_action(self):
+        simulation = Simulation(2, seed=5)
+        simulation.run(200)
+        # A peer that doesn't check its actions sends a malformed move
+        simulation.engines[0].game.cur_actions.append(('move', ((1, 1), )))
+        net_engine = simulation.engines[1]
+        # Keep its messages
+        del net_engine.game.add_message
+        # Dropping the packet would stall the session on that tick
+        deadline = time.monotonic() + 10
+        simulation.run(400, until=lambda: time.monotonic() > deadline)
+        self.assertGreaterEqual(min(x.game.counter for x in simulation.engines), 400)
+        self.assertEqual(net_engine.stats()['rejected_actions'], 1)
+        # The rest of the tick arrived, and the session went on in sync
+        self.assertEqual(len(set(simulation.hashes())), 1)
+        self.assertEqual(net_engine.desyncs, [])
+        self.assertTrue(any(msg.startswith('Left out 1 malformed actions') for msg in net_engine.game.messages))
+
+    def test_loopback(self):
+        now = [0]
+        network = LoopbackNetwork(lambda: now[0], 0.05, 0.5, 3)
+        a = network.transport('a', lambda packet: packet)
+        b = network.transport('b', lambda packet: packet)
+        for i in range(100):
+            a.send(bytes([i]), 'b')
+        self.assertEqual(b.receive(), [])
+        now[0] = 0.05
+        received = b.receive()
+        self.assertGreater(len(received), 20)
+        self.assertLess(len(received), 80)
+        self.assertEqual([x[0] for x in received], ['a'] * len(received))
+        self.assertEqual(network.packets_sent, 100)
+
+class TestMetrics(unittest.TestCase):
+    def test_sinks(self):
+        simulation = Simulation(2, seed=1, loss=0.1)
+        metrics = simulation.instrument()
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        path = os.path.join(log_dir, 'metrics.jsonl')
+        metrics.log_to(path)
+        server = metrics.serve(0)
+        simulation.run(300)
+        with urllib.request.urlopen('http://127.0.0.1:%d/' % server.server_address[1]) as response:
+            served = json.loads(response.read())
+        metrics.close()
+        with open(path) as f:
+            summaries = [json.loads(line) for line in f]
+        self.assertEqual(len(summaries), metrics.tick // metrics.report_interval)
+        self.assertEqual(served, summaries[-1])
+        last = summaries[-1]
+        self.assertEqual(sorted(last['timings_ms']), ['NetEngine.act', 'NetEngine.communicate'])
+        # Summarized up to the last report
+        self.assertGreater(last['counters']['net.packets_sent'], 0)
+        self.assertLessEqual(last['counters']['net.packets_sent'], simulation.engines[0].transport.packets_sent)
+        self.assertGreater(last['counters']['net.bytes_received'], 0)
+        self.assertGreater(last['rates']['net.packets_sent'], 0)
+        self.assertTrue(any(line.startswith('NetEngine.act') for line in metrics.overlay()))
+
+class TestBot(unittest.TestCase):
+    def test_fog(self):
+        game = GameModel()
+        game.init()
+        game.mode = 'play'
+        game.players[game.my_id] = 0
+        bot = Bot(game, worker=False)
+        pieces = bot.observe()[4]
+        # White sees its own pieces and the squares in front of them, but not black's
+        self.assertEqual({x[1] for x in pieces}, {0})
+        # Moving pawns up until they see black's
+        for x in range(8):
+            game.board[x, 1]._move((x, 5))
+        self.assertEqual(len([x for x in bot.observe()[4] if x[1] == 1]), 8)
+
+    def test_worker(self):
+        game = GameModel()
+        game.init()
+        game.mode = 'play'
+        game.players[game.my_id] = 1
+        bot = Bot(game, strength=2)
+        deadline = time.monotonic() + 10
+        while not game.cur_actions and time.monotonic() < deadline:
+            bot.update()
+            time.sleep(0.001)
+        bot.stop()
+        [(action_type, (src, dst))] = game.cur_actions
+        self.assertEqual(action_type, 'move')
+        self.assertEqual(game.board[src].player, 1)
+        self.assertIn(dst, game.board[src].moves())
+
+    def test_worker_imports(self):
+        # A spawned worker imports main.py again and then bot.py, and importing Kivy would open a window
+        script = ("import runpy, sys; runpy.run_path('main.py', run_name='__mp_main__'); import bot; "
+                  "print([name for name in sys.modules if name.split('.')[0] == 'kivy'])")
+        result = subprocess.run(
+            [sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), '[]')
+
+    def test_reproducible(self):
+        hashes = []
+        for _ in range(2):
+            simulation = Simulation(2, seed=3, bots=2)
+            simulation.run(900)
+            self.assertEqual(len(set(simulation.hashes())), 1)
+            self.assertGreater(simulation.actions, 10)
+            self.assertEqual(simulation.engines[0].action_failures, 0)
+            hashes.append(simulation.hashes()[0])
+        self.assertEqual(hashes[0], hashes[1])
+
+class TestRelay(unittest.TestCase):
+    def test_relay(self):
+        rand = random.Random(7)
+        relay_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        relay_socket.bind(('127.0.0.1', 0))
+        relay = Relay(relay_socket, num_players=3)
+        instances = [GameInstance() for _ in range(3)]
+        for inst in instances:
+            inst.net_engine.connect_relay(relay_socket.getsockname())
+        for i in range(600):
+            relay.step()
+            inst = instances[i % 3]
+            inst.net_engine.iteration()
+            (src, piece) = rand.choice(sorted(inst.game.board.items()))
+            opts = sorted(piece.moves())
+            if opts and rand.random() < 0.3:
+                inst.game.add_action('move', src, rand.choice(opts))
+            time.sleep(0.0005)
+        counter = min(inst.game.counter for inst in instances)
+        self.assertGreater(counter, 50)
+        for inst in instances:
+            self.assertEqual(inst.game.num_boards, 2)
+            self.assertEqual(inst.game.players, instances[0].game.players)
+            for tick in range(counter - 20, counter):
+                self.assertEqual(len(inst.net_engine.iter_actions[tick]), 3)
+                self.assertEqual(inst.net_engine.iter_actions[tick], instances[0].net_engine.iter_actions[tick])
+
+    def test_spectators(self):
+        rand = random.Random(8)
+        relay_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        relay_socket.bind(('127.0.0.1', 0))
+        relay = Relay(relay_socket, num_players=2, spectator_delay=10)
+        relay.spectator_interval = 0.02
+        players = [GameInstance() for _ in range(2)]
+        spectators = [GameInstance() for _ in range(2)]
+        for inst in players:
+            inst.net_engine.connect_relay(relay_socket.getsockname())
+        for i in range(800):
+            if i == 0 or i == 400:
+                # One watches from the start, the other joins late
+                spectators[i // 400].net_engine.connect_relay(relay_socket.getsockname(), spectate=True)
+            relay.step()
+            inst = players[i % 2]
+            inst.net_engine.iteration()
+            (src, piece) = rand.choice(sorted(inst.game.board.items()))
+            opts = sorted(piece.moves())
+            if opts and rand.random() < 0.3:
+                inst.game.add_action('move', src, rand.choice(opts))
+            for spectator in spectators[:1 + i // 400]:
+                spectator.net_engine.iteration()
+            time.sleep(0.0005)
+        self.assertEqual(len(relay.roster), 2)
+        self.assertEqual(len(relay.spectators), 2)
+        counter = min(inst.game.counter for inst in players)
+        self.assertGreater(counter, 100)
+        hashes = players[0].net_engine.state_hashes
+        for spectator in spectators:
+            net_engine = spectator.net_engine
+            # Caught up, up to the delay and a batch
+            self.assertGreater(net_engine.game.counter, counter - 40)
+            self.assertEqual(spectator.game.players, players[0].game.players)
+            self.assertNotIn(spectator.game.my_id, net_engine.iter_actions[net_engine.game.counter - 1])
+            common = set(hashes) & set(net_engine.state_hashes)
+            self.assertTrue(common)
+            for tick in common:
+                self.assertEqual(net_engine.state_hashes[tick][0], hashes[tick][0])
+
+class TestMatchmaking(unittest.TestCase):
+    def test_protocol(self):
+        server = MatchServer(('127.0.0.1', 0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:%d' % server.server_address[1]
+        host, guest = MatchClient(url), MatchClient(url)
+        host_address = host.register('10.0.0.1', 1000)
+        guest_address = guest.register('10.0.0.2', 2000)
+        with self.assertRaises(MatchError) as cm:
+            guest.connect(guest_address, 'no such game')
+        self.assertEqual(cm.exception.status, 404)
+        result = []
+        lookup = threading.Thread(target=lambda: result.append(host.lookup(host_address)))
+        start = time.monotonic()
+        lookup.start()
+        time.sleep(0.1)
+        self.assertEqual(guest.connect(guest_address, host_address.upper()), '10.0.0.1:1000 10.0.0.2:2000')
+        lookup.join()
+        # The host's long poll returned as soon as the guest joined
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(result, ['10.0.0.1:1000 10.0.0.2:2000'])
+        # Each client kept a single connection alive
+        self.assertEqual((host.connections_opened, guest.connections_opened), (1, 1))
+        host.close()
+        guest.close()
+        server.shutdown()
+        server.server_close()
+
+class TestBatch(unittest.TestCase):
+    def test_sweep(self):
+        values = {'piece_freeze': [40, 80], 'player_freeze': [10]}
+        player_freeze_time = GameModel.player_freeze_time
+        in_process = list(batch.sweep(values, 2, strength=1, max_ticks=600, jobs=1))
+        self.assertEqual(list(batch.sweep(values, 2, strength=1, max_ticks=600, jobs=2)), in_process)
+        self.assertEqual([(row['piece_freeze'], row['seed']) for row in in_process], [(40, 0), (40, 1), (80, 0), (80, 1)])
+        # The cool-downs are restored after the games
+        self.assertEqual(GameModel.player_freeze_time, player_freeze_time)
+        rows = [{key: str(value) for key, value in row.items()} for row in in_process]
+        summary = batch.summarize(rows)
+        self.assertEqual([(x['piece_freeze'], x['games']) for x in summary], [(40, 2), (80, 2)])
+        for result in summary:
+            self.assertAlmostEqual(result['white_wins'] + result['black_wins'] + result['unfinished'], 1)
+        for row in in_process:
+            self.assertLessEqual(row['ticks'], 600)
+            if row['winner']:
+                # Counted when the king was captured, by the side that captured it
+                self.assertGreaterEqual(row['%s_captures' % row['winner']], 1)
 
 if __name__ == '__main__':
     unittest.main()
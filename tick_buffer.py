@@ -0,0 +1,147 @@
+'''
+Tick-indexed store of the actions exchanged by NetEngine.
+
+Recent ticks live in a fixed ring of slots, each holding ``{peer_id: actions}``.
+Ticks falling out of the ring are no longer changed by the lockstep,
+and are either dropped or, when a replay may still need them, spilled to a
+compact encoded log. Memory thus depends on the length of the current game,
+not of the whole session.
+'''
+
+from array import array
+from collections.abc import Mapping
+
+import wire
+
+class TickBuffer(Mapping):
+    '''
+    Behaves like the ``{tick: {peer_id: actions}}`` dict it replaces.
+
+    Spilled ticks are decoded on access and are final:
+    changing the returned dicts doesn't change the stored ticks.
+    Writes to ticks that were dropped are ignored.
+    '''
+
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.clear()
+
+    def clear(self):
+        self.slots = [None] * self.capacity
+        # The ring holds ticks in range(end - capacity, end)
+        self.end = 0
+        # Ticks before this are dropped rather than spilled
+        self.keep_from = 0
+        self.spill_start = 0
+        self.spill_data = bytearray()
+        # End offset of each spilled tick in spill_data (equal offsets for gaps)
+        self.spill_offsets = array('L')
+        self.peer_ids = []
+        self.peer_index = {}
+        # The last decoded spilled tick, as replay reads the same tick repeatedly
+        self.thawed = None
+
+    def _slot(self, tick):
+        if not self.end - self.capacity <= tick < self.end:
+            return None
+        slot = self.slots[tick % self.capacity]
+        if slot is None or slot[0] != tick:
+            return None
+        return slot
+
+    def __getitem__(self, tick):
+        slot = self._slot(tick)
+        if slot is not None:
+            return slot[1]
+        if self.thawed is not None and self.thawed[0] == tick:
+            return self.thawed[1]
+        acts = self._unspill(tick)
+        if acts is None:
+            raise KeyError(tick)
+        self.thawed = tick, acts
+        return acts
+
+    def __setitem__(self, tick, acts):
+        if tick >= self.end:
+            self._advance(tick + 1)
+        elif tick < self.end - self.capacity:
+            return
+        self.slots[tick % self.capacity] = (tick, acts)
+
+    def setdefault(self, tick, default=None):
+        try:
+            return self[tick]
+        except KeyError:
+            self[tick] = default
+            return default
+
+    def __iter__(self):
+        for i in range(len(self.spill_offsets)):
+            if self.spill_offsets[i] != (self.spill_offsets[i-1] if i else 0):
+                yield self.spill_start + i
+        for tick in range(max(0, self.end - self.capacity), self.end):
+            if self._slot(tick) is not None:
+                yield tick
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def _advance(self, end):
+        'Move the ring forward, spilling the ticks it no longer holds'
+        for tick in range(max(0, self.end - self.capacity), min(self.end, end - self.capacity)):
+            slot = self._slot(tick)
+            if slot is not None:
+                self._spill(tick, slot[1])
+                self.slots[tick % self.capacity] = None
+        self.end = end
+
+    def _spill(self, tick, acts):
+        if tick < self.keep_from:
+            return
+        if not self.spill_offsets:
+            self.spill_start = tick
+        # Pad gaps with empty entries
+        while self.spill_start + len(self.spill_offsets) < tick:
+            self.spill_offsets.append(len(self.spill_data))
+        out = self.spill_data
+        wire.write_varint(out, len(acts))
+        for peer_id, actions in acts.items():
+            index = self.peer_index.get(peer_id)
+            if index is None:
+                index = self.peer_index[peer_id] = len(self.peer_ids)
+                self.peer_ids.append(peer_id)
+            wire.write_varint(out, index)
+            out += wire.encode_actions(actions)
+        self.spill_offsets.append(len(out))
+
+    def _unspill(self, tick):
+        i = tick - self.spill_start
+        if not 0 <= i < len(self.spill_offsets):
+            return None
+        start = self.spill_offsets[i-1] if i else 0
+        if start == self.spill_offsets[i]:
+            return None
+        r = wire.Reader(self.spill_data[start:self.spill_offsets[i]])
+        acts = {}
+        for _ in range(r.varint()):
+            peer_id = self.peer_ids[r.varint()]
+            # Actions were checked before they were stored
+            acts[peer_id] = r.actions(check=False)
+        return acts
+
+    def release(self, before):
+        'Ticks before the given one will not be read again'
+        self.keep_from = max(self.keep_from, before)
+        if self.thawed is not None and self.thawed[0] < before:
+            self.thawed = None
+        num_dropped = min(before - self.spill_start, len(self.spill_offsets))
+        if num_dropped <= 0:
+            return
+        offset = self.spill_offsets[num_dropped-1]
+        del self.spill_data[:offset]
+        self.spill_offsets = array('L', (x - offset for x in self.spill_offsets[num_dropped:]))
+        self.spill_start += num_dropped
+
+    def spilled_size(self):
+        'Bytes held by spilled ticks'
+        return len(self.spill_data) + self.spill_offsets.itemsize * len(self.spill_offsets)
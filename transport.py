@@ -0,0 +1,140 @@
+'''
+Network transports of NetEngine.
+
+A transport has:
+
+* send(packet, addr)
+* receive(), returning the ``(addr, decoded packet, time received)``
+  of the packets that arrived since the last call
+* close()
+* socket, the socket it reads (None if it has none)
+* packets_sent, bytes_sent, packets_received and bytes_received counters
+
+UdpTransport reads its socket in a dedicated thread, which decodes packets
+as they arrive and hands them to the game loop through a queue, so neither
+waits for the other.
+
+LoopbackTransport connects engines in the same process, for tests and
+simulations (see simulate.py).
+'''
+
+import collections
+import random
+import select
+import threading
+import time
+
+import wire
+
+class UdpTransport:
+    # How often the receive thread checks whether it was closed (seconds)
+    poll_interval = 0.1
+
+    def __init__(self, sock, decode):
+        self.socket = sock
+        self.decode = decode
+        # (address, decoded packet, time received) tuples. deque's append and popleft are atomic,
+        # so the threads share it without locks.
+        self.received = collections.deque()
+        self.should_stop = False
+        # Counted by the receive thread for received packets, which is their only writer
+        self.packets_sent = self.bytes_sent = 0
+        self.packets_received = self.bytes_received = 0
+        self.thread = threading.Thread(target=self.receive_thread_go, daemon=True)
+        self.thread.start()
+
+    def send(self, packet, addr):
+        # Sending and receiving on a UDP socket from different threads is safe
+        self.socket.sendto(packet, 0, addr)
+        self.packets_sent += 1
+        self.bytes_sent += len(packet)
+
+    def receive(self):
+        'Packets received since the last call'
+        result = []
+        while self.received:
+            result.append(self.received.popleft())
+        return result
+
+    def close(self):
+        self.should_stop = True
+
+    def receive_thread_go(self):
+        while not self.should_stop:
+            try:
+                if not select.select([self.socket], [], [], self.poll_interval)[0]:
+                    continue
+                packet, addr = self.socket.recvfrom(wire.max_datagram_size)
+            except (OSError, ValueError):
+                # Socket closed
+                return
+            received_at = time.monotonic()
+            self.packets_received += 1
+            self.bytes_received += len(packet)
+            try:
+                self.received.append((addr, self.decode(packet), received_at))
+            except wire.DecodeError:
+                print('dropping malformed packet from %s:%d' % addr)
+
+class LoopbackNetwork:
+    '''
+    In-memory network of LoopbackTransports.
+
+    Packets arrive after a fixed latency by the network's clock,
+    and a random share of them is lost. The randomness is seeded,
+    so that with a simulated clock, runs are reproducible.
+    '''
+
+    def __init__(self, clock=time.monotonic, latency=0, loss=0, seed=0):
+        self.clock = clock
+        self.latency = latency
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.transports = {}
+        self.packets_sent = 0
+        self.bytes_sent = 0
+
+    def transport(self, addr, decode):
+        'A transport receiving the packets sent to addr'
+        transport = self.transports[addr] = LoopbackTransport(self, addr, decode)
+        return transport
+
+class LoopbackTransport:
+    socket = None
+
+    def __init__(self, network, addr, decode):
+        self.network = network
+        self.addr = addr
+        self.decode = decode
+        # (arrival time, sender address, packet) in order of arrival
+        self.in_flight = collections.deque()
+        self.packets_sent = self.bytes_sent = 0
+        self.packets_received = self.bytes_received = 0
+
+    def send(self, packet, addr):
+        self.packets_sent += 1
+        self.bytes_sent += len(packet)
+        network = self.network
+        network.packets_sent += 1
+        network.bytes_sent += len(packet)
+        recipient = network.transports.get(addr)
+        if recipient is None or network.loss and network.random.random() < network.loss:
+            return
+        recipient.in_flight.append((network.clock() + network.latency, self.addr, packet))
+
+    def receive(self):
+        now = self.network.clock()
+        result = []
+        while self.in_flight and self.in_flight[0][0] <= now:
+            received_at, addr, packet = self.in_flight.popleft()
+            self.packets_received += 1
+            self.bytes_received += len(packet)
+            try:
+                result.append((addr, self.decode(packet), received_at))
+            except wire.DecodeError:
+                print('dropping malformed packet from %s' % (addr, ))
+        return result
+
+    def close(self):
+        if self.network.transports.get(self.addr) is self:
+            del self.network.transports[self.addr]
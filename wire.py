@@ -0,0 +1,569 @@
+'''
+Binary encoding of the lockstep packets exchanged by NetEngine.
+
+A packet carries the actions of one sender for a window of ticks:
+
+    magic, version, sender id (8 bytes), ack, clock, first tick, entries...
+
+The ack tells the recipient up to which tick (exclusive) the sender holds
+all of its actions, so that it doesn't need to resend them.
+
+The clock is three varints used to measure round-trip times: the sender's
+time in milliseconds, the latest time it received from the recipient
+(plus one, zero if none) and for how long it held that before sending.
+
+Each entry starts with a varint holding the tick delta from the previous entry
+and the entry kind. An empty tick is a single byte. Other entries have a length
+prefixed body with the tick's actions, each encoded as an action code followed
+by tagged parameters. Board squares are packed into a single varint.
+
+Ticks are resent in several consecutive packets, so Encoder reuses their
+encoding and Decoder skips entries it already received without decoding them.
+
+Ticks with too many actions to fit in one datagram are split into fragments,
+which Decoder reassembles.
+
+A relay (see relay.py) sends merged packets, holding the actions of all
+players. Their magic differs, and after the clock they have the relay's
+roster: the number of players and their 8 byte ids. Each tick's body holds
+the actions of every player by their index in the roster.
+Merged ticks too large for a datagram are split into byte fragments.
+
+Spectators of a relayed game send the relay spectator requests: a header
+with their own magic and no entries, whose ack asks for the merged ticks
+from that tick on.
+
+Decoded actions are checked against their schemas (see action_registry.py).
+A malformed action is left out of its tick (and counted by the decoder) rather
+than rejecting its packet: the sender would resend the tick forever, while
+every receiver leaving out the same action keeps the tick identical for all.
+'''
+
+import struct
+
+import action_registry
+
+magic = 0xc5
+merged_magic = 0xc6
+spectator_magic = 0xc7
+version = 3
+
+# Datagram payload size we aim for (safely below common MTUs)
+max_packet_size = 1200
+# What the receiving side must be able to read
+max_datagram_size = 0x10000
+
+action_codes = ['move', 'msg', 'surrender', 'become', 'nick', 'credits', 'delay', 'hash']
+action_by_code = {code: name for code, name in enumerate(action_codes, 1)}
+code_by_action = {name: code for code, name in action_by_code.items()}
+
+EMPTY, ACTIONS, FRAGMENT = range(3)
+
+T_INT, T_STR, T_SQUARE, T_TUPLE, T_LIST, T_NONE, T_FLOAT, T_TRUE, T_FALSE = range(9)
+
+class DecodeError(ValueError):
+    pass
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def write_value(out, value):
+    if value is None:
+        out.append(T_NONE)
+    elif value is True:
+        out.append(T_TRUE)
+    elif value is False:
+        out.append(T_FALSE)
+    elif type(value) == int:
+        out.append(T_INT)
+        write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+    elif type(value) == str:
+        data = value.encode('utf-8')
+        out.append(T_STR)
+        write_varint(out, len(data))
+        out += data
+    elif type(value) == float:
+        out.append(T_FLOAT)
+        out += struct.pack('<d', value)
+    elif type(value) == tuple and len(value) == 2 and all(type(x) == int for x in value) and \
+            value[0] >= 0 and 0 <= value[1] < 8:
+        out.append(T_SQUARE)
+        write_varint(out, value[0] * 8 + value[1])
+    elif type(value) in (tuple, list):
+        out.append(T_TUPLE if type(value) == tuple else T_LIST)
+        write_varint(out, len(value))
+        for x in value:
+            write_value(out, x)
+    else:
+        raise TypeError('Cannot encode %r' % (value, ))
+
+def encode_actions(actions):
+    out = bytearray()
+    write_varint(out, len(actions))
+    for act_type, params in actions:
+        code = code_by_action.get(act_type, 0)
+        out.append(code)
+        if code == 0:
+            write_value(out, act_type)
+        write_varint(out, len(params))
+        for x in params:
+            write_value(out, x)
+    return out
+
+def tick_entries(actions, max_size=max_packet_size):
+    'Encoded entries (kind, body) of one tick'
+    if not actions:
+        return [(EMPTY, b'')]
+    body = encode_actions(actions)
+    if len(body) + 16 <= max_size or len(actions) == 1:
+        entry = bytearray()
+        write_varint(entry, len(body))
+        return [(ACTIONS, bytes(entry + body))]
+    # Split across fragments holding as many actions as fit
+    parts = []
+    part_size = 0
+    for action in actions:
+        size = len(encode_actions([action]))
+        if parts and part_size + size + 16 <= max_size:
+            parts[-1].append(action)
+            part_size += size
+        else:
+            parts.append([action])
+            part_size = size
+    entries = []
+    for i, part in enumerate(parts):
+        body = encode_actions(part)
+        entry = bytearray()
+        write_varint(entry, i)
+        write_varint(entry, len(parts))
+        write_varint(entry, len(body))
+        entries.append((FRAGMENT, bytes(entry + body)))
+    return entries
+
+def merged_tick_entries(acts, roster_index, max_size=max_packet_size):
+    'Encoded entries (kind, body) of the ``[(peer_id, actions)]`` of a merged tick'
+    body = bytearray()
+    write_varint(body, len(acts))
+    for peer_id, actions in acts:
+        write_varint(body, roster_index[peer_id])
+        body += encode_actions(actions)
+    if len(body) + 16 <= max_size:
+        entry = bytearray()
+        write_varint(entry, len(body))
+        return [(ACTIONS, bytes(entry + body))]
+    chunk_size = max_size - 64
+    chunks = [body[i:i+chunk_size] for i in range(0, len(body), chunk_size)]
+    entries = []
+    for i, chunk in enumerate(chunks):
+        entry = bytearray()
+        write_varint(entry, i)
+        write_varint(entry, len(chunks))
+        write_varint(entry, len(chunk))
+        entries.append((FRAGMENT, bytes(entry + chunk)))
+    return entries
+
+def varint_bytes(value):
+    out = bytearray()
+    write_varint(out, value)
+    return bytes(out)
+
+small_varints = [bytes([i]) for i in range(0x80)]
+
+def packet_header(packet_magic, sender_id, ack, clock):
+    sent, echo, held = clock or (0, None, 0)
+    return b''.join([
+        bytes([packet_magic, version]), struct.pack('<Q', sender_id), varint_bytes(ack),
+        varint_bytes(sent), varint_bytes(0 if echo is None else echo + 1), varint_bytes(held)])
+
+def spectator_request(sender_id, ack, clock=None):
+    'Packet asking a relay for its merged ticks from ack on'
+    return packet_header(spectator_magic, sender_id, ack, clock)
+
+def pack(sender_id, entries, max_size=max_packet_size, ack=0, clock=None, roster=None):
+    '''
+    Pack encoded (tick, kind, body) entries into packets (at least one).
+
+    Packets with a roster are merged packets.
+    '''
+    prefix = [packet_header(magic if roster is None else merged_magic, sender_id, ack, clock)]
+    if roster is not None:
+        prefix.append(varint_bytes(len(roster)))
+        prefix += [struct.pack('<Q', peer_id) for peer_id in roster]
+    prefix = b''.join(prefix)
+    packets = []
+    parts = None
+    for tick, kind, body in entries:
+        if parts is not None:
+            header = (tick - prev) << 2 | kind
+            header = small_varints[header] if header < 0x80 else varint_bytes(header)
+            if size + len(header) + len(body) <= max_size:
+                parts += (header, body)
+                size += len(header) + len(body)
+                prev = tick
+                continue
+            packets.append(b''.join(parts))
+        parts = [prefix, varint_bytes(tick), small_varints[kind], body]
+        size = sum(map(len, parts))
+        prev = tick
+    if parts is None:
+        parts = [prefix, small_varints[0]]
+    packets.append(b''.join(parts))
+    return packets
+
+class Encoder:
+    '''
+    Encodes packets, reusing the encoding of ticks that were already sent.
+
+    The same ticks are resent on every frame until they are no longer needed,
+    and a tick's action list doesn't change once it was sent.
+    '''
+
+    def __init__(self, max_size=max_packet_size):
+        self.max_size = max_size
+        self.cache = {}
+
+    def encode(self, sender_id, ticks, ack=0, clock=None):
+        '''
+        Encode ``[(tick, actions)]`` (ticks in increasing order) into packets.
+
+        clock is ``(sent, echo, held)``, see the module documentation.
+
+        Returns a list of packets, each at most max_size bytes,
+        unless a single action is larger than that.
+        '''
+        entries = []
+        for tick, actions in ticks:
+            cached = self.cache.get(tick)
+            if cached is None or cached[0] is not actions:
+                cached = self.cache[tick] = (actions, tick_entries(actions, self.max_size))
+            entries += [(tick, kind, body) for kind, body in cached[1]]
+        return pack(sender_id, entries, self.max_size, ack, clock)
+
+    def forget(self, before):
+        'Drop cached encodings of ticks that will not be sent again'
+        for tick in [x for x in self.cache if x < before]:
+            del self.cache[tick]
+
+class MergedEncoder:
+    'Encodes merged packets, reusing the encoding of ticks that were already sent'
+
+    def __init__(self, max_size=max_packet_size):
+        self.max_size = max_size
+        self.cache = {}
+        self.roster = None
+
+    def encode(self, sender_id, roster, ticks, ack=0, clock=None):
+        '''
+        Encode ``[(tick, [(peer_id, actions)])]`` (complete ticks in increasing order) into packets.
+
+        Players are referred to by their index in the roster.
+        '''
+        if roster != self.roster:
+            self.roster = list(roster)
+            self.roster_index = {peer_id: i for i, peer_id in enumerate(roster)}
+            self.cache.clear()
+        entries = []
+        for tick, acts in ticks:
+            cached = self.cache.get(tick)
+            if cached is None:
+                cached = self.cache[tick] = merged_tick_entries(acts, self.roster_index, self.max_size)
+            entries += [(tick, kind, body) for kind, body in cached]
+        return pack(sender_id, entries, self.max_size, ack, clock, self.roster)
+
+    def forget(self, before):
+        for tick in [x for x in self.cache if x < before]:
+            del self.cache[tick]
+
+def encode(sender_id, ticks, max_size=max_packet_size, ack=0, clock=None):
+    return Encoder(max_size).encode(sender_id, ticks, ack, clock)
+
+class Reader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def byte(self):
+        if self.pos >= len(self.data):
+            raise DecodeError('truncated packet')
+        self.pos += 1
+        return self.data[self.pos-1]
+
+    def bytes(self, n):
+        if self.pos + n > len(self.data):
+            raise DecodeError('truncated packet')
+        self.pos += n
+        return self.data[self.pos-n:self.pos]
+
+    def varint(self):
+        result = 0
+        shift = 0
+        while True:
+            b = self.byte()
+            result |= (b & 0x7f) << shift
+            if b < 0x80:
+                return result
+            shift += 7
+
+    def value(self):
+        tag = self.byte()
+        if tag == T_INT:
+            x = self.varint()
+            return -(x + 1) // 2 if x & 1 else x // 2
+        if tag == T_STR:
+            try:
+                return self.bytes(self.varint()).decode('utf-8')
+            except UnicodeDecodeError as err:
+                raise DecodeError(str(err))
+        if tag == T_SQUARE:
+            return divmod(self.varint(), 8)
+        if tag in (T_TUPLE, T_LIST):
+            items = [self.value() for _ in range(self.varint())]
+            return tuple(items) if tag == T_TUPLE else items
+        if tag == T_NONE:
+            return None
+        if tag == T_FLOAT:
+            return struct.unpack('<d', self.bytes(8))[0]
+        if tag in (T_TRUE, T_FALSE):
+            return tag == T_TRUE
+        raise DecodeError('bad value tag %d' % tag)
+
+    def actions(self, check=True, rejected=None):
+        '''
+        Decode actions, leaving out those that don't match their schemas.
+
+        Descriptions of the actions left out are added to the rejected list.
+        Without checking (say for our own logs), unknown action codes are errors.
+        '''
+        result = []
+        for _ in range(self.varint()):
+            code = self.byte()
+            act_type = self.value() if code == 0 else action_by_code.get(code)
+            params = tuple(self.value() for _ in range(self.varint()))
+            if type(act_type) != str:
+                error = 'bad action code %d' % code
+                if not check:
+                    raise DecodeError(error)
+            elif check:
+                error = action_registry.check(act_type, params)
+            else:
+                error = None
+            if error:
+                if rejected is not None:
+                    rejected.append('%s: %s' % (act_type, error))
+                continue
+            result.append((act_type, params))
+        return result
+
+    def at_end(self):
+        return self.pos == len(self.data)
+
+def entries(packet):
+    '''
+    Split a packet into ``(sender_id, ack, clock, [(tick, kind, part, num_parts, body)])``.
+
+    Bodies are left encoded, see Reader.actions.
+    '''
+    r = Reader(packet)
+    sender_id, ack, clock = read_header(r, magic)
+    return sender_id, ack, clock, read_entries(r)
+
+def merged_entries(packet):
+    'Split a merged packet into ``(sender_id, ack, clock, roster, entries)``'
+    r = Reader(packet)
+    sender_id, ack, clock = read_header(r, merged_magic)
+    roster = [struct.unpack('<Q', r.bytes(8))[0] for _ in range(r.varint())]
+    return sender_id, ack, clock, roster, read_entries(r)
+
+def read_spectator_request(packet):
+    'Returns the ``(sender_id, ack, clock)`` of a spectator request'
+    r = Reader(packet)
+    result = read_header(r, spectator_magic)
+    if not r.at_end():
+        raise DecodeError('trailing bytes in spectator request')
+    return result
+
+def read_header(r, expected_magic):
+    if r.byte() != expected_magic or r.byte() != version:
+        raise DecodeError('not a packet of this protocol version')
+    sender_id = struct.unpack('<Q', r.bytes(8))[0]
+    ack = r.varint()
+    sent = r.varint()
+    echo = r.varint() - 1
+    clock = sent, None if echo < 0 else echo, r.varint()
+    return sender_id, ack, clock
+
+def read_entries(r):
+    tick = r.varint()
+    result = []
+    first = True
+    data = r.data
+    end = len(data)
+    while r.pos < end:
+        # Fast path for the common single byte header
+        header = data[r.pos]
+        if header < 0x80:
+            r.pos += 1
+        else:
+            header = r.varint()
+        if not first:
+            tick += header >> 2
+        first = False
+        kind = header & 3
+        if kind == EMPTY:
+            result.append((tick, EMPTY, 0, 1, b''))
+            continue
+        part, num_parts = 0, 1
+        if kind == FRAGMENT:
+            part = r.varint()
+            num_parts = r.varint()
+            if part >= num_parts:
+                raise DecodeError('bad fragment index')
+        elif kind != ACTIONS:
+            raise DecodeError('bad entry kind')
+        result.append((tick, kind, part, num_parts, r.bytes(r.varint())))
+    return result
+
+def decode_actions(body, rejected=None):
+    r = Reader(body)
+    actions = r.actions(rejected=rejected)
+    if not r.at_end():
+        raise DecodeError('trailing bytes in actions')
+    return actions
+
+def decode(packet):
+    '''
+    Decode a packet into ``(sender_id, ack, clock, ticks, fragments)``.
+
+    ticks is a list of ``(tick, actions)``,
+    and fragments a list of ``(tick, part, num_parts, actions)``.
+    '''
+    sender_id, ack, clock, packet_entries = entries(packet)
+    ticks = []
+    fragments = []
+    for tick, kind, part, num_parts, body in packet_entries:
+        actions = decode_actions(body) if body else []
+        if kind == FRAGMENT:
+            fragments.append((tick, part, num_parts, actions))
+        else:
+            ticks.append((tick, actions))
+    return sender_id, ack, clock, ticks, fragments
+
+class Decoder:
+    '''
+    Decodes packets, reassembling ticks that were split into fragments.
+
+    Entries identical to ones already received are skipped without decoding,
+    so only new (or conflicting) ticks are returned. A packet is decoded in
+    full before its entries count as received, so when it turns out to be
+    malformed, resends of its valid entries aren't skipped.
+    '''
+
+    max_pending = 256
+    # How many ticks back to remember received entries
+    history = 512
+
+    def __init__(self):
+        self.pending = {}
+        self.received = {}
+        self.latest = 0
+        # Size of received at which to prune it. It holds the history of every sender,
+        # so this grows with their number, for pruning to stay occasional.
+        self.prune_at = 4 * self.history
+        # Malformed actions left out of the ticks, and the description of the latest
+        self.rejected_actions = 0
+        self.last_rejected = None
+
+    def reject(self, rejected):
+        if rejected:
+            self.rejected_actions += len(rejected)
+            self.last_rejected = rejected[-1]
+
+    def decode(self, packet):
+        'Returns (sender_id, ack, clock, [(tick, actions)]) with complete, newly received ticks'
+        sender_id, ack, clock, packet_entries = entries(packet)
+        new_entries = []
+        rejected = []
+        for tick, kind, part, num_parts, body in packet_entries:
+            key = sender_id, tick, part
+            if self.received.get(key) == body:
+                continue
+            new_entries.append((key, kind, num_parts, body, decode_actions(body, rejected) if body else []))
+        self.reject(rejected)
+        ticks = []
+        for key, kind, num_parts, body, actions in new_entries:
+            tick, part = key[1:]
+            self.received[key] = body
+            self.latest = max(self.latest, tick)
+            if kind != FRAGMENT:
+                ticks.append((tick, actions))
+                continue
+            parts = self.pending.setdefault((sender_id, tick), {})
+            parts[part] = actions
+            if not all(i in parts for i in range(num_parts)):
+                continue
+            del self.pending[sender_id, tick]
+            ticks.append((tick, [x for i in range(num_parts) for x in parts[i]]))
+        self.prune()
+        return sender_id, ack, clock, ticks
+
+    def prune(self):
+        while len(self.pending) > self.max_pending:
+            del self.pending[min(self.pending, key=lambda x: x[1])]
+        if len(self.received) > self.prune_at:
+            self.received = {
+                key: body for key, body in self.received.items()
+                if key[1] >= self.latest - self.history}
+            self.prune_at = max(4 * self.history, 2 * len(self.received))
+
+class MergedDecoder(Decoder):
+    'Decodes merged packets from a relay'
+
+    def decode(self, packet):
+        'Returns (sender_id, ack, clock, roster, [(tick, [(peer_id, actions)])]) with newly received ticks'
+        sender_id, ack, clock, roster, packet_entries = merged_entries(packet)
+        new_entries = []
+        # (sender_id, tick) -> fragments of incomplete ticks, with those of this packet
+        fragments = {}
+        completed = []
+        ticks = []
+        rejected = []
+        for tick, kind, part, num_parts, body in packet_entries:
+            key = sender_id, tick, part
+            if self.received.get(key) == body:
+                continue
+            new_entries.append((key, body))
+            if kind == FRAGMENT:
+                if (sender_id, tick) not in fragments:
+                    fragments[sender_id, tick] = dict(self.pending.get((sender_id, tick), {}))
+                parts = fragments[sender_id, tick]
+                parts[part] = body
+                if not all(i in parts for i in range(num_parts)):
+                    continue
+                del fragments[sender_id, tick]
+                completed.append((sender_id, tick))
+                body = b''.join(parts[i] for i in range(num_parts))
+            elif kind != ACTIONS:
+                raise DecodeError('bad entry kind in merged packet')
+            r = Reader(body)
+            acts = []
+            for _ in range(r.varint()):
+                index = r.varint()
+                if index >= len(roster):
+                    raise DecodeError('bad roster index')
+                acts.append((roster[index], r.actions(rejected=rejected)))
+            if not r.at_end():
+                raise DecodeError('trailing bytes in merged tick')
+            ticks.append((tick, acts))
+        # Decoded in full, so only now are its entries received
+        self.reject(rejected)
+        for key, body in new_entries:
+            self.received[key] = body
+            self.latest = max(self.latest, key[1])
+        self.pending.update(fragments)
+        for key in completed:
+            self.pending.pop(key, None)
+        self.prune()
+        return sender_id, ack, clock, roster, ticks